@@ -83,8 +83,9 @@ public function register(Request $request)
                         
                         Log::info('Encoding received, length: ' . (is_array($encoding) ? count($encoding) : 'not array'));
                         
-                        $encodingJson = json_encode($encoding);
-                        Log::info('Encoding JSON length: ' . strlen($encodingJson));
+                        // Prefer the compact template; fall back to the JSON array for older services
+                        $encodingJson = $response->json('template') ?? json_encode($encoding);
+                        Log::info('Stored encoding length: ' . strlen($encodingJson));
                         
                         $updated = $user->update([
                             'face_encoding' => $encodingJson,
@@ -235,8 +236,14 @@ public function verifyFace(Request $request)
             
             Log::info('Calling face service at: ' . $faceServiceUrl);
             
-            $storedEncoding = json_decode($user->face_encoding, true);
-            Log::info('Stored encoding array length: ' . (is_array($storedEncoding) ? count($storedEncoding) : 'not array'));
+            // Legacy rows hold a JSON array; compact templates are passed through as-is
+            $storedEncoding = $user->face_encoding;
+            if (str_starts_with(ltrim($storedEncoding), '[')) {
+                $storedEncoding = json_decode($storedEncoding, true);
+                Log::info('Stored encoding array length: ' . (is_array($storedEncoding) ? count($storedEncoding) : 'not array'));
+            } else {
+                Log::info('Stored encoding template length: ' . strlen($storedEncoding));
+            }
             
             $response = Http::timeout(30)->post($faceServiceUrl . '/verify-face', [
                 'image' => $request->face_image,
@@ -484,7 +491,7 @@ public function setupFaceAuth(Request $request)
             }
 
             // Store the face encoding
-            $user->face_encoding = json_encode($result['encoding']);
+            $user->face_encoding = $result['template'] ?? json_encode($result['encoding']);
             $user->face_auth_enabled = true;
             $user->face_registered_at = now();
             $user->save();
@@ -0,0 +1,65 @@
+<?php
+
+require __DIR__ . '/vendor/autoload.php';
+
+$app = require_once __DIR__ . '/bootstrap/app.php';
+$app->make('Illuminate\Contracts\Console\Kernel')->bootstrap();
+
+use App\Models\User;
+use Illuminate\Support\Facades\Http;
+
+// Converts legacy JSON-array face encodings to the compact template format.
+// Usage: php convert_face_templates.php [--dry-run] [float16|float32]
+
+$dryRun = in_array('--dry-run', $argv);
+$dtype = in_array('float32', $argv) ? 'float32' : 'float16';
+$faceServiceUrl = env('FACE_RECOGNITION_SERVICE_URL', 'http://localhost:5000');
+$batchSize = 100;
+
+echo "=== CONVERTING FACE TEMPLATES ({$dtype}" . ($dryRun ? ', dry run' : '') . ") ===\n\n";
+
+$converted = 0;
+$failed = 0;
+$bytesBefore = 0;
+$bytesAfter = 0;
+
+User::whereNotNull('face_encoding')
+    ->where('face_encoding', 'like', '[%')
+    ->chunkById($batchSize, function ($users) use ($faceServiceUrl, $dtype, $dryRun, &$converted, &$failed, &$bytesBefore, &$bytesAfter) {
+        $encodings = [];
+        foreach ($users as $user) {
+            $encodings[(string) $user->id] = $user->face_encoding;
+        }
+
+        $response = Http::timeout(60)->post($faceServiceUrl . '/convert-templates', [
+            'encodings' => $encodings,
+            'dtype' => $dtype,
+        ]);
+
+        if (!$response->successful() || !$response->json('success')) {
+            echo "❌ Face service error: " . $response->body() . "\n";
+            $failed += count($encodings);
+            return;
+        }
+
+        foreach ($response->json('errors') ?? [] as $id => $error) {
+            echo "⚠️ User {$id}: {$error}\n";
+            $failed++;
+        }
+
+        foreach ($response->json('templates') as $id => $template) {
+            $bytesBefore += strlen($encodings[$id]);
+            $bytesAfter += strlen($template);
+            if (!$dryRun) {
+                User::where('id', $id)->update(['face_encoding' => $template]);
+            }
+            $converted++;
+        }
+
+        echo "✅ Converted {$converted} so far\n";
+    });
+
+echo "\nConverted: {$converted}, failed: {$failed}\n";
+if ($converted > 0) {
+    echo "Stored size: {$bytesBefore} -> {$bytesAfter} bytes (" . round(100 * $bytesAfter / $bytesBefore, 1) . "%)\n";
+}
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import CORS
 import cv2
 import numpy as np
@@ -6,36 +6,288 @@ import base64
 import io
 from PIL import Image
 import os
+import time
+import threading
+import contextvars
+from dataclasses import dataclass, field, replace
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from face_encoder import FaceEncoder, encoding_deviation
+import registration_pool
+from registration_jobs import RegistrationJobs, QueueFull
+from face_tracker import FaceTracker
+from face_cache import FaceCache, content_key
+from face_detectors import create_detector, DEFAULT_YUNET_MODEL
+from service_metrics import ServiceMetrics
+from template_store import TemplateStore, fold_mean
+from gallery import Gallery, pairwise_scores
+from template_codec import load_template, template_to_text
+from template_set import build_template_set, score_template_set
 
 app = Flask(__name__)
 CORS(app)
 
-# Load OpenCV's pre-trained face detector
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-
 # Configuration
 TOLERANCE = float(os.environ.get('TOLERANCE', '0.92'))  # 92% similarity minimum - EXTREMELY STRICT
 MAX_DISTANCE = float(os.environ.get('MAX_DISTANCE', '0.35'))  # Relaxed to 0.35 for better same-person acceptance
 MIN_PIXEL_SIMILARITY = float(os.environ.get('MIN_PIXEL_SIMILARITY', '0.88'))  # Raw pixel must be 88%+ similar
+VERIFY_EARLY_REJECT = os.environ.get('VERIFY_EARLY_REJECT', 'True').lower() == 'true'  # Reject on the 20x20 pixel block before full encoding
+VERIFY_EARLY_REJECT_MARGIN = float(os.environ.get('VERIFY_EARLY_REJECT_MARGIN', '1e-4'))  # Only early-reject this far below MIN_PIXEL_SIMILARITY
+VERIFY_BURST_MAX_FRAMES = int(os.environ.get('VERIFY_BURST_MAX_FRAMES', '5'))  # Frames scored at most per burst request
+VERIFY_BURST_THREADS = int(os.environ.get('VERIFY_BURST_THREADS', '2'))  # Burst frames scored concurrently
+VERIFY_BURST_BUDGET_MS = float(os.environ.get('VERIFY_BURST_BUDGET_MS', '1500'))  # Stop scoring a burst after this long
+COMPARE_BATCH_MAX_ITEMS = int(os.environ.get('COMPARE_BATCH_MAX_ITEMS', '20'))  # Images + templates per /compare-batch request
 IMAGE_SIZE = (200, 200)  # Larger size for more detail
 MIN_FACE_SIZE = (80, 80)  # Minimum face detection size
+FACE_DETECTOR = os.environ.get('FACE_DETECTOR', 'haar')  # Detector backend: haar, yunet (OpenCV DNN) or dlib (HOG)
+FACE_DETECTOR_MODEL = os.environ.get('FACE_DETECTOR_MODEL', DEFAULT_YUNET_MODEL)  # ONNX model file for the yunet backend
+FACE_DETECTOR_SCORE = float(os.environ.get('FACE_DETECTOR_SCORE', '0.8'))  # Minimum yunet confidence for a face
+DETECT_MAX_SIDE = int(os.environ.get('DETECT_MAX_SIDE', '0'))  # Run the detector on a copy no larger than this (0 = full resolution)
+TRACK_MAX_SESSIONS = int(os.environ.get('TRACK_MAX_SESSIONS', '1000'))  # /detect-face sessions remembered at once
+TRACK_TTL_SECONDS = float(os.environ.get('TRACK_TTL_SECONDS', '30'))  # Forget a session after this long without a poll
+TRACK_ROI_MARGIN = float(os.environ.get('TRACK_ROI_MARGIN', '0.5'))  # ROI = last box grown by this fraction per side
+TRACK_FULL_SCAN_EVERY = int(os.environ.get('TRACK_FULL_SCAN_EVERY', '10'))  # Force a full-frame scan every N polls
+TEMPLATE_STORE_DIR = os.environ.get('TEMPLATE_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template_store'))
+IDENTIFY_TOP_K = int(os.environ.get('IDENTIFY_TOP_K', '5'))  # Candidates returned by /identify-face
+IDENTIFY_IVF_MIN_SIZE = int(os.environ.get('IDENTIFY_IVF_MIN_SIZE', '50000'))  # Use the approximate IVF index from this many templates (0 = always exact)
+IDENTIFY_IVF_LISTS = int(os.environ.get('IDENTIFY_IVF_LISTS', '0'))  # IVF clusters (0 = sqrt of gallery size)
+IDENTIFY_IVF_PROBES = int(os.environ.get('IDENTIFY_IVF_PROBES', '16'))  # IVF clusters scanned per search
+KIOSK_MAX_FACES = int(os.environ.get('KIOSK_MAX_FACES', '10'))  # Largest faces identified per /identify-faces frame
+REGISTRATION_JOB_DB = os.environ.get('REGISTRATION_JOB_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registration_jobs.sqlite3'))  # Job queue shared by every worker process, opened on first use
+REGISTRATION_JOB_WORKERS = int(os.environ.get('REGISTRATION_JOB_WORKERS', '1'))  # Registrations running at once, across all worker processes
+REGISTRATION_JOB_MAX_QUEUED = int(os.environ.get('REGISTRATION_JOB_MAX_QUEUED', '20'))  # Reject new jobs (503) beyond this many waiting, service-wide
+REGISTRATION_JOB_STALE_SECONDS = float(os.environ.get('REGISTRATION_JOB_STALE_SECONDS', '120'))  # Requeue running jobs without a heartbeat for this long
+REGISTRATION_JOB_TTL_SECONDS = float(os.environ.get('REGISTRATION_JOB_TTL_SECONDS', '3600'))  # Keep finished jobs this long for polling
+ENROLL_DEFAULT_WEIGHT = float(os.environ.get('ENROLL_DEFAULT_WEIGHT', '35'))  # Samples assumed behind a template with no recorded count (5 images x 7 augmentations)
+ENROLL_DECAY = float(os.environ.get('ENROLL_DECAY', '1.0'))  # Multiply the old samples' weight by this on every update (1 = never age out)
+ENROLL_MAX_WEIGHT = float(os.environ.get('ENROLL_MAX_WEIGHT', '0'))  # Cap on the old samples' total weight (0 = no cap)
+FACE_CACHE_MAX_ENTRIES = int(os.environ.get('FACE_CACHE_MAX_ENTRIES', '256'))  # Repeated images remembered by content hash (0 = no cache)
+FACE_CACHE_MAX_MB = float(os.environ.get('FACE_CACHE_MAX_MB', '64'))  # Memory held by cached face crops and encodings
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'False').lower() == 'true'  # Per-stage timings and counters at /metrics (Prometheus)
+TEMPLATE_DTYPE = os.environ.get('TEMPLATE_DTYPE', 'float16')  # Payload of compact templates returned by /encode-faces
+TEMPLATE_SET_SIZE = int(os.environ.get('TEMPLATE_SET_SIZE', '1'))  # Templates per registration in 'template_set' (1 = mean only)
+ENCODER_DTYPE = os.environ.get('ENCODER_DTYPE', 'float64')  # 'float64' reproduces stored encodings bit-for-bit; 'float32' is faster, opt-in
+ENCODER_CV2_GRADIENTS = os.environ.get('ENCODER_CV2_GRADIENTS', 'False').lower() == 'true'  # cv2.cartToPolar for HOG
+ENCODER_TOLERANCE = float(os.environ.get('ENCODER_TOLERANCE', '0.01'))  # Max Euclidean drift from float64 encodings
+
+def load_encoder():
+    """
+    Configured encoder -> (encoder, deviation from float64 encodings).
+    A faster setting that drifts more than ENCODER_TOLERANCE would no longer match the
+    stored templates, so the service falls back to the exact float64 encoder instead.
+    """
+    global ENCODER_DTYPE, ENCODER_CV2_GRADIENTS
+    configured = FaceEncoder(IMAGE_SIZE, dtype=np.dtype(ENCODER_DTYPE), use_cv2_gradients=ENCODER_CV2_GRADIENTS)
+    if np.dtype(ENCODER_DTYPE) == np.float64 and not ENCODER_CV2_GRADIENTS:
+        return configured, 0.0
+    
+    reference = FaceEncoder(IMAGE_SIZE, dtype=np.float64)
+    probe = np.random.default_rng(0).integers(0, 256, size=(IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.uint8)
+    deviation = encoding_deviation(configured, reference, [probe])
+    if deviation > ENCODER_TOLERANCE:
+        print(f"[ERROR] Encoder {ENCODER_DTYPE} (cv2 gradients {'ON' if ENCODER_CV2_GRADIENTS else 'OFF'}) deviates "
+              f"{deviation:.5f} from float64 encodings (tolerance {ENCODER_TOLERANCE}), using float64")
+        ENCODER_DTYPE, ENCODER_CV2_GRADIENTS = 'float64', False
+        return reference, 0.0
+    return configured, deviation
 
-def decode_base64_image(base64_string):
-    """Decode base64 image to numpy array"""
+# Build the encoder once (Gabor bank + work buffers) and reuse it for every request
+encoder, encoder_deviation = load_encoder()
+def load_face_detector():
+    """Configured detector backend, falling back to the Haar cascade if it can't be loaded"""
+    options = {'yunet': {'model_path': FACE_DETECTOR_MODEL, 'score_threshold': FACE_DETECTOR_SCORE}}
     try:
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
+        return create_detector(FACE_DETECTOR, **options.get(FACE_DETECTOR, {}))
+    except (ValueError, RuntimeError) as e:
+        print(f"[WARNING] Face detector '{FACE_DETECTOR}' unavailable ({str(e)}), using haar")
+        return create_detector('haar')
+
+face_detector = load_face_detector()
+face_cache = FaceCache(FACE_CACHE_MAX_ENTRIES, int(FACE_CACHE_MAX_MB * 1024 * 1024))
+metrics = ServiceMetrics(METRICS_ENABLED)
+
+@app.before_request
+def start_request_metrics():
+    # Endpoint label is the route pattern, so /templates/<user_id> stays one series
+    if metrics.enabled and request.url_rule is not None and request.url_rule.rule != '/metrics':
+        g.metrics_endpoint = request.url_rule.rule
+        g.metrics_token = metrics.request_started(g.metrics_endpoint)
+
+@app.after_request
+def record_response_status(response):
+    if 'metrics_endpoint' in g:
+        g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # Teardown runs even when a handler raised, so the in-flight gauge always comes back down
+    if 'metrics_endpoint' in g:
+        metrics.request_finished(g.metrics_endpoint, g.get('metrics_status', 500), g.metrics_token)
+
+template_store = None
+gallery = None
+template_store_lock = threading.Lock()
+
+def get_template_store():
+    """Open (or create) the server-side template store on first use"""
+    global template_store
+    with template_store_lock:
+        if template_store is None:
+            template_store = TemplateStore(TEMPLATE_STORE_DIR, encoder.dimension)
+        return template_store
+
+def get_gallery():
+    """1:N search state over the template store, created on first use"""
+    global gallery
+    store = get_template_store()
+    with template_store_lock:
+        if gallery is None:
+            gallery = Gallery(store, IDENTIFY_IVF_MIN_SIZE, IDENTIFY_IVF_LISTS, IDENTIFY_IVF_PROBES)
+        return gallery
+
+def decode_image_bytes(image_bytes, gray=False):
+    """Decode JPEG/PNG bytes straight into an RGB (or grayscale) numpy array"""
+    with metrics.stage('decode'):
+        # np.frombuffer wraps the bytes without copying; imdecode writes the only full-size frame
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
         
-        image_data = base64.b64decode(base64_string)
-        image = Image.open(io.BytesIO(image_data))
+        if image is None:
+            # Formats OpenCV can't read still go through PIL
+            try:
+                image = Image.open(io.BytesIO(image_bytes))
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image = np.array(image)
+            except Exception as e:
+                metrics.reject('invalid_image')
+                raise ValueError(f"Failed to decode image: {str(e)}")
+            return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if gray else image
         
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        # OpenCV decodes to BGR: go straight to gray, or swap to RGB in place
+        if gray:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+def image_bytes(image):
+    """File bytes of an uploaded image: raw bytes as-is, a base64 string (or data URL) decoded"""
+    if isinstance(image, (bytes, bytearray)):
+        return image
+    try:
+        if ',' in image:
+            image = image.split(',')[1]
         
-        return np.array(image)
+        return base64.b64decode(image)
     except Exception as e:
         raise ValueError(f"Failed to decode image: {str(e)}")
 
+def decode_image(image, gray=False):
+    """Decode an uploaded image: raw bytes (multipart/binary body) or a base64 string (JSON)"""
+    return decode_image_bytes(image_bytes(image), gray)
+
+decode_base64_image = decode_image  # Original name, still imported by benchmark_pipeline.py
+
+def flag(data, name, default=False):
+    """Boolean request field: true/false in JSON, or a form field / query parameter such as exact=false or exact=1"""
+    value = data.get(name, default) if data else default
+    if isinstance(value, str):
+        return value.strip().lower() not in ('false', '0', 'no', 'off', '')
+    return bool(value)
+
+def cache_requested(data):
+    """Per-request opt-out of the image cache: "cache": false in JSON, cache=false as a form field or query parameter"""
+    return flag(data, 'cache', True)
+
+def get_request_data(list_fields=(), raw_field=None):
+    """
+    Request fields as a dict, however the client sent them:
+      - application/json: the parsed body, images as base64 strings (original contract)
+      - multipart/form-data: form fields, plus uploaded files as raw bytes
+        (a list for names in list_fields, e.g. several 'images' parts)
+      - image/* or application/octet-stream: the body bytes under raw_field,
+        other fields from the query string
+    """
+    if request.mimetype == 'multipart/form-data':
+        data = request.form.to_dict()
+        for name in request.files:
+            uploads = [upload.read() for upload in request.files.getlist(name)]
+            data[name] = uploads if name in list_fields else uploads[0]
+        return data
+    
+    if raw_field and (request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream'):
+        data = request.args.to_dict()
+        data[raw_field] = request.get_data()
+        return data
+    
+    return request.get_json()
+
+# Running totals for downscaled detection, reported on /health
+detection_stats = {'calls': 0, 'downscaled': 0, 'detect_ms': 0.0}
+detection_stats_lock = threading.Lock()
+
+def detect_faces(gray, min_neighbors=6):
+    """
+    Run the face detector on a copy of gray capped at DETECT_MAX_SIDE and map the boxes back.
+    
+    Returns (faces, info) where faces are (x, y, w, h) in full-resolution coordinates.
+    Off by default (DETECT_MAX_SIDE=0): boxes found on a downscaled copy differ by a few
+    pixels, which shifts the crops that stored templates were enrolled from.
+    benchmark_detectors.py --compare-full measures the speed-up and box agreement.
+    """
+    height, width = gray.shape[:2]
+    scale = 1.0
+    small = gray
+    if DETECT_MAX_SIDE > 0 and max(height, width) > DETECT_MAX_SIDE:
+        scale = DETECT_MAX_SIDE / max(height, width)
+        small = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    
+    min_size = (max(1, int(MIN_FACE_SIZE[0] * scale)), max(1, int(MIN_FACE_SIZE[1] * scale)))
+    start = time.perf_counter()
+    detections = face_detector.detect(small, min_neighbors=min_neighbors, min_size=min_size)
+    detect_ms = (time.perf_counter() - start) * 1000
+    metrics.observe_stage('detect', detect_ms / 1000)
+    
+    faces = [
+        (int(round(x / scale)), int(round(y / scale)), int(round(w / scale)), int(round(h / scale)))
+        for (x, y, w, h) in detections
+    ]
+    
+    with detection_stats_lock:
+        detection_stats['calls'] += 1
+        detection_stats['downscaled'] += scale < 1.0
+        detection_stats['detect_ms'] += detect_ms
+    
+    return faces, {
+        'scale': round(scale, 4),
+        'detect_ms': round(detect_ms, 2)
+    }
+
+# Last face box per /detect-face polling session
+face_tracker = FaceTracker(TRACK_MAX_SESSIONS, TRACK_TTL_SECONDS, TRACK_ROI_MARGIN, TRACK_FULL_SCAN_EVERY)
+
+def detect_faces_tracked(gray, session_id, min_neighbors=5):
+    """
+    detect_faces for a polling session: search around the session's last box first
+    and fall back to a full-frame scan when the face is lost (or a periodic full scan is due).
+    """
+    roi = face_tracker.roi_for(session_id, gray.shape)
+    faces, detection, roi_hit = [], None, None
+    
+    if roi is not None:
+        rx, ry, rw, rh = roi
+        faces, detection = detect_faces(gray[ry:ry+rh, rx:rx+rw], min_neighbors=min_neighbors)
+        faces = [(x + rx, y + ry, w, h) for (x, y, w, h) in faces]
+        roi_hit = len(faces) > 0
+    
+    mode = 'roi' if roi_hit else 'full'
+    if not roi_hit:
+        faces, detection = detect_faces(gray, min_neighbors=min_neighbors)
+    
+    # Track the largest face; losing it entirely clears the session box
+    largest = max(faces, key=lambda f: f[2] * f[3]) if faces else None
+    face_tracker.record(session_id, largest, mode, roi_hit)
+    
+    return faces, detection, {'session_id': session_id, 'mode': mode, 'roi_hit': roi_hit}
+
 def augment_image(face_img):
     """Create augmented versions of the face image for better training"""
     augmented = [face_img]  # Original
@@ -74,13 +326,28 @@ def augment_image(face_img):
     
     return augmented
 
-def detect_and_extract_face(image_array):
-    """Detect face and extract it from image with quality checks"""
+@dataclass
+class FaceFrame:
+    """One decoded image and everything derived from it, computed once and shared by later stages"""
+    image: np.ndarray                  # Full RGB frame
+    gray: np.ndarray                   # Full frame in grayscale (the only full-frame conversion)
+    faces: list = field(default_factory=list)  # Detector boxes (x, y, w, h), full-resolution coordinates
+    detection: dict = None             # Detection scale and timing from detect_faces
+    face_img: np.ndarray = None        # Padded face crop resized to IMAGE_SIZE (RGB)
+    face_gray: np.ndarray = None       # face_img in grayscale, ready for the encoder
+    error: str = None                  # Quality gate failure, if any
+    encoding: np.ndarray = None        # Encoding of face_gray, once something has computed it
+
+def preprocess_image(image_array):
+    """Convert to gray, detect and quality-check the face once, returning a FaceFrame"""
     gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=6, minSize=MIN_FACE_SIZE)
+    faces, detection = detect_faces(gray, min_neighbors=6)
+    frame = FaceFrame(image=image_array, gray=gray, faces=faces, detection=detection)
     
     if len(faces) == 0:
-        return None, "No face detected in the image"
+        metrics.reject('no_face')
+        frame.error = "No face detected in the image"
+        return frame
     
     # If multiple faces still detected after cropping, use the largest one
     if len(faces) > 1:
@@ -89,151 +356,195 @@ def detect_and_extract_face(image_array):
         print(f"  [INFO] Multiple faces detected, using largest face")
     
     # Extract the face region
-    x, y, w, h = faces[0]
-    
-    # Check face size quality
-    if w < MIN_FACE_SIZE[0] or h < MIN_FACE_SIZE[1]:
-        return None, "Face too small or too far from camera"
-    
-    # Add padding around face (10%)
-    padding = int(0.1 * min(w, h))
-    x = max(0, x - padding)
-    y = max(0, y - padding)
-    w = min(image_array.shape[1] - x, w + 2*padding)
-    h = min(image_array.shape[0] - y, h + 2*padding)
-    
-    face_img = image_array[y:y+h, x:x+w]
-    
-    # Check image sharpness (Laplacian variance) - lowered threshold
-    gray_face = cv2.cvtColor(face_img, cv2.COLOR_RGB2GRAY)
-    laplacian_var = cv2.Laplacian(gray_face, cv2.CV_64F).var()
-    if laplacian_var < 20:  # Lowered from 50 - less strict on blur
-        return None, "Image too blurry. Please ensure good lighting and focus"
+    frame.face_img, frame.face_gray, frame.error = crop_face(image_array, gray, faces[0])
+    return frame
+
+def crop_face(image_array, gray, box):
+    """Quality-check one detected box and crop it -> (face_img, face_gray, None) or (None, None, error)"""
+    with metrics.stage('quality'):
+        x, y, w, h = box
+        
+        # Check face size quality
+        if w < MIN_FACE_SIZE[0] or h < MIN_FACE_SIZE[1]:
+            metrics.reject('too_small')
+            return None, None, "Face too small or too far from camera"
+        
+        # Add padding around face (10%)
+        padding = int(0.1 * min(w, h))
+        x = max(0, x - padding)
+        y = max(0, y - padding)
+        w = min(image_array.shape[1] - x, w + 2*padding)
+        h = min(image_array.shape[0] - y, h + 2*padding)
+        
+        # Check image sharpness (Laplacian variance) - lowered threshold
+        # Gray conversion is per pixel, so the crop of the full-frame gray equals the gray of the crop
+        laplacian_var = cv2.Laplacian(gray[y:y+h, x:x+w], cv2.CV_64F).var()
+        if laplacian_var < 20:  # Lowered from 50 - less strict on blur
+            metrics.reject('blurry')
+            return None, None, "Image too blurry. Please ensure good lighting and focus"
+        
+        # Resize to standard size (cropped from the full-resolution frame; the RGB crop is
+        # resized first so encodings match registration)
+        face_img = cv2.resize(image_array[y:y+h, x:x+w], IMAGE_SIZE)
+        return face_img, cv2.cvtColor(face_img, cv2.COLOR_RGB2GRAY), None
+
+def load_frame(image, use_cache=True):
+    """
+    decode_image + preprocess_image for an uploaded image, through the content-hash cache.
     
-    # Resize to standard size
-    face_img = cv2.resize(face_img, IMAGE_SIZE)
+    A repeated image returns the cached frame, including its encoding once any
+    request has computed it (see frame_encoding). Cached frames keep only the
+    face crop, not the full-size image and gray frame.
+    """
+    data = image_bytes(image)
+    key = content_key(data, 'frame:') if use_cache and face_cache.enabled else None
+    if key:
+        cached = face_cache.get(key)
+        if cached is not None:
+            return cached
     
-    return face_img, None
+    frame = preprocess_image(decode_image_bytes(data))
+    if key:
+        frame = replace(frame, image=None, gray=None)
+        size = 256  # Detections, error text and object overhead
+        if frame.face_img is not None:
+            size += frame.face_img.nbytes + frame.face_gray.nbytes + encoder.dimension * 4
+        face_cache.put(key, frame, size)
+    return frame
+
+def frame_encoding(frame):
+    """Encoding of the frame's face, computed at most once per (cached) frame"""
+    if frame.encoding is None:
+        with metrics.stage('encode'):
+            frame.encoding = encoder.encode_gray(frame.face_gray)
+    return frame.encoding
+
+def detect_and_extract_face(image_array):
+    """Detect face and extract it from image with quality checks"""
+    frame = preprocess_image(image_array)
+    return frame.face_img, frame.error
 
 def create_face_encoding(face_img):
     """Create a robust face encoding using multiple advanced features"""
-    # Convert to grayscale
-    gray = cv2.cvtColor(face_img, cv2.COLOR_RGB2GRAY)
-    
-    # Apply histogram equalization for better contrast
-    gray = cv2.equalizeHist(gray)
-    
-    # 1. Multi-scale histogram (64 bins at different resolutions)
-    hist_full = cv2.calcHist([gray], [0], None, [64], [0, 256])
-    hist_full = hist_full.flatten() / (gray.shape[0] * gray.shape[1])
-    
-    # Quarter images for spatial awareness
-    h, w = gray.shape
-    h2, w2 = h//2, w//2
-    hist_tl = cv2.calcHist([gray[:h2, :w2]], [0], None, [32], [0, 256]).flatten()
-    hist_tr = cv2.calcHist([gray[:h2, w2:]], [0], None, [32], [0, 256]).flatten()
-    hist_bl = cv2.calcHist([gray[h2:, :w2]], [0], None, [32], [0, 256]).flatten()
-    hist_br = cv2.calcHist([gray[h2:, w2:]], [0], None, [32], [0, 256]).flatten()
-    hist_spatial = np.concatenate([hist_tl, hist_tr, hist_bl, hist_br])
-    hist_spatial = hist_spatial / (hist_spatial.sum() + 1e-7)
-    
-    # 2. Enhanced LBP with rotation invariance
-    def compute_lbp_uniform(img):
-        lbp = np.zeros_like(img)
-        for i in range(1, img.shape[0]-1):
-            for j in range(1, img.shape[1]-1):
-                center = img[i, j]
-                code = 0
-                code |= (img[i-1, j-1] >= center) << 7
-                code |= (img[i-1, j] >= center) << 6
-                code |= (img[i-1, j+1] >= center) << 5
-                code |= (img[i, j+1] >= center) << 4
-                code |= (img[i+1, j+1] >= center) << 3
-                code |= (img[i+1, j] >= center) << 2
-                code |= (img[i+1, j-1] >= center) << 1
-                code |= (img[i, j-1] >= center) << 0
-                lbp[i, j] = code
-        return lbp
-    
-    lbp = compute_lbp_uniform(gray)
-    lbp_hist = np.histogram(lbp, bins=64, range=(0, 256))[0]
-    lbp_hist = lbp_hist / (lbp_hist.sum() + 1e-7)
-    
-    # 3. Fine-grained grid features (16x16 grid - balanced detail)
-    grid_size = 16  # Reduced from 24 to 16 for better generalization
-    grid_h, grid_w = h // grid_size, w // grid_size
-    
-    grid_features = []
-    for i in range(grid_size):
-        for j in range(grid_size):
-            cell = gray[i*grid_h:(i+1)*grid_h, j*grid_w:(j+1)*grid_w]
-            if cell.size > 0:
-                grid_features.append(np.mean(cell) / 255.0)
-                grid_features.append(np.std(cell) / 255.0)
-                grid_features.append(np.median(cell) / 255.0)
-    
-    # 4. Gradient orientation histogram (HOG-like)
-    sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
-    sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-    magnitude = np.sqrt(sobelx**2 + sobely**2)
-    orientation = np.arctan2(sobely, sobelx)
-    
-    # Histogram of gradient orientations
-    orient_hist = np.histogram(orientation, bins=32, range=(-np.pi, np.pi), weights=magnitude)[0]
-    orient_hist = orient_hist / (orient_hist.sum() + 1e-7)
-    
-    # 5. Texture features using Gabor filters
-    gabor_features = []
-    for theta in [0, np.pi/4, np.pi/2, 3*np.pi/4]:
-        kernel = cv2.getGaborKernel((21, 21), 5, theta, 10, 0.5, 0, ktype=cv2.CV_32F)
-        filtered = cv2.filter2D(gray, cv2.CV_64F, kernel)
-        gabor_features.append(np.mean(np.abs(filtered)) / 255.0)
-        gabor_features.append(np.std(filtered) / 255.0)
-    
-    # 6. Downsampled raw pixels for direct comparison (20x20 = 400 features)
-    small_face = cv2.resize(gray, (20, 20))
-    pixel_features = small_face.flatten() / 255.0
-    
-    # Combine all features
-    encoding = np.concatenate([
-        hist_full,
-        hist_spatial,
-        lbp_hist,
-        np.array(grid_features),
-        orient_hist,
-        np.array(gabor_features),
-        pixel_features  # Add raw pixel data
-    ])
-    
-    # L2 normalization
-    norm = np.linalg.norm(encoding)
-    if norm > 1e-7:
-        encoding = encoding / norm
-    
-    return encoding
+    with metrics.stage('encode'):
+        return encoder.encode(face_img)
+
+def create_face_encodings(face_imgs):
+    """Encode a list of same-size face images in one batch, returns an (N, D) matrix"""
+    with metrics.stage('encode'):
+        return encoder.encode_batch(np.stack(face_imgs))
+
+def prepare_registration_image(image):
+    """Decode, detect and augment one registration image (base64 or bytes) -> (augmented faces, error)"""
+    try:
+        image_array = decode_image(image)
+        # Image already cropped to center oval on frontend
+        face_img, error = detect_and_extract_face(image_array)
+        
+        if error:
+            return None, error
+        
+        # Apply data augmentation - create 7 variations per image
+        with metrics.stage('augment'):
+            return augment_image(face_img), None
+    except Exception as e:
+        return None, str(e)
 
 def compare_encodings(encoding1, encoding2):
     """Compare two face encodings using multiple weighted metrics"""
-    # Split encoding into features and raw pixels
-    # Last 400 features are raw pixels (20x20)
-    features1, pixels1 = encoding1[:-400], encoding1[-400:]
-    features2, pixels2 = encoding2[:-400], encoding2[-400:]
-    
-    # 1. Feature cosine similarity
-    feature_sim = np.dot(features1, features2) / (np.linalg.norm(features1) * np.linalg.norm(features2) + 1e-7)
+    with metrics.stage('compare'):
+        # Split encoding into features and raw pixels
+        # Last 400 features are raw pixels (20x20)
+        features1, pixels1 = encoding1[:-400], encoding1[-400:]
+        features2, pixels2 = encoding2[:-400], encoding2[-400:]
+        
+        # 1. Feature cosine similarity
+        feature_sim = np.dot(features1, features2) / (np.linalg.norm(features1) * np.linalg.norm(features2) + 1e-7)
+        
+        # 2. Pixel cosine similarity (direct face comparison)
+        pixel_sim = np.dot(pixels1, pixels2) / (np.linalg.norm(pixels1) * np.linalg.norm(pixels2) + 1e-7)
+        
+        # 3. Overall Euclidean distance
+        euclidean_dist = np.linalg.norm(encoding1 - encoding2)
+        
+        # Weighted combined similarity (60% features, 40% pixels)
+        combined_sim = 0.6 * feature_sim + 0.4 * pixel_sim
+        
+        return float(combined_sim), float(euclidean_dist), float(pixel_sim)
+
+def verify_staged(stored_encoding, face_gray, current_encoding=None):
+    """
+    Cheapest-first verification of one face crop against a stored encoding.
     
-    # 2. Pixel cosine similarity (direct face comparison)
-    pixel_sim = np.dot(pixels1, pixels2) / (np.linalg.norm(pixels1) * np.linalg.norm(pixels2) + 1e-7)
+    Stage 1 ('pixel_block') compares only the raw 20x20 block. Cosine similarity
+    ignores scale, so it equals the pixel similarity compare_encodings would
+    compute (the full path only differs by float rounding and its 1e-7
+    denominator term, which can only lower the score). A face clearly below
+    MIN_PIXEL_SIMILARITY would fail the triple check anyway, so it is rejected
+    without the full encoding. Stage 2 ('full_encoding') is the original
+    triple validation. Decisions match running stage 2 alone.
     
-    # 3. Overall Euclidean distance
-    euclidean_dist = np.linalg.norm(encoding1 - encoding2)
+    A (k, D) template set matches if any of its templates passes; the early
+    reject then needs every template below the pixel threshold.
     
-    # Weighted combined similarity (60% features, 40% pixels)
-    combined_sim = 0.6 * feature_sim + 0.4 * pixel_sim
+    An already known current_encoding (e.g. cached) goes straight to stage 2.
+    The result carries the encoding under 'encoding' (None after an early reject).
+    """
+    if VERIFY_EARLY_REJECT and current_encoding is None:
+        with metrics.stage('compare'):
+            stored_pixels = np.atleast_2d(np.asarray(stored_encoding, dtype=np.float64))[:, -400:]
+            pixels = encoder.pixel_block(face_gray).astype(np.float64)
+            stored_norms, pixel_norm = np.linalg.norm(stored_pixels, axis=1), np.linalg.norm(pixels)
+            # Degenerate (near-empty) blocks skip the shortcut rather than lean on the epsilon term
+            if stored_norms.min() > 1e-3 and pixel_norm > 0:
+                pixel_sim = float(np.max(stored_pixels @ pixels / (stored_norms * pixel_norm + 1e-7)))
+                if pixel_sim < MIN_PIXEL_SIMILARITY - VERIFY_EARLY_REJECT_MARGIN:
+                    return {
+                        'match': False,
+                        'decided_by': 'pixel_block',
+                        'combined_sim': None,
+                        'euclidean_dist': None,
+                        'pixel_sim': pixel_sim,
+                        'encoding': None
+                    }
     
-    return float(combined_sim), float(euclidean_dist), float(pixel_sim)
+    if current_encoding is None:
+        with metrics.stage('encode'):
+            current_encoding = encoder.encode_gray(face_gray)
+    if np.ndim(stored_encoding) == 2:
+        return {**verify_template_set(stored_encoding, current_encoding), 'encoding': current_encoding}
+    combined_sim, euclidean_dist, pixel_sim = compare_encodings(stored_encoding, current_encoding)
     
-    return float(cosine_sim), float(euclidean_dist)
+    # ALL THREE conditions must pass for a match
+    match = (
+        (combined_sim >= TOLERANCE) and 
+        (euclidean_dist <= MAX_DISTANCE) and 
+        (pixel_sim >= MIN_PIXEL_SIMILARITY)
+    )
+    return {
+        'match': bool(match),
+        'decided_by': 'full_encoding',
+        'combined_sim': combined_sim,
+        'euclidean_dist': euclidean_dist,
+        'pixel_sim': pixel_sim,
+        'encoding': current_encoding
+    }
+
+def verify_template_set(templates, current_encoding):
+    """Full-encoding stage for a template set: max-pool over templates, reporting the best one"""
+    with metrics.stage('compare'):
+        combined, distance, pixel = score_template_set(templates, current_encoding)
+    passing = (combined >= TOLERANCE) & (distance <= MAX_DISTANCE) & (pixel >= MIN_PIXEL_SIMILARITY)
+    # Best passing template if any, otherwise the closest miss
+    best = int(np.argmax(np.where(passing, combined, -np.inf)))
+    return {
+        'match': bool(passing[best]),
+        'decided_by': 'full_encoding',
+        'combined_sim': float(combined[best]),
+        'euclidean_dist': float(distance[best]),
+        'pixel_sim': float(pixel[best]),
+        'template_index': best
+    }
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -242,98 +553,343 @@ def health_check():
         'status': 'healthy',
         'service': 'face_recognition_simple',
         'version': '1.0.0',
-        'backend': 'opencv'
+        'backend': 'opencv',
+        'encoder': {
+            'dtype': ENCODER_DTYPE,
+            'cv2_gradients': ENCODER_CV2_GRADIENTS,
+            'deviation': encoder_deviation,
+            'dimension': encoder.dimension
+        },
+        'detection': {
+            'backend': face_detector.name,
+            'max_side': DETECT_MAX_SIDE,
+            'calls': detection_stats['calls'],
+            'downscaled': detection_stats['downscaled'],
+            'total_detect_ms': round(detection_stats['detect_ms'], 1)
+        },
+        'registration_jobs': registration_jobs.stats() if registration_jobs is not None else None,
+        'cache': face_cache.stats()
     }), 200
 
-@app.route('/encode-faces', methods=['POST'])
-def encode_faces():
+def validate_registration_request(data):
+    """Images from an /encode-faces style request -> (images, None) or (None, (error body, HTTP status))"""
+    if not data or 'images' not in data:
+        print(f"[ERROR] No images provided in request")
+        return None, ({
+            'success': False,
+            'error': 'No images provided'
+        }, 400)
+    
+    images = data['images']
+    
+    if not isinstance(images, list) or len(images) == 0:
+        print(f"[ERROR] Images not a list or empty")
+        return None, ({
+            'success': False,
+            'error': 'Images must be a non-empty array'
+        }, 400)
+    
+    print(f"[INFO] Received {len(images)} images for encoding")
+    
+    if len(images) < 5:
+        print(f"[ERROR] Only {len(images)} images provided (minimum 5)")
+        return None, ({
+            'success': False,
+            'error': 'Please provide at least 5 images for better accuracy'
+        }, 400)
+    
+    return images, None
+
+def parse_number(data, name, default, kind=float, low=None, high=None, above=None):
     """
-    Encode multiple face images during registration.
+    Numeric request field (or default) -> (value, None) or (None, (error body, HTTP status)).
+    low/high are inclusive bounds, above an exclusive lower bound; int fields must be whole numbers.
     """
+    value = data.get(name, default)
     try:
-        data = request.get_json()
-        
-        if not data or 'images' not in data:
-            print(f"[ERROR] No images provided in request")
-            return jsonify({
-                'success': False,
-                'error': 'No images provided'
-            }), 400
+        if isinstance(value, bool) or (kind is int and isinstance(value, float) and not value.is_integer()):
+            raise ValueError(name)
+        value = kind(value)
+        valid = ((low is None or value >= low) and (high is None or value <= high) and
+                 (above is None or value > above) and value == value)  # NaN fails every comparison
+    except (TypeError, ValueError, OverflowError):
+        valid = False
+    
+    if not valid:
+        if low is not None and high is not None:
+            requirement = f'between {low} and {high}'
+        else:
+            bounds = [f'greater than {above}' if above is not None else None,
+                      f'at least {low}' if low is not None else None,
+                      f'at most {high}' if high is not None else None]
+            requirement = ' and '.join(bound for bound in bounds if bound)
+        return None, ({
+            'success': False,
+            'error': f"{name} must be {'an integer' if kind is int else 'a number'}{' ' + requirement if requirement else ''}"
+        }, 400)
+    return value, None
+
+def prepare_faces(images, report):
+    """
+    Detect, check and augment every image -> (augmented face batch, valid image count, per-image errors, originals).
+    originals holds (image number, batch index of its unaugmented crop) for every valid image.
+    """
+    face_batch = []
+    processed_count = 0
+    errors = []
+    originals = []
+    
+    report('preparing', 0, len(images))
+    # Images are independent until the final average, so fan them out when a pool is configured
+    if registration_pool.enabled():
+        prepared = registration_pool.prepare_images(images)
+    else:
+        prepared = []
+        for image in images:
+            prepared.append(prepare_registration_image(image))
+            report('preparing', len(prepared), len(images))
+    
+    for idx, (augmented_images, error) in enumerate(prepared):
+        if error:
+            print(f"  [ERROR] Image {idx + 1}: {error}")
+            errors.append(f"Image {idx + 1}: {error}")
+            continue
         
-        images = data['images']
+        originals.append((idx + 1, len(face_batch)))
+        face_batch.extend(augmented_images)
+        processed_count += 1
+        print(f"  [OK] Image {idx + 1}: Processed ({len(augmented_images)} augmented samples)")
+    
+    print(f"\n[STATS] Processing complete: {processed_count}/{len(images)} images valid")
+    print(f"   Total augmented samples: {len(face_batch)}")
+    return face_batch, processed_count, errors, originals
+
+def encode_face_batch(face_batch):
+    """Encode every augmented sample of every image in a single batch (split across workers if enabled)"""
+    if registration_pool.enabled():
+        with metrics.stage('encode'):
+            return registration_pool.encode_faces(face_batch)
+    return create_face_encodings(face_batch)
+
+def run_registration(images, user_id=None, progress=None, template_set_size=None):
+    """
+    Registration pipeline shared by /encode-faces and registration jobs -> (response body, HTTP status).
+    progress(stage, processed, total) is called as work completes, if given.
+    template_set_size > 1 also returns a multi-template 'template_set' (default TEMPLATE_SET_SIZE).
+    """
+    report = progress or (lambda stage, processed, total: None)
+    face_batch, processed_count, errors, _ = prepare_faces(images, report)
+    
+    if processed_count < 3:
+        print(f"[ERROR] Only {processed_count} valid images (minimum 3 required)")
+        return {
+            'success': False,
+            'error': 'Not enough valid face images (minimum 3 required)',
+            'details': errors,
+            'images_processed': processed_count
+        }, 400
+    
+    report('encoding', len(images), len(images))
+    encodings = encode_face_batch(face_batch)
+    
+    # Average the encodings (now includes augmented versions)
+    avg_encoding = np.mean(encodings, axis=0)
+    
+    print(f"[SUCCESS] Encoding complete: {len(encodings)} samples averaged")
+    
+    # Keep the template server-side too when the caller tells us whose it is
+    stored = False
+    if user_id is not None:
+        get_template_store().put(user_id, avg_encoding, weight=len(encodings))
+        stored = True
+        print(f"[INFO] Template stored for user {user_id}")
+    
+    body = {
+        'success': True,
+        'encoding': avg_encoding.tolist(),
+        'template': template_to_text(avg_encoding, TEMPLATE_DTYPE),
+        'stored': stored,
+        'images_processed': processed_count,
+        'augmented_samples': len(encodings),  # Total including augmentations
+        'total_images': len(images),
+        'warnings': errors if errors else None
+    }
+    
+    # Optional multi-template set (client-held; the server-side store keeps the mean)
+    k = TEMPLATE_SET_SIZE if template_set_size is None else template_set_size
+    if k > 1:
+        template_set = build_template_set(encodings, k)
+        body['template_set'] = template_to_text(template_set, TEMPLATE_DTYPE)
+        body['template_set_size'] = len(template_set)
+        print(f"[INFO] Template set built: {len(template_set)} templates")
+    
+    return body, 200
+
+@app.route('/enroll-update', methods=['POST'])
+def enroll_update():
+    """
+    Fold new images into an existing template without reprocessing the original ones.
+    
+    The template is a running mean: the server-side template (user_id) keeps its
+    sample count in the store; a client-held template (stored_encoding) sends its
+    count as sample_count. Optional decay/max_weight age out older samples.
+    Every new face must verify against the current template first, so an update
+    can't move a template towards someone else's face; new users go through
+    /encode-faces.
+    """
+    try:
+        data = get_request_data(list_fields=('images',))
         
-        if not isinstance(images, list) or len(images) == 0:
-            print(f"[ERROR] Images not a list or empty")
+        if not data or not isinstance(data.get('images'), list) or not data['images'] \
+                or ('stored_encoding' not in data and 'user_id' not in data):
             return jsonify({
                 'success': False,
-                'error': 'Images must be a non-empty array'
+                'error': 'Missing required fields: images and user_id (or stored_encoding)'
             }), 400
         
-        print(f"[INFO] Received {len(images)} images for encoding")
+        decay, invalid = parse_number(data, 'decay', ENROLL_DECAY, above=0, high=1)
+        if not invalid:
+            max_weight, invalid = parse_number(data, 'max_weight', ENROLL_MAX_WEIGHT, low=0)
+        if invalid:
+            return jsonify(invalid[0]), invalid[1]
+        
+        # Load the client-held template before paying for any image work
+        if 'stored_encoding' in data:
+            try:
+                current = load_template(data['stored_encoding'], encoder.dimension)
+            except ValueError as e:
+                return jsonify({
+                    'success': False,
+                    'error': f"Invalid stored_encoding: {str(e)}"
+                }), 400
+            if current.ndim != 1:
+                return jsonify({
+                    'success': False,
+                    'error': 'Template sets cannot be updated incrementally; register again instead'
+                }), 400
+            weight, invalid = parse_number(data, 'sample_count', ENROLL_DEFAULT_WEIGHT, above=0)
+            if invalid:
+                return jsonify(invalid[0]), invalid[1]
+        else:
+            current = get_template_store().get(data['user_id'])
+            if current is None:
+                return jsonify({
+                    'success': False,
+                    'error': f"No stored template for user {data['user_id']}; register with /encode-faces first"
+                }), 404
         
-        if len(images) < 5:
-            print(f"[ERROR] Only {len(images)} images provided (minimum 5)")
+        images = data['images']
+        face_batch, processed_count, errors, originals = prepare_faces(images, lambda stage, processed, total: None)
+        if processed_count == 0:
             return jsonify({
                 'success': False,
-                'error': 'Please provide at least 5 images for better accuracy'
+                'error': 'No valid face images',
+                'details': errors,
+                'images_processed': 0
             }), 400
         
-        encodings = []
-        processed_count = 0
-        errors = []
+        encodings = encode_face_batch(face_batch)
         
-        for idx, img_base64 in enumerate(images):
-            try:
-                image_array = decode_base64_image(img_base64)
-                # Image already cropped to center oval on frontend
-                face_img, error = detect_and_extract_face(image_array)
-                
-                if error:
-                    print(f"  [ERROR] Image {idx + 1}: {error}")
-                    errors.append(f"Image {idx + 1}: {error}")
-                    continue
-                
-                # Apply data augmentation - create 7 variations per image
-                augmented_images = augment_image(face_img)
-                
-                # Create encodings for all augmented versions
-                for aug_img in augmented_images:
-                    encoding = create_face_encoding(aug_img)
-                    encodings.append(encoding)
-                
-                processed_count += 1
-                print(f"  [OK] Image {idx + 1}: Processed ({len(augmented_images)} augmented samples)")
-                
-            except Exception as e:
-                print(f"  [ERROR] Image {idx + 1}: Exception - {str(e)}")
-                errors.append(f"Image {idx + 1}: {str(e)}")
-        
-        print(f"\n[STATS] Processing complete: {processed_count}/{len(images)} images valid")
-        print(f"   Total augmented samples: {len(encodings)}")
-        
-        if processed_count < 3:
-            print(f"[ERROR] Only {processed_count} valid images (minimum 3 required)")
+        # Same triple validation as a login, on each image's unaugmented crop
+        mismatched = []
+        for number, offset in originals:
+            result = verify_staged(current, None, encodings[offset])
+            if not result['match']:
+                mismatched.append({
+                    'image': number,
+                    'similarity': round(result['combined_sim'], 4),
+                    'distance': round(result['euclidean_dist'], 4),
+                    'pixel_similarity': round(result['pixel_sim'], 4)
+                })
+        if mismatched:
+            print(f"[WARNING] Enrollment update rejected: {len(mismatched)}/{processed_count} images don't match the template")
             return jsonify({
                 'success': False,
-                'error': 'Not enough valid face images (minimum 3 required)',
-                'details': errors,
+                'error': 'New images do not match the enrolled face',
+                'mismatched': mismatched,
                 'images_processed': processed_count
-            }), 400
+            }), 403
         
-        # Average the encodings (now includes augmented versions)
-        avg_encoding = np.mean(encodings, axis=0)
+        sample_sum = np.sum(encodings, axis=0, dtype=np.float64)
         
-        print(f"[SUCCESS] Encoding complete: {len(encodings)} samples averaged")
+        if 'stored_encoding' in data:
+            new_encoding, new_weight = fold_mean(current, weight, sample_sum, len(encodings), decay, max_weight)
+            stored = False
+        else:
+            folded = get_template_store().fold(
+                data['user_id'], sample_sum, len(encodings), decay, max_weight, default_weight=ENROLL_DEFAULT_WEIGHT
+            )
+            if folded is None:
+                return jsonify({
+                    'success': False,
+                    'error': f"No stored template for user {data['user_id']}"
+                }), 404
+            new_encoding, new_weight = folded
+            stored = True
+        
+        print(f"[SUCCESS] Enrollment updated: +{len(encodings)} samples, weight now {new_weight:g}")
         
         return jsonify({
             'success': True,
-            'encoding': avg_encoding.tolist(),
+            'encoding': np.asarray(new_encoding).tolist(),
+            'template': template_to_text(new_encoding, TEMPLATE_DTYPE),
+            'stored': stored,
+            'sample_count': new_weight,
             'images_processed': processed_count,
-            'augmented_samples': len(encodings),  # Total including augmentations
-            'total_images': len(images),
+            'added_samples': len(encodings),
             'warnings': errors if errors else None
         }), 200
         
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+registration_jobs = None
+registration_jobs_lock = threading.Lock()
+
+def get_registration_jobs():
+    """Open (or create) the registration job database on first use; start_background_workers starts its threads"""
+    global registration_jobs
+    with registration_jobs_lock:
+        if registration_jobs is None:
+            registration_jobs = RegistrationJobs(
+                REGISTRATION_JOB_DB, run_registration, workers=REGISTRATION_JOB_WORKERS,
+                max_queued=REGISTRATION_JOB_MAX_QUEUED, stale_seconds=REGISTRATION_JOB_STALE_SECONDS,
+                ttl_seconds=REGISTRATION_JOB_TTL_SECONDS
+            )
+        return registration_jobs
+
+# State owned by other components, read when /metrics is scraped
+metrics.collect('face_cache_lookups_total', 'counter', 'Image cache lookups by result',
+                lambda: {('hit',): face_cache.hits, ('miss',): face_cache.misses}, ('result',))
+metrics.collect('face_cache_bytes', 'gauge', 'Memory held by cached frames',
+                lambda: {(): face_cache.stats()['bytes']})
+metrics.collect('face_registration_jobs', 'gauge', 'Registration jobs by status',
+                lambda: {(status,): count for status, count in registration_jobs.stats()['jobs'].items()}
+                if registration_jobs is not None else {}, ('status',))
+
+@app.route('/encode-faces', methods=['POST'])
+def encode_faces():
+    """
+    Encode multiple face images during registration.
+    Accepts JSON (base64 images) or multipart/form-data with one 'images' part per file.
+    """
+    try:
+        data = get_request_data(list_fields=('images',))
+        
+        images, invalid = validate_registration_request(data)
+        if invalid:
+            return jsonify(invalid[0]), invalid[1]
+        
+        template_set_size, invalid = parse_number(data, 'template_set_size', TEMPLATE_SET_SIZE, int, 1, 255)
+        if invalid:
+            return jsonify(invalid[0]), invalid[1]
+        
+        body, status = run_registration(images, data.get('user_id'), template_set_size=template_set_size)
+        return jsonify(body), status
+        
     except Exception as e:
         print(f"[ERROR] Exception in encode_faces: {str(e)}")
         import traceback
@@ -343,69 +899,429 @@ def encode_faces():
             'error': str(e)
         }), 500
 
+@app.route('/registration-jobs', methods=['POST'])
+def submit_registration_job():
+    """
+    Queue an /encode-faces registration and return its job id immediately.
+    Same body as /encode-faces; poll GET /registration-jobs/<job_id> for the result.
+    """
+    try:
+        data = get_request_data(list_fields=('images',))
+        
+        images, invalid = validate_registration_request(data)
+        if invalid:
+            return jsonify(invalid[0]), invalid[1]
+        
+        template_set_size, invalid = parse_number(data, 'template_set_size', TEMPLATE_SET_SIZE, int, 1, 255)
+        if invalid:
+            return jsonify(invalid[0]), invalid[1]
+        
+        try:
+            job_id, position = get_registration_jobs().submit(images, data.get('user_id'), template_set_size)
+        except QueueFull as e:
+            response = jsonify({
+                'success': False,
+                'error': str(e)
+            })
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        
+        print(f"[INFO] Registration job {job_id} queued (position {position})")
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'queued',
+            'queue_position': position,
+            'status_url': f'/registration-jobs/{job_id}'
+        }), 202
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/registration-jobs/<job_id>', methods=['GET'])
+def registration_job_status(job_id):
+    """Progress of a registration job; 'result' holds the /encode-faces response once finished"""
+    try:
+        job = get_registration_jobs().get(job_id)
+        if job is None:
+            return jsonify({
+                'success': False,
+                'error': 'Unknown or expired job id'
+            }), 404
+        return jsonify({'success': True, **job}), 200
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def score_frame(image, stored_encoding, use_cache=True):
+    """Decode, detect and verify one frame -> verify_staged() result, or {'error': ...} for unusable frames"""
+    # Decode, convert and detect once (or not at all for a repeated image); every later stage reuses this frame
+    frame = load_frame(image, use_cache)
+    
+    # Reject if multiple faces detected during verification (strict mode)
+    if len(frame.faces) > 1:
+        metrics.reject('multiple_faces')
+        print(f"[WARNING] Verification rejected: {len(frame.faces)} faces detected")
+        return {
+            'error': f'Multiple faces detected ({len(frame.faces)} people). Please ensure only you are visible in the frame.',
+            'face_count': len(frame.faces)
+        }
+    
+    if frame.error:
+        return {'error': frame.error}
+    
+    # Compare faces using TRIPLE validation, cheapest stage first
+    result = verify_staged(stored_encoding, frame.face_gray, frame.encoding)
+    encoding = result.pop('encoding')
+    if frame.encoding is None:
+        frame.encoding = encoding  # Kept with the cached frame for the next request
+    return result
+
+def format_scores(result):
+    """Rounded response fields for a verify_staged() result"""
+    # Early rejects never compute the full encoding, so only the pixel score is known
+    full = result['decided_by'] == 'full_encoding'
+    
+    return {
+        'match': result['match'],
+        'decided_by': result['decided_by'],
+        # Convert similarity to confidence percentage
+        'confidence': round(float(min(100, max(0, result['combined_sim'] * 100))), 2) if full else None,
+        'distance': round(float(result['euclidean_dist']), 4) if full else None,
+        'similarity': round(float(result['combined_sim']), 4) if full else None,
+        'pixel_similarity': round(float(result['pixel_sim']), 4),
+        # Which template of a template set scored best (None for a single template)
+        'template_index': result.get('template_index')
+    }
+
+burst_executor = None
+burst_executor_lock = threading.Lock()
+
+def get_burst_executor():
+    """Thread pool for burst frames (OpenCV and NumPy release the GIL for the heavy parts)"""
+    global burst_executor
+    with burst_executor_lock:
+        if burst_executor is None:
+            burst_executor = ThreadPoolExecutor(max_workers=VERIFY_BURST_THREADS, thread_name_prefix='verify-burst')
+        return burst_executor
+
+def verify_burst(images, stored_encoding, use_cache=True):
+    """
+    Score a burst of frames, VERIFY_BURST_THREADS at a time, in frame order.
+    
+    Stops at the first frame that passes all three thresholds or when the time
+    budget runs out; frames never started are reported as 'skipped', frames
+    cut off by the budget as 'unfinished'. Returns the response body.
+    """
+    started = time.perf_counter()
+    deadline = started + VERIFY_BURST_BUDGET_MS / 1000.0
+    received = len(images)
+    images = images[:VERIFY_BURST_MAX_FRAMES]
+    executor = get_burst_executor()
+    
+    def timed(index):
+        frame_start = time.perf_counter()
+        try:
+            result = score_frame(images[index], stored_encoding, use_cache)
+        except Exception as e:
+            result = {'error': str(e)}
+        result['ms'] = round((time.perf_counter() - frame_start) * 1000, 1)
+        return result
+    
+    results = {}
+    pending = {}
+    next_index = 0
+    matched = None
+    budget_exhausted = False
+    
+    # Keep only as many frames in flight as there are threads, so an early match saves the rest
+    while matched is None:
+        while next_index < len(images) and len(pending) < VERIFY_BURST_THREADS:
+            # Run in a copy of this request's context so stage timings keep its endpoint label
+            pending[executor.submit(contextvars.copy_context().run, timed, next_index)] = next_index
+            next_index += 1
+        if not pending:
+            break
+        
+        remaining = deadline - time.perf_counter()
+        done, _ = wait(pending, timeout=max(0, remaining), return_when=FIRST_COMPLETED)
+        if not done:
+            budget_exhausted = True
+            break
+        
+        for future in done:
+            index = pending.pop(future)
+            results[index] = future.result()
+            if results[index].get('match') and (matched is None or index < matched):
+                matched = index
+    
+    # Frames still running past an early exit or the budget finish in the background; their results are dropped
+    for future in pending:
+        future.cancel()
+    unfinished = set(pending.values())
+    
+    frames = []
+    for index in range(len(images)):
+        if index not in results:
+            frames.append({'frame': index, 'status': 'unfinished' if index in unfinished else 'skipped'})
+        elif 'error' in results[index]:
+            frames.append({'frame': index, 'status': 'error', **results[index]})
+        else:
+            frames.append({'frame': index, 'status': 'scored', 'ms': results[index]['ms'], **format_scores(results[index])})
+    
+    # Headline scores come from the matching frame, otherwise from the best scored frame
+    scored = [results[i] for i in sorted(results) if 'error' not in results[i]]
+    best = results[matched] if matched is not None else max(
+        scored, key=lambda r: (r['combined_sim'] is not None, r['combined_sim'] or 0, r['pixel_sim']), default=None
+    )
+    headline = format_scores(best) if best else {
+        'match': False, 'decided_by': None, 'confidence': None, 'distance': None, 'similarity': None, 'pixel_similarity': None
+    }
+    
+    print(f"[INFO] Burst verify: {len(results)}/{len(images)} frames scored, "
+          f"match={'frame ' + str(matched) if matched is not None else 'none'}, "
+          f"{(time.perf_counter() - started) * 1000:.0f} ms{' (budget exhausted)' if budget_exhausted else ''}")
+    
+    return {
+        'success': True,
+        **headline,
+        'matched_frame': matched,
+        'frames_received': received,
+        'frames_scored': len(results),
+        'budget_exhausted': budget_exhausted,
+        'frames': frames,
+        'threshold': {
+            'min_similarity': TOLERANCE,
+            'max_distance': MAX_DISTANCE,
+            'min_pixel_similarity': MIN_PIXEL_SIMILARITY
+        }
+    }
+
 @app.route('/verify-face', methods=['POST'])
 def verify_face():
     """
     Verify a face against stored encoding.
+    Accepts JSON, multipart/form-data or a raw image body (other fields in the query string).
+    Send 'images' (a short burst of frames) instead of 'image' to pass on the first good frame.
     """
     try:
-        data = request.get_json()
+        data = get_request_data(list_fields=('images',), raw_field='image')
         
-        if not data or 'image' not in data or 'stored_encoding' not in data:
+        has_images = data and ('image' in data or isinstance(data.get('images'), list) and data['images'])
+        if not has_images or ('stored_encoding' not in data and 'user_id' not in data):
             return jsonify({
                 'success': False,
-                'error': 'Missing required fields: image and stored_encoding'
+                'error': 'Missing required fields: image (or images) and stored_encoding (or user_id)'
             }), 400
         
-        # Decode and check for multiple faces first
-        image_array = decode_base64_image(data['image'])
-        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
-        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=6, minSize=MIN_FACE_SIZE)
+        # Get stored encoding (from the request, or straight from the memory-mapped store)
+        if 'stored_encoding' in data:
+            # Legacy JSON array or compact template (base64 text or raw bytes)
+            try:
+                stored_encoding = load_template(data['stored_encoding'], encoder.dimension)
+            except ValueError as e:
+                return jsonify({
+                    'success': False,
+                    'error': f"Invalid stored_encoding: {str(e)}"
+                }), 400
+        else:
+            stored_encoding = get_template_store().get(data['user_id'])
+            if stored_encoding is None:
+                return jsonify({
+                    'success': False,
+                    'error': f"No stored template for user {data['user_id']}"
+                }), 404
+        
+        if 'image' not in data:
+            return jsonify(verify_burst(data['images'], stored_encoding, cache_requested(data))), 200
         
-        # Reject if multiple faces detected during verification (strict mode)
-        if len(faces) > 1:
-            print(f"[WARNING] Verification rejected: {len(faces)} faces detected")
+        result = score_frame(data['image'], stored_encoding, cache_requested(data))
+        if 'error' in result:
             return jsonify({
                 'success': False,
-                'error': f'Multiple faces detected ({len(faces)} people). Please ensure only you are visible in the frame.',
-                'face_count': len(faces)
+                **result
             }), 400
         
-        # Process the image (verification still strict - must be alone)
-        face_img, error = detect_and_extract_face(image_array)
+        return jsonify({
+            'success': True,
+            **format_scores(result),
+            'threshold': {
+                'min_similarity': TOLERANCE,
+                'max_distance': MAX_DISTANCE,
+                'min_pixel_similarity': MIN_PIXEL_SIMILARITY
+            }
+        }), 200
         
-        if error:
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/identify-face', methods=['POST'])
+def identify_face():
+    """
+    Identify a face against every enrolled template (1:N, no user id needed).
+    Accepts the same JSON, multipart or raw image bodies as /verify-face.
+    """
+    try:
+        data = get_request_data(raw_field='image')
+        
+        if not data or 'image' not in data:
             return jsonify({
                 'success': False,
-                'error': error
+                'error': 'Missing required field: image'
             }), 400
         
-        # Create encoding
-        current_encoding = create_face_encoding(face_img)
+        top_k, invalid = parse_number(data, 'top_k', IDENTIFY_TOP_K, int, low=1)
+        if invalid:
+            return jsonify(invalid[0]), invalid[1]
         
-        # Get stored encoding
-        stored_encoding = np.array(data['stored_encoding'])
+        frame = load_frame(data['image'], cache_requested(data))
         
-        # Compare faces using TRIPLE validation
-        combined_sim, euclidean_dist, pixel_sim = compare_encodings(stored_encoding, current_encoding)
+        # Same strict single-face rule as /verify-face
+        if len(frame.faces) > 1:
+            metrics.reject('multiple_faces')
+            print(f"[WARNING] Identification rejected: {len(frame.faces)} faces detected")
+            return jsonify({
+                'success': False,
+                'error': f'Multiple faces detected ({len(frame.faces)} people). Please ensure only you are visible in the frame.',
+                'face_count': len(frame.faces)
+            }), 400
         
-        # ALL THREE conditions must pass for a match
-        match = (
-            (combined_sim >= TOLERANCE) and 
-            (euclidean_dist <= MAX_DISTANCE) and 
-            (pixel_sim >= MIN_PIXEL_SIMILARITY)
-        )
+        if frame.error:
+            return jsonify({
+                'success': False,
+                'error': frame.error
+            }), 400
         
-        # Convert similarity to confidence percentage
-        confidence = min(100, max(0, combined_sim * 100))
+        current_encoding = frame_encoding(frame)
+        
+        # Score against the whole gallery; only candidates passing all three thresholds come back
+        with metrics.stage('search'):
+            candidates, search = get_gallery().search(
+                current_encoding, top_k, TOLERANCE, MAX_DISTANCE, MIN_PIXEL_SIMILARITY,
+                exact=flag(data, 'exact')
+            )
+        for candidate in candidates:
+            candidate['confidence'] = round(min(100, max(0, candidate['similarity'] * 100)), 2)
+            candidate['similarity'] = round(candidate['similarity'], 4)
+            candidate['distance'] = round(candidate['distance'], 4)
+            candidate['pixel_similarity'] = round(candidate['pixel_similarity'], 4)
+        
+        print(f"[INFO] Identify: {len(candidates)} candidate(s) from {search['scanned']}/{search['gallery_size']} templates "
+              f"({search['mode']}, {search['search_ms']} ms)")
         
         return jsonify({
             'success': True,
-            'match': bool(match),
-            'confidence': round(float(confidence), 2),
-            'distance': round(float(euclidean_dist), 4),
-            'similarity': round(float(combined_sim), 4),
-            'pixel_similarity': round(float(pixel_sim), 4),
+            'match': bool(candidates),
+            'user_id': candidates[0]['user_id'] if candidates else None,
+            'candidates': candidates,
+            'search': search,
+            'threshold': {
+                'min_similarity': TOLERANCE,
+                'max_distance': MAX_DISTANCE,
+                'min_pixel_similarity': MIN_PIXEL_SIMILARITY
+            }
+        }), 200
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/identify-faces', methods=['POST'])
+def identify_faces():
+    """
+    Kiosk check-in: identify every face in one frame (1:N per face).
+    All usable faces are encoded as one batch and scored against the gallery
+    with one matrix product. Accepts the same bodies as /identify-face.
+    """
+    try:
+        data = get_request_data(raw_field='image')
+        
+        if not data or 'image' not in data:
+            return jsonify({
+                'success': False,
+                'error': 'Missing required field: image'
+            }), 400
+        
+        top_k, invalid = parse_number(data, 'top_k', IDENTIFY_TOP_K, int, low=1)
+        if not invalid:
+            max_faces, invalid = parse_number(data, 'max_faces', KIOSK_MAX_FACES, int, low=1)
+        if invalid:
+            return jsonify(invalid[0]), invalid[1]
+        started = time.perf_counter()
+        
+        image_array = decode_image(data['image'])
+        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+        faces, detection = detect_faces(gray, min_neighbors=6)
+        
+        # Largest (closest) faces first; the rest of the queue waits for a later frame
+        faces = sorted(faces, key=lambda f: f[2] * f[3], reverse=True)
+        results = []
+        crops = []
+        for (x, y, w, h) in faces[:max_faces]:
+            face_img, _, error = crop_face(image_array, gray, (x, y, w, h))
+            results.append({
+                'box': {'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)},
+                'match': False,
+                'user_id': None,
+                'candidates': [],
+                'error': error
+            })
+            if not error:
+                crops.append((len(results) - 1, face_img))
+        detected_at = time.perf_counter()
+        
+        search = None
+        if crops:
+            encodings = create_face_encodings([face_img for _, face_img in crops])
+            encoded_at = time.perf_counter()
+            with metrics.stage('search'):
+                matches, search = get_gallery().search_batch(
+                    encodings, top_k, TOLERANCE, MAX_DISTANCE, MIN_PIXEL_SIMILARITY,
+                    exact=flag(data, 'exact')
+                )
+            for (i, _), candidates in zip(crops, matches):
+                for candidate in candidates:
+                    candidate['confidence'] = round(min(100, max(0, candidate['similarity'] * 100)), 2)
+                    candidate['similarity'] = round(candidate['similarity'], 4)
+                    candidate['distance'] = round(candidate['distance'], 4)
+                    candidate['pixel_similarity'] = round(candidate['pixel_similarity'], 4)
+                results[i].update({
+                    'match': bool(candidates),
+                    'user_id': candidates[0]['user_id'] if candidates else None,
+                    'candidates': candidates
+                })
+        else:
+            encoded_at = detected_at
+        
+        total = time.perf_counter() - started
+        identified = sum(result['match'] for result in results)
+        print(f"[INFO] Identify faces: {len(faces)} detected, {len(crops)} encoded, {identified} identified "
+              f"in {total * 1000:.0f} ms")
+        
+        return jsonify({
+            'success': True,
+            'faces': results,
+            'face_count': len(faces),
+            'faces_processed': len(results),
+            'identified': identified,
+            'search': search,
+            'timing': {
+                'detect_ms': round((detected_at - started) * 1000, 1),
+                'encode_ms': round((encoded_at - detected_at) * 1000, 1),
+                'search_ms': search['search_ms'] if search else 0.0,
+                'total_ms': round(total * 1000, 1),
+                'faces_per_second': round(len(crops) / total, 1) if crops else 0.0
+            },
             'threshold': {
                 'min_similarity': TOLERANCE,
                 'max_distance': MAX_DISTANCE,
@@ -425,7 +1341,7 @@ def compare_faces():
     Compare two face images directly.
     """
     try:
-        data = request.get_json()
+        data = get_request_data()
         
         if not data or 'image1' not in data or 'image2' not in data:
             return jsonify({
@@ -433,41 +1349,139 @@ def compare_faces():
                 'error': 'Missing required fields: image1 and image2'
             }), 400
         
-        # Process first image
-        image1_array = decode_base64_image(data['image1'])
-        face1_img, error1 = detect_and_extract_face(image1_array)
+        use_cache = cache_requested(data)
+        
+        # Process first image (a reference image reused across calls comes from the cache)
+        frame1 = load_frame(data['image1'], use_cache)
         
-        if error1:
+        if frame1.error:
             return jsonify({
                 'success': False,
-                'error': f"Image 1: {error1}"
+                'error': f"Image 1: {frame1.error}"
             }), 400
         
         # Process second image
-        image2_array = decode_base64_image(data['image2'])
-        face2_img, error2 = detect_and_extract_face(image2_array)
+        frame2 = load_frame(data['image2'], use_cache)
         
-        if error2:
+        if frame2.error:
             return jsonify({
                 'success': False,
-                'error': f"Image 2: {error2}"
+                'error': f"Image 2: {frame2.error}"
             }), 400
         
         # Create encodings
-        encoding1 = create_face_encoding(face1_img)
-        encoding2 = create_face_encoding(face2_img)
+        encoding1 = frame_encoding(frame1)
+        encoding2 = frame_encoding(frame2)
         
-        # Compare
-        similarity = compare_encodings(encoding1, encoding2)
-        match = similarity >= TOLERANCE
+        # Compare using the same TRIPLE validation as /verify-face
+        similarity, distance, pixel_similarity = compare_encodings(encoding1, encoding2)
+        match = (
+            (similarity >= TOLERANCE) and
+            (distance <= MAX_DISTANCE) and
+            (pixel_similarity >= MIN_PIXEL_SIMILARITY)
+        )
         confidence = min(100, max(0, similarity * 100))
         
         return jsonify({
             'success': True,
             'match': bool(match),
             'confidence': round(float(confidence), 2),
-            'distance': round(float(1 - similarity), 4),
-            'similarity': round(float(similarity), 4)
+            'distance': round(float(distance), 4),
+            'similarity': round(float(similarity), 4),
+            'pixel_similarity': round(float(pixel_similarity), 4)
+        }), 200
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/compare-batch', methods=['POST'])
+def compare_batch():
+    """
+    Compare every pair among N images and/or stored templates in one call.
+    Each image is detected and encoded once (one batch); the N x N matrices come
+    from a few matrix products. Items are the images first, then the templates.
+    """
+    try:
+        data = get_request_data(list_fields=('images', 'templates'))
+        images = (data or {}).get('images') or []
+        templates = (data or {}).get('templates') or []
+        
+        if not isinstance(images, list) or not isinstance(templates, list):
+            return jsonify({
+                'success': False,
+                'error': 'images and templates must be arrays'
+            }), 400
+        
+        count = len(images) + len(templates)
+        if count < 2 or count > COMPARE_BATCH_MAX_ITEMS:
+            return jsonify({
+                'success': False,
+                'error': f'Send between 2 and {COMPARE_BATCH_MAX_ITEMS} images and/or templates in total'
+            }), 400
+        
+        items = [{'type': 'image', 'index': i, 'error': None} for i in range(len(images))] + \
+                [{'type': 'template', 'index': i, 'error': None} for i in range(len(templates))]
+        encodings = [None] * count
+        
+        # Images: detect each one, then encode all faces not already cached in one batch
+        use_cache = cache_requested(data)
+        pending = []
+        for i, image in enumerate(images):
+            try:
+                frame = load_frame(image, use_cache)
+                error = frame.error
+            except Exception as e:
+                error = str(e)
+            if error:
+                items[i]['error'] = error
+            elif frame.encoding is not None:
+                encodings[i] = frame.encoding
+            else:
+                pending.append((i, frame))
+        if pending:
+            batch = create_face_encodings([frame.face_img for _, frame in pending])
+            for (i, frame), encoding in zip(pending, batch):
+                frame.encoding = encodings[i] = encoding
+        
+        for j, template in enumerate(templates):
+            i = len(images) + j
+            try:
+                encoding = load_template(template, encoder.dimension)
+                if encoding.ndim != 1:
+                    raise ValueError("Template sets are not supported here; send the averaged template")
+                encodings[i] = encoding
+            except ValueError as e:
+                items[i]['error'] = str(e)
+        
+        # Rows and columns of items that failed stay null
+        valid = [i for i in range(count) if encodings[i] is not None]
+        matrices = {name: [[None] * count for _ in range(count)]
+                    for name in ('similarity', 'distance', 'pixel_similarity', 'match')}
+        if valid:
+            with metrics.stage('compare'):
+                combined, distance, pixel = pairwise_scores(np.stack([encodings[i] for i in valid]))
+            match = (combined >= TOLERANCE) & (distance <= MAX_DISTANCE) & (pixel >= MIN_PIXEL_SIMILARITY)
+            for a, row in enumerate(valid):
+                for b, col in enumerate(valid):
+                    matrices['similarity'][row][col] = round(float(combined[a, b]), 4)
+                    matrices['distance'][row][col] = round(float(distance[a, b]), 4)
+                    matrices['pixel_similarity'][row][col] = round(float(pixel[a, b]), 4)
+                    matrices['match'][row][col] = bool(match[a, b])
+        
+        print(f"[INFO] Batch compare: {len(valid)}/{count} items usable")
+        
+        return jsonify({
+            'success': True,
+            'items': items,
+            **matrices,
+            'threshold': {
+                'min_similarity': TOLERANCE,
+                'max_distance': MAX_DISTANCE,
+                'min_pixel_similarity': MIN_PIXEL_SIMILARITY
+            }
         }), 200
         
     except Exception as e:
@@ -478,9 +1492,9 @@ def compare_faces():
 
 @app.route('/detect-face', methods=['POST'])
 def detect_face():
-    """Quick face detection endpoint for real-time feedback"""
+    """Quick face detection endpoint for real-time feedback (JSON, multipart or raw image body)"""
     try:
-        data = request.get_json()
+        data = get_request_data(raw_field='image')
         
         if not data or 'image' not in data:
             return jsonify({
@@ -489,10 +1503,23 @@ def detect_face():
                 'error': 'No image provided'
             }), 400
         
-        # Decode and detect face
-        image_array = decode_base64_image(data['image'])
-        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
-        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=MIN_FACE_SIZE)
+        # Decode and detect face (around the last known box when the client sends a session id)
+        session_id = data.get('session_id')
+        tracking = None
+        if session_id:
+            gray = decode_image(data['image'], gray=True)
+            faces, detection, tracking = detect_faces_tracked(gray, str(session_id), min_neighbors=5)
+        else:
+            # Polling often resends the same snapshot; its boxes come from the cache without decoding
+            raw = image_bytes(data['image'])
+            key = content_key(raw, 'detect:') if cache_requested(data) and face_cache.enabled else None
+            cached = face_cache.get(key) if key else None
+            if cached is not None:
+                faces, detection = cached
+            else:
+                faces, detection = detect_faces(decode_image_bytes(raw, gray=True), min_neighbors=5)
+                if key:
+                    face_cache.put(key, (faces, detection), 256 + 64 * len(faces))
         
         face_detected = len(faces) == 1  # Exactly one face
         multiple_faces = len(faces) > 1
@@ -512,6 +1539,8 @@ def detect_face():
             'face_detected': face_detected,
             'num_faces': len(faces),
             'faces': face_boxes,  # Array of face bounding boxes
+            'detection': detection,
+            'tracking': tracking,
             'warning': 'Multiple people detected! Please ensure only you are visible.' if multiple_faces else None
         }), 200
         
@@ -522,22 +1551,145 @@ def detect_face():
             'error': str(e)
         }), 500
 
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-    debug = os.environ.get('DEBUG', 'False').lower() == 'true'
-    
-    print(f"Starting Face Recognition Service (OpenCV Backend) on port {port}")
+@app.route('/templates/<user_id>', methods=['GET', 'PUT', 'DELETE'])
+def manage_template(user_id):
+    """Look up, import/overwrite or remove a server-side template"""
+    try:
+        store = get_template_store()
+        
+        if request.method == 'PUT':
+            data = request.get_json()
+            if not data or 'encoding' not in data:
+                return jsonify({
+                    'success': False,
+                    'error': 'Missing required field: encoding'
+                }), 400
+            weight, invalid = None, None
+            if data.get('weight') is not None:
+                weight, invalid = parse_number(data, 'weight', None, above=0)
+            if invalid:
+                return jsonify(invalid[0]), invalid[1]
+            row = store.put(user_id, load_template(data['encoding'], encoder.dimension), weight)
+            return jsonify({'success': True, 'user_id': user_id, 'row': row}), 200
+        
+        if request.method == 'DELETE':
+            deleted = store.delete(user_id)
+            return jsonify({'success': True, 'user_id': user_id, 'deleted': deleted}), 200 if deleted else 404
+        
+        return jsonify({
+            'success': True,
+            'user_id': user_id,
+            'exists': user_id in store,
+            'weight': store.weight(user_id),
+            'dimension': store.dimension,
+            'templates': len(store)
+        }), 200
+        
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/convert-templates', methods=['POST'])
+def convert_templates():
+    """Bulk-convert stored encodings (legacy JSON arrays or templates) to the compact format"""
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('encodings'), dict):
+            return jsonify({
+                'success': False,
+                'error': 'Missing required field: encodings (object of id -> stored encoding)'
+            }), 400
+        
+        dtype = data.get('dtype', TEMPLATE_DTYPE)
+        templates = {}
+        errors = {}
+        for key, value in data['encodings'].items():
+            try:
+                templates[key] = template_to_text(load_template(value, encoder.dimension), dtype)
+            except ValueError as e:
+                errors[key] = str(e)
+        
+        return jsonify({
+            'success': True,
+            'templates': templates,
+            'errors': errors
+        }), 200
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters and size of the content-hash image cache"""
+    return jsonify({
+        'success': True,
+        **face_cache.stats()
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage timings, rejection counters and in-flight requests in the Prometheus text format"""
+    if not metrics.enabled:
+        return jsonify({
+            'success': False,
+            'error': 'Metrics are disabled (set METRICS_ENABLED=true)'
+        }), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/tracker-stats', methods=['GET'])
+def tracker_stats():
+    """ROI hit rates for /detect-face polling sessions (optionally ?session_id=...)"""
+    return jsonify({
+        'success': True,
+        **face_tracker.stats(request.args.get('session_id'))
+    }), 200
+
+def print_startup_banner(port, server='Flask development server'):
+    """Configuration summary and encoder self-check, printed once at startup"""
+    print(f"Starting Face Recognition Service (OpenCV Backend) on port {port} ({server})")
     print(f"Configuration:")
     print(f"  - Tolerance: {TOLERANCE} (Combined similarity threshold)")
     print(f"  - Max Distance: {MAX_DISTANCE} (Euclidean distance threshold)")
     print(f"  - Min Pixel Similarity: {MIN_PIXEL_SIMILARITY} (Raw pixel threshold)")
+    print(f"  - Early Pixel Reject: {'ON' if VERIFY_EARLY_REJECT else 'OFF'} (margin {VERIFY_EARLY_REJECT_MARGIN})")
     print(f"  - Image Size: {IMAGE_SIZE}")
     print(f"  - Data Augmentation: ENABLED (7x per image)")
+    print(f"  - Face Detector: {face_detector.name}")
+    print(f"  - Detection Max Side: {DETECT_MAX_SIDE or 'full resolution'}")
+    print(f"  - Registration Workers: {registration_pool.REGISTRATION_WORKERS} per process")
+    print(f"  - Registration Job Workers: {REGISTRATION_JOB_WORKERS} (queue limit {REGISTRATION_JOB_MAX_QUEUED})")
+    print(f"  - Image Cache: {f'{FACE_CACHE_MAX_ENTRIES} entries / {FACE_CACHE_MAX_MB:g} MB' if face_cache.enabled else 'OFF'}")
+    print(f"  - Metrics: {'ON (/metrics)' if metrics.enabled else 'OFF'}")
+    print(f"  - Template Set Size: {TEMPLATE_SET_SIZE if TEMPLATE_SET_SIZE > 1 else 'OFF (mean only)'}")
+    print(f"  - Encoder: {ENCODER_DTYPE}, cv2 gradients {'ON' if ENCODER_CV2_GRADIENTS else 'OFF'}, {encoder.dimension} dims "
+          f"(deviation {encoder_deviation:.5f}, tolerance {ENCODER_TOLERANCE})")
     print(f"\nFeatures:")
     print(f"  [+] Triple validation (combined + distance + pixel)")
     print(f"  [+] Data augmentation (brightness, rotation, contrast, blur)")
     print(f"  [+] Real-time face detection overlay")
     print(f"  [+] ~2400 dimensional face encoding")
     print(f"\nNote: This version uses OpenCV for face detection (easier to install)")
+
+def start_background_workers():
+    """Registration process pool and job threads; call in every process that serves requests"""
+    registration_pool.start()
+    get_registration_jobs().start()  # Resumes jobs left queued by a previous run
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+    debug = os.environ.get('DEBUG', 'False').lower() == 'true'
     
+    print_startup_banner(port)
+    start_background_workers()
     app.run(host='0.0.0.0', port=port, debug=debug)
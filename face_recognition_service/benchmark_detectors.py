@@ -0,0 +1,165 @@
+"""
+Compare face detector backends on the same images
+
+For each available backend (see face_detectors.py), runs detection on every
+image the way the service does (grayscale, downscaled to --max-side, faces
+smaller than 80x80 at full resolution ignored) and reports per-frame latency
+and detection rate: the share of images with at least one face and with
+exactly one face (what registration and login require).
+
+--compare-full also runs every backend at full resolution and reports the
+speed-up of the downscaled pass and how well its boxes agree (IoU after
+mapping back), the check to run before enabling DETECT_MAX_SIDE.
+
+  python benchmark_detectors.py photos/*.jpg
+  python benchmark_detectors.py --backends haar,yunet --json results.json photos/
+  python benchmark_detectors.py --max-side 640 --compare-full photos/
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import cv2
+import numpy as np
+from face_detectors import BACKENDS, DEFAULT_YUNET_MODEL, create_detector
+
+MIN_FACE_SIZE = (80, 80)  # Same as app_simple
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+def load_images(paths, max_side):
+    """(name, gray frame downscaled like detect_faces, scaled min size) for every readable image"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(f for f in glob.glob(os.path.join(path, '*')) if f.lower().endswith(IMAGE_EXTENSIONS)))
+        else:
+            files.append(path)
+
+    images = []
+    for name in files:
+        gray = cv2.imread(name, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            print(f"[WARNING] Skipping unreadable image {name}", file=sys.stderr)
+            continue
+        scale = 1.0
+        if max_side > 0 and max(gray.shape) > max_side:
+            scale = max_side / max(gray.shape)
+            gray = cv2.resize(gray, (round(gray.shape[1] * scale), round(gray.shape[0] * scale)),
+                              interpolation=cv2.INTER_AREA)
+        min_size = (max(1, int(MIN_FACE_SIZE[0] * scale)), max(1, int(MIN_FACE_SIZE[1] * scale)))
+        images.append((name, gray, min_size))
+    return images
+
+def benchmark(detector, images, repeats=3, min_neighbors=6):
+    """Latency percentiles (best of `repeats` per image) and detection rates for one backend"""
+    detector.detect(images[0][1], min_neighbors=min_neighbors, min_size=images[0][2])  # Warm-up (model load, buffers)
+    latencies, counts = [], []
+    for _, gray, min_size in images:
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            faces = detector.detect(gray, min_neighbors=min_neighbors, min_size=min_size)
+            best = min(best, time.perf_counter() - start)
+        latencies.append(best * 1000)
+        counts.append(len(faces))
+
+    latencies = np.array(latencies)
+    counts = np.array(counts)
+    return {
+        'backend': detector.name,
+        'images': len(images),
+        'mean_ms': round(float(latencies.mean()), 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+        'detected_rate': round(float((counts > 0).mean()), 4),
+        'single_face_rate': round(float((counts == 1).mean()), 4),
+        'faces_per_image': counts.tolist()
+    }
+
+def box_iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    w = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    h = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = w * h
+    return inter / float(a[2] * a[3] + b[2] * b[3] - inter) if inter else 0.0
+
+def box_agreement(detector, full_images, scaled_images, min_neighbors=6):
+    """Share of images with the same face count at both resolutions, and mean IoU of their best-matching boxes"""
+    same_count, ious = 0, []
+    for (_, full, full_min), (_, small, small_min) in zip(full_images, scaled_images):
+        scale = small.shape[1] / full.shape[1]
+        expected = detector.detect(full, min_neighbors=min_neighbors, min_size=full_min)
+        found = [tuple(int(round(v / scale)) for v in box)
+                 for box in detector.detect(small, min_neighbors=min_neighbors, min_size=small_min)]
+        same_count += len(expected) == len(found)
+        ious.extend(max((box_iou(box, other) for other in found), default=0.0) for box in expected)
+    return {
+        'same_count_rate': round(same_count / len(full_images), 4),
+        'mean_iou': round(float(np.mean(ious)), 4) if ious else None
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark face detector backends on the same images')
+    parser.add_argument('paths', nargs='+', help='image files or directories')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma-separated backends to compare')
+    parser.add_argument('--max-side', type=int, default=int(os.environ.get('DETECT_MAX_SIDE', '0')),
+                        help='downscale images like the service does (0 = full resolution)')
+    parser.add_argument('--compare-full', action='store_true',
+                        help='also time full resolution and compare the boxes with the downscaled ones')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per image (best one counts)')
+    parser.add_argument('--min-neighbors', type=int, default=6, help='haar minNeighbors (6 = verification/registration)')
+    parser.add_argument('--model', default=os.environ.get('FACE_DETECTOR_MODEL', DEFAULT_YUNET_MODEL),
+                        help='YuNet ONNX model file')
+    parser.add_argument('--score', type=float, default=float(os.environ.get('FACE_DETECTOR_SCORE', '0.8')),
+                        help='YuNet confidence threshold')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    images = load_images(args.paths, args.max_side)
+    if not images:
+        parser.error('no readable images')
+    compare = args.compare_full and args.max_side > 0
+    full_images = load_images(args.paths, 0) if compare else None
+
+    options = {'yunet': {'model_path': args.model, 'score_threshold': args.score}}
+    results = []
+    for name in args.backends.split(','):
+        try:
+            detector = create_detector(name, **options.get(name, {}))
+        except (ValueError, RuntimeError) as e:
+            print(f"[WARNING] {name}: {str(e)}", file=sys.stderr)
+            results.append({'backend': name, 'error': str(e)})
+            continue
+        result = benchmark(detector, images, args.repeats, args.min_neighbors)
+        if compare:
+            full = benchmark(detector, full_images, args.repeats, args.min_neighbors)
+            result['full_mean_ms'] = full['mean_ms']
+            result['speedup'] = round(full['mean_ms'] / max(result['mean_ms'], 1e-3), 2)
+            result.update(box_agreement(detector, full_images, images, args.min_neighbors))
+        results.append(result)
+
+    print(f"{len(images)} images, max side {args.max_side or 'full'}")
+    print(f"{'backend':<8} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'detected':>9} {'single':>8}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['backend']:<8} unavailable: {result['error']}")
+            continue
+        print(f"{result['backend']:<8} {result['mean_ms']:>8.2f} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+              f"{result['detected_rate']:>9.1%} {result['single_face_rate']:>8.1%}")
+    if compare:
+        print(f"\nAgainst full resolution")
+        print(f"{'backend':<8} {'full ms':>8} {'speedup':>8} {'same #':>8} {'mean IoU':>9}")
+        for result in results:
+            if 'error' not in result:
+                iou = 'n/a' if result['mean_iou'] is None else f"{result['mean_iou']:.3f}"
+                print(f"{result['backend']:<8} {result['full_mean_ms']:>8.2f} {result['speedup']:>7.2f}x "
+                      f"{result['same_count_rate']:>8.1%} {iou:>9}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'max_side': args.max_side, 'images': [name for name, _, _ in images], 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""
+Offline latency benchmark for the face pipeline (no webcam or running server needed)
+
+Times each stage the service runs, in-process and on the same fixture frames:
+
+  decode_base64_image      base64 JPEG -> RGB array
+  detect_and_extract_face  detection, quality checks and 200x200 crop
+  augment_image            the 7 registration variants of one crop
+  create_face_encoding     one encoding
+  create_face_encodings    the 7 augmented variants as one batch (registration)
+  compare_encodings        one stored template against one probe
+
+and reports mean/p50/p95/p99 per stage, peak traced memory per stage and the
+process peak RSS. Results are saved as JSON; --compare prints the change
+against an earlier run, e.g. from the previous commit.
+
+Fixtures are generated deterministically (--seed) from seed photos in
+--fixtures: webcam-like frames at several resolutions with lighting, small
+rotation and JPEG quality varied. Without seed photos, synthetic frames are
+used and the results are marked "synthetic"; frames where no face is detected
+run the stages after detection on a centre crop.
+
+  python benchmark_pipeline.py --fixtures benchmark_fixtures/ --output bench.json
+  python benchmark_pipeline.py --fixtures benchmark_fixtures/ --compare bench.json
+"""
+import os
+import sys
+import json
+import glob
+import time
+import base64
+import platform
+import argparse
+import resource
+import subprocess
+import tracemalloc
+import cv2
+import numpy as np
+
+import app_simple
+from app_simple import (IMAGE_SIZE, decode_base64_image, detect_and_extract_face, augment_image,
+                        create_face_encoding, create_face_encodings, compare_encodings)
+
+FRAME_SIZES = [(640, 480), (1280, 720), (1920, 1080)]  # Typical webcam captures
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures')
+
+def load_seed_photos(directory):
+    """RGB seed photos from a directory (sorted, so runs see the same order)"""
+    photos = []
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            image = cv2.imread(path)
+            if image is not None:
+                photos.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return photos
+
+def synthetic_photo(rng):
+    """A textured frame with a drawn face-like shape (only sometimes detected as a face)"""
+    h, w = 480, 640
+    img = np.clip(rng.normal(120, 30, size=(h, w, 3)), 0, 255).astype(np.uint8)
+    img = cv2.GaussianBlur(img, (7, 7), 2.0)
+    cv2.ellipse(img, (w // 2, h // 2), (110, 145), 0, 0, 360, (200, 170, 150), -1)
+    for x in (w // 2 - 45, w // 2 + 45):
+        cv2.circle(img, (x, h // 2 - 35), 14, (40, 40, 40), -1)
+    cv2.ellipse(img, (w // 2, h // 2 + 60), (40, 12), 0, 0, 180, (120, 60, 60), 4)
+    return img
+
+def make_fixtures(photos, count, seed):
+    """count base64 JPEG frames: each seed photo fitted into a webcam frame size, then varied"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(count):
+        photo = photos[i % len(photos)] if photos else synthetic_photo(rng)
+        width, height = FRAME_SIZES[i % len(FRAME_SIZES)]
+
+        # Letterbox into the frame size
+        scale = min(width / photo.shape[1], height / photo.shape[0])
+        resized = cv2.resize(photo, (round(photo.shape[1] * scale), round(photo.shape[0] * scale)),
+                             interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        y, x = (height - resized.shape[0]) // 2, (width - resized.shape[1]) // 2
+        frame[y:y + resized.shape[0], x:x + resized.shape[1]] = resized
+
+        # Lighting and a small head tilt
+        frame = cv2.convertScaleAbs(frame, alpha=rng.uniform(0.85, 1.15), beta=rng.uniform(-20, 20))
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), rng.uniform(-5, 5), 1.0)
+        frame = cv2.warpAffine(frame, rotation, (width, height), borderMode=cv2.BORDER_REFLECT)
+
+        quality = int(rng.integers(70, 96))
+        ok, jpeg = cv2.imencode('.jpg', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        frames.append('data:image/jpeg;base64,' + base64.b64encode(jpeg.tobytes()).decode('ascii'))
+    return frames
+
+def centre_crop(image_array):
+    """Stand-in face crop for frames without a detectable face"""
+    h, w = image_array.shape[:2]
+    side = min(h, w) // 2
+    return cv2.resize(image_array[(h - side) // 2:(h + side) // 2, (w - side) // 2:(w + side) // 2], IMAGE_SIZE)
+
+def summarize(samples_ms):
+    samples = np.array(samples_ms)
+    return {
+        'n': len(samples),
+        'mean_ms': round(float(samples.mean()), 4),
+        'p50_ms': round(float(np.percentile(samples, 50)), 4),
+        'p95_ms': round(float(np.percentile(samples, 95)), 4),
+        'p99_ms': round(float(np.percentile(samples, 99)), 4),
+        'max_ms': round(float(samples.max()), 4)
+    }
+
+def run_stages(frames, measure):
+    """
+    Run every stage on every frame; measure(stage, fn) runs fn and records it.
+    Returns the detection success count.
+    """
+    detected = 0
+    template = None
+    for frame in frames:
+        image_array = measure('decode_base64_image', lambda: decode_base64_image(frame))
+        face_img, error = measure('detect_and_extract_face', lambda: detect_and_extract_face(image_array))
+        if error:
+            face_img = centre_crop(image_array)
+        else:
+            detected += 1
+        augmented = measure('augment_image', lambda: augment_image(face_img))
+        encoding = measure('create_face_encoding', lambda: create_face_encoding(face_img))
+        measure('create_face_encodings', lambda: create_face_encodings(augmented))
+        if template is None:
+            template = encoding
+        measure('compare_encodings', lambda: compare_encodings(template, encoding))
+    return detected
+
+def benchmark(frames, repeats=1):
+    """Latency percentiles per stage, then peak traced memory per stage in a separate pass"""
+    samples = {}
+
+    def timed(stage, fn):
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+        samples.setdefault(stage, []).append(best * 1000)
+        return result
+
+    run_stages(frames[:1], lambda stage, fn: fn())  # Warm-up: encoder buffers, cascade, lazy imports
+    detected = run_stages(frames, timed)
+
+    # tracemalloc slows allocation-heavy code, so memory gets its own pass
+    peaks = {}
+
+    def traced(stage, fn):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        peaks[stage] = max(peaks.get(stage, 0), peak)
+        return result
+
+    tracemalloc.start()
+    try:
+        run_stages(frames, traced)
+    finally:
+        tracemalloc.stop()
+
+    stages = {stage: {**summarize(values), 'peak_traced_mb': round(peaks.get(stage, 0) / 1e6, 3)}
+              for stage, values in samples.items()}
+    return stages, detected
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def print_report(report, previous=None):
+    print(f"\n{report['fixtures']['frames']} frames ({report['fixtures']['source']}), "
+          f"faces detected in {report['fixtures']['faces_detected']}")
+    header = f"{'stage':<24} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak MB':>8}"
+    print(header + ('   p50 vs previous' if previous else ''))
+    for stage, stats in report['stages'].items():
+        line = (f"{stage:<24} {stats['p50_ms']:>9.3f} {stats['p95_ms']:>9.3f} {stats['p99_ms']:>9.3f} "
+                f"{stats['peak_traced_mb']:>8.2f}")
+        old = (previous or {}).get('stages', {}).get(stage)
+        if old and old['p50_ms'] > 0:
+            line += f"   {(stats['p50_ms'] / old['p50_ms'] - 1) * 100:+.1f}%"
+        print(line)
+    print(f"Peak RSS: {report['max_rss_mb']:.0f} MB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline per-stage latency benchmark of the face pipeline')
+    parser.add_argument('--fixtures', default=os.environ.get('BENCHMARK_FIXTURES', DEFAULT_FIXTURES),
+                        help='directory of seed face photos (synthetic frames if empty or missing)')
+    parser.add_argument('--frames', type=int, default=30, help='fixture frames to generate')
+    parser.add_argument('--seed', type=int, default=0, help='fixture generation seed')
+    parser.add_argument('--repeats', type=int, default=1, help='runs per stage and frame (best one counts)')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='earlier results JSON to compare p50 latencies against')
+    args = parser.parse_args(argv)
+
+    photos = load_seed_photos(args.fixtures) if os.path.isdir(args.fixtures) else []
+    if not photos:
+        print(f"[WARNING] No seed photos in {args.fixtures}; using synthetic frames",
+              file=sys.stderr)
+    frames = make_fixtures(photos, args.frames, args.seed)
+
+    stages, detected = benchmark(frames, args.repeats)
+    # ru_maxrss is KB on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == 'darwin' else 1e3)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()
+        },
+        'config': {
+            'encoder_dtype': app_simple.ENCODER_DTYPE,
+            'encoder_cv2_gradients': app_simple.ENCODER_CV2_GRADIENTS,
+            'face_detector': app_simple.face_detector.name,
+            'detect_max_side': app_simple.DETECT_MAX_SIDE
+        },
+        'fixtures': {
+            'source': 'photos' if photos else 'synthetic',
+            'seed_photos': len(photos),
+            'frames': len(frames),
+            'seed': args.seed,
+            'frame_sizes': FRAME_SIZES,
+            'faces_detected': detected
+        },
+        'stages': stages,
+        'max_rss_mb': round(max_rss, 1)
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"[SUCCESS] Results saved to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Throughput benchmark for serve.py worker/thread settings
+
+Starts serve.py once per --configs entry (workers x threads, or "dev" for the
+Flask development server) on a spare port, enrolls a template with
+/encode-faces, then keeps --concurrency clients posting /verify-face frames
+(cache off, so every request decodes, detects and encodes) for --duration
+seconds. Reports requests/s, p50/p95/p99 latency, frames rejected by a quality
+check (still served) and errors per config.
+
+  python benchmark_serving.py --fixtures benchmark_fixtures/ --configs dev,1x4,2x2,4x2 --concurrency 8
+  python benchmark_serving.py --url http://localhost:5000 --fixtures benchmark_fixtures/   # a running server
+
+Frames come from the same seed photos as benchmark_pipeline.py; a template
+can only be enrolled when faces are found, so seed photos are needed here.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from benchmark_pipeline import DEFAULT_FIXTURES, load_seed_photos, make_fixtures
+
+SERVE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_simple.py')
+
+def post(url, body, timeout=60):
+    """JSON response body; 4xx answers (e.g. no face in the frame) are returned too"""
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        if e.code >= 500:
+            raise
+        return json.load(e)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(workers, threads, port, timeout=120):
+    """serve.py (or the Flask development server for workers=None) in a subprocess, returned once /health answers"""
+    if workers is None:
+        command = [sys.executable, APP_SCRIPT]
+    else:
+        command = [sys.executable, SERVE_SCRIPT, '--host', '127.0.0.1', '--port', str(port),
+                   '--workers', str(workers), '--threads', str(threads)]
+    process = subprocess.Popen(command, env={**os.environ, 'PORT': str(port)},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"serve.py exited with code {process.returncode}")
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=2).close()
+            return process
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("serve.py did not become ready")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def run_load(url, frames, template, concurrency, duration, warmup):
+    """Closed-loop load: each client sends its next frame as soon as the previous answer arrives"""
+    latencies, rejected, errors = [], 0, 0
+    measure_from = time.perf_counter() + warmup
+    stop_at = measure_from + duration
+
+    def client(offset):
+        results, no_face, failed, i = [], 0, 0, offset
+        while True:
+            start = time.perf_counter()
+            if start >= stop_at:
+                return results, no_face, failed
+            try:
+                ok = post(url + '/verify-face', {'image': frames[i % len(frames)], 'stored_encoding': template,
+                                                 'cache': False})['success']
+                served = True
+            except (urllib.error.URLError, OSError, ValueError):
+                ok = served = False
+            end = time.perf_counter()
+            if start >= measure_from and end <= stop_at:
+                # Frames rejected by a quality check were still fully served and count towards throughput
+                if served:
+                    results.append((end - start) * 1000)
+                    no_face += not ok
+                else:
+                    failed += 1
+            i += concurrency
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for results, no_face, failed in pool.map(client, range(concurrency)):
+            latencies.extend(results)
+            rejected += no_face
+            errors += failed
+
+    samples = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        'requests': len(latencies),
+        'rejected': rejected,
+        'errors': errors,
+        'requests_per_second': round(len(latencies) / duration, 2),
+        'p50_ms': round(float(np.percentile(samples, 50)), 1),
+        'p95_ms': round(float(np.percentile(samples, 95)), 1),
+        'p99_ms': round(float(np.percentile(samples, 99)), 1)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Requests/s of /verify-face for several serve.py configurations')
+    parser.add_argument('--fixtures', default=os.environ.get('BENCHMARK_FIXTURES', DEFAULT_FIXTURES),
+                        help='directory of seed face photos')
+    parser.add_argument('--configs', default='dev,1x4,2x2',
+                        help='comma-separated WORKERSxTHREADS to start ("dev" = python app_simple.py)')
+    parser.add_argument('--url', help='benchmark this running server instead of starting serve.py')
+    parser.add_argument('--concurrency', type=int, default=8, help='clients sending requests at once')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds per config')
+    parser.add_argument('--warmup', type=float, default=3, help='unmeasured seconds before that')
+    parser.add_argument('--frames', type=int, default=30, help='fixture frames to cycle through')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args(argv)
+
+    photos = load_seed_photos(args.fixtures) if os.path.isdir(args.fixtures) else []
+    if not photos:
+        parser.error(f'no seed photos in {args.fixtures}')
+    frames = make_fixtures(photos, args.frames, seed=0)
+
+    configs = [('url', None, None)] if args.url else [
+        (c, None, None) if c == 'dev' else (c, *(int(v) for v in c.split('x'))) for c in args.configs.split(',')]
+    results = []
+    for label, workers, threads in configs:
+        process = None
+        url = args.url
+        if not url:
+            port = free_port()
+            process = start_server(workers, threads, port)
+            url = f'http://127.0.0.1:{port}'
+        try:
+            enrolled = post(url + '/encode-faces', {'images': frames[:10]}, timeout=300)
+            if not enrolled.get('success'):
+                raise RuntimeError(f"enrollment failed: {enrolled.get('error')}")
+            stats = run_load(url, frames, enrolled['encoding'], args.concurrency, args.duration, args.warmup)
+        finally:
+            if process:
+                stop_server(process)
+        label = url if args.url else label
+        results.append({'config': label, 'workers': workers, 'threads': threads, **stats})
+        print(f"[INFO] {label}: {stats['requests_per_second']} req/s, p50 {stats['p50_ms']} ms", file=sys.stderr)
+
+    print(f"\n/verify-face, {args.concurrency} concurrent clients, {args.duration:g}s per config, {os.cpu_count()} CPUs")
+    print(f"{'config':<12} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rejected':>9} {'errors':>7}")
+    for r in results:
+        print(f"{r['config']:<12} {r['requests_per_second']:>8.2f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} "
+              f"{r['p99_ms']:>8.1f} {r['rejected']:>9} {r['errors']:>7}")
+    if (os.cpu_count() or 1) == 1:
+        print("[WARNING] Single CPU: these numbers show each setup's overhead, not how workers scale across cores")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'concurrency': args.concurrency, 'duration': args.duration, 'cpus': os.cpu_count(),
+                       'results': results}, f, indent=2)
+        print(f"[SUCCESS] Results saved to {args.output}")
+
+if __name__ == '__main__':
+    main()
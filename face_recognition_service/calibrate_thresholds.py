@@ -0,0 +1,293 @@
+"""
+Threshold calibration: FAR / FRR / EER for TOLERANCE, MAX_DISTANCE and MIN_PIXEL_SIMILARITY
+
+Takes a labelled image directory (one sub-directory of photos per person),
+runs every image through the service pipeline once, and scores every genuine
+(same person) and impostor (different people) pair with the compare_encodings
+metric in blocked matrix products. The three thresholds are then swept
+jointly: a face is accepted only if all three pass, so each pair is binned
+into a 3-D histogram over the threshold grids and cumulative sums give the
+accepted count for every grid point at once, instead of re-testing every pair
+per combination.
+
+  python calibrate_thresholds.py dataset/ [--enroll 5] [--output calibration.json]
+
+dataset/alice/*.jpg, dataset/bob/*.jpg, ... Encodings are cached in
+dataset/.face_encodings.npz (keyed by file, size, mtime and encoder/detector
+settings), so re-running after changing only the grids is instant and after
+an encoder change only re-encodes.
+
+--enroll N scores like login does: each person's template is built from the
+first N photos as in registration (mean of the augmented encodings) and the
+remaining photos are the probes. Without it, every photo is compared with
+every other photo.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+import app_simple
+from app_simple import augment_image, decode_image_bytes, preprocess_image, frame_encoding, create_face_encodings
+from face_encoder import ENCODER_VERSION
+from gallery import row_norms, score_rows_batch
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+SCORE_BLOCK = 1024  # Rows scored per product; bounds the (rows x columns) score matrices
+
+def encoder_signature():
+    """Everything that changes an image's encoding; cached encodings from other settings are ignored"""
+    return json.dumps({
+        'encoder_version': ENCODER_VERSION,
+        'dtype': app_simple.ENCODER_DTYPE,
+        'cv2_gradients': app_simple.ENCODER_CV2_GRADIENTS,
+        'detector': app_simple.face_detector.name,
+        'detect_max_side': app_simple.DETECT_MAX_SIDE
+    }, sort_keys=True)
+
+def list_dataset(root):
+    """(relative path, label) for every image in root/<label>/"""
+    items = []
+    for label in sorted(os.listdir(root)):
+        folder = os.path.join(root, label)
+        if not os.path.isdir(folder) or label.startswith('.'):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                items.append((os.path.join(label, name), label))
+    return items
+
+def encode_dataset(root, items, cache_path):
+    """
+    Encodings for every image -> (encodings, augmented means, usable mask), reusing cache_path.
+
+    The encoding is what login computes for the photo; the augmented mean is the
+    mean of its 7 registration variants, so a template over several photos is
+    the mean of their augmented means, as in run_registration.
+    """
+    signature = encoder_signature()
+    cached = {}
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as data:
+            if str(data['signature']) == signature:
+                for i, key in enumerate(data['keys']):
+                    cached[str(key)] = (data['encodings'][i], data['augmented'][i], bool(data['ok'][i]))
+
+    dimension = app_simple.encoder.dimension
+    encodings = np.zeros((len(items), dimension), dtype=np.float32)
+    augmented = np.zeros((len(items), dimension), dtype=np.float32)
+    ok = np.zeros(len(items), dtype=bool)
+    keys = []
+    encoded = 0
+    start = time.perf_counter()
+
+    for i, (path, _) in enumerate(items):
+        full_path = os.path.join(root, path)
+        stat = os.stat(full_path)
+        key = f"{path}|{stat.st_size}|{stat.st_mtime_ns}"
+        keys.append(key)
+        if key in cached:
+            encodings[i], augmented[i], ok[i] = cached[key]
+            continue
+
+        with open(full_path, 'rb') as f:
+            frame = preprocess_image(decode_image_bytes(f.read()))
+        if frame.error:
+            print(f"  [WARNING] {path}: {frame.error}", file=sys.stderr)
+        else:
+            encodings[i] = frame_encoding(frame)
+            augmented[i] = create_face_encodings(augment_image(frame.face_img)).mean(axis=0)
+            ok[i] = True
+        encoded += 1
+
+    print(f"[INFO] {len(items)} images: {len(items) - encoded} from cache, {encoded} encoded "
+          f"in {time.perf_counter() - start:.1f}s, {int(ok.sum())} usable", file=sys.stderr)
+
+    if cache_path and encoded:
+        np.savez(cache_path, signature=signature, keys=np.array(keys), encodings=encodings,
+                 augmented=augmented, ok=ok)
+    return encodings, augmented, ok
+
+def score_pairs(rows, row_labels, columns, column_labels, skip_self=False):
+    """
+    compare_encodings score triples for every (row, column) pair, split by label.
+
+    Returns {'genuine': (combined, distance, pixel), 'impostor': (...)} of flat
+    arrays. skip_self keeps only column > row, for rows and columns being the same set.
+    """
+    rows = np.asarray(rows, dtype=np.float32)
+    columns = np.asarray(columns, dtype=np.float32)
+    feature_sq, pixel_sq = row_norms(rows)
+    row_labels, column_labels = np.asarray(row_labels), np.asarray(column_labels)
+    parts = {'genuine': [], 'impostor': []}
+
+    for start in range(0, len(rows), SCORE_BLOCK):
+        stop = min(start + SCORE_BLOCK, len(rows))
+        scores = score_rows_batch(rows[start:stop], feature_sq[start:stop], pixel_sq[start:stop], columns)
+        same = row_labels[start:stop, None] == column_labels[None, :]
+        keep = np.ones_like(same)
+        if skip_self:
+            keep = np.arange(start, stop)[:, None] < np.arange(len(columns))[None, :]
+        for kind, mask in (('genuine', same & keep), ('impostor', ~same & keep)):
+            parts[kind].append(tuple(score[mask] for score in scores))
+
+    return {kind: tuple(np.concatenate([block[k] for block in blocks]) if blocks else np.empty(0)
+                        for k in range(3))
+            for kind, blocks in parts.items()}
+
+def accepted_counts(scores, tolerances, distances, pixels):
+    """
+    Pairs accepted at every grid point -> (len(tolerances), len(distances), len(pixels)) counts.
+
+    A pair is accepted when combined >= T, distance <= D and pixel >= P. Each
+    pair is binned by how many grid values it passes on each axis; suffix and
+    prefix sums over that 3-D histogram then count the pairs passing all three.
+    Grids must be sorted ascending.
+    """
+    combined, distance, pixel = scores
+    a = np.searchsorted(tolerances, combined, side='right')  # accepted for T index < a
+    b = np.searchsorted(distances, distance, side='left')  # accepted for D index >= b
+    c = np.searchsorted(pixels, pixel, side='right')  # accepted for P index < c
+    shape = (len(tolerances) + 1, len(distances) + 1, len(pixels) + 1)
+    histogram = np.bincount(np.ravel_multi_index((a, b, c), shape), minlength=np.prod(shape)).reshape(shape)
+
+    counts = np.flip(np.cumsum(np.flip(histogram, 0), 0), 0)[1:]  # a > i
+    counts = np.cumsum(counts, 1)[:, :-1]  # b <= j
+    counts = np.flip(np.cumsum(np.flip(counts, 2), 2), 2)[:, :, 1:]  # c > k
+    return counts
+
+def sweep(genuine, impostor, tolerances, distances, pixels):
+    """(FAR, FRR) over the joint threshold grid"""
+    genuine_total, impostor_total = len(genuine[0]), len(impostor[0])
+    far = accepted_counts(impostor, tolerances, distances, pixels) / max(impostor_total, 1)
+    frr = 1 - accepted_counts(genuine, tolerances, distances, pixels) / max(genuine_total, 1)
+    return far, frr
+
+def operating_point(far, frr, grids, index):
+    tolerance, distance, pixel = (grid[i] for grid, i in zip(grids, index))
+    return {
+        'tolerance': round(float(tolerance), 4),
+        'max_distance': round(float(distance), 4),
+        'min_pixel_similarity': round(float(pixel), 4),
+        'far': float(far[index]),
+        'frr': float(frr[index])
+    }
+
+def current_index(grids):
+    """Grid point nearest the configured TOLERANCE, MAX_DISTANCE and MIN_PIXEL_SIMILARITY"""
+    current = (app_simple.TOLERANCE, app_simple.MAX_DISTANCE, app_simple.MIN_PIXEL_SIMILARITY)
+    return tuple(int(np.argmin(np.abs(grid - value))) for grid, value in zip(grids, current))
+
+def summarize(far, frr, grids, target_fars):
+    """EER point, the lowest-FRR point under each target FAR, and the point nearest the current config"""
+    eer_index = np.unravel_index(np.argmin(np.abs(far - frr) + 1e-9 * (far + frr)), far.shape)
+    eer = operating_point(far, frr, grids, eer_index)
+    eer['eer'] = (eer['far'] + eer['frr']) / 2
+
+    targets = []
+    for target in target_fars:
+        allowed = far <= target
+        if not allowed.any():
+            targets.append({'target_far': target, 'point': None})
+            continue
+        # Lowest FRR within the FAR budget; ties go to the lowest FAR
+        index = np.unravel_index(np.argmin(np.where(allowed, frr + 1e-6 * far, np.inf)), far.shape)
+        targets.append({'target_far': target, 'point': operating_point(far, frr, grids, index)})
+
+    return eer, targets, operating_point(far, frr, grids, current_index(grids))
+
+def grid(spec):
+    """'start:stop:step' -> ascending array (stop included)"""
+    start, stop, step = (float(v) for v in spec.split(':'))
+    return np.round(np.arange(start, stop + step / 2, step), 6)
+
+def format_point(point):
+    if point is None:
+        return 'not reachable on this grid'
+    return (f"T={point['tolerance']:.3f} D={point['max_distance']:.3f} P={point['min_pixel_similarity']:.3f}  "
+            f"FAR={point['far']:.5f} FRR={point['frr']:.5f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Calibrate the three match thresholds on a labelled image set')
+    parser.add_argument('dataset', help='directory with one sub-directory of photos per person')
+    parser.add_argument('--enroll', type=int, default=0,
+                        help='build each template from the first N photos (as in registration); 0 = photo vs photo')
+    parser.add_argument('--cache', help='encoding cache file (default: <dataset>/.face_encodings.npz, "" = off)')
+    parser.add_argument('--tolerances', default='0.80:0.998:0.002', help='TOLERANCE grid start:stop:step')
+    parser.add_argument('--distances', default='0.05:0.80:0.01', help='MAX_DISTANCE grid start:stop:step')
+    parser.add_argument('--pixels', default='0.60:0.998:0.002', help='MIN_PIXEL_SIMILARITY grid start:stop:step')
+    parser.add_argument('--target-far', default='0.01,0.001,0.0001', help='FAR budgets to report the best FRR for')
+    parser.add_argument('--output', help='write the summary (and the FAR/FRR table along TOLERANCE) as JSON')
+    args = parser.parse_args(argv)
+
+    items = list_dataset(args.dataset)
+    if not items:
+        parser.error('no images found in <dataset>/<person>/')
+    cache_path = os.path.join(args.dataset, '.face_encodings.npz') if args.cache is None else args.cache
+    encodings, augmented, ok = encode_dataset(args.dataset, items, cache_path)
+    labels = np.array([label for _, label in items])
+
+    start = time.perf_counter()
+    if args.enroll:
+        # Templates from each person's first N usable photos, probes from the rest
+        templates, template_labels, probe_rows = [], [], []
+        for label in np.unique(labels[ok]):
+            rows = np.flatnonzero(ok & (labels == label))
+            if len(rows) <= args.enroll:
+                continue
+            templates.append(augmented[rows[:args.enroll]].mean(axis=0))
+            template_labels.append(label)
+            probe_rows.extend(rows[args.enroll:])
+        if not templates:
+            parser.error(f'no person has more than {args.enroll} usable photos')
+        scores = score_pairs(templates, template_labels, encodings[probe_rows], labels[probe_rows])
+    else:
+        rows = np.flatnonzero(ok)
+        scores = score_pairs(encodings[rows], labels[rows], encodings[rows], labels[rows], skip_self=True)
+    scored_at = time.perf_counter()
+
+    grids = (grid(args.tolerances), grid(args.distances), grid(args.pixels))
+    far, frr = sweep(scores['genuine'], scores['impostor'], *grids)
+    target_fars = [float(v) for v in args.target_far.split(',')]
+    eer, targets, current = summarize(far, frr, grids, target_fars)
+    swept_at = time.perf_counter()
+
+    genuine_count, impostor_count = len(scores['genuine'][0]), len(scores['impostor'][0])
+    print(f"\n{genuine_count} genuine / {impostor_count} impostor pairs "
+          f"({'template vs probe' if args.enroll else 'photo vs photo'}); "
+          f"scored in {(scored_at - start) * 1000:.0f} ms, {far.size} threshold combinations swept "
+          f"in {(swept_at - scored_at) * 1000:.0f} ms")
+    print(f"  Current config:  {format_point(current)}")
+    print(f"  EER {eer['eer']:.5f}:     {format_point(eer)}")
+    for target in targets:
+        print(f"  FAR <= {target['target_far']:<8g} {format_point(target['point'])}")
+
+    # FAR/FRR along TOLERANCE with the other two thresholds at their current values
+    _, j, k = current_index(grids)
+    table = [{'tolerance': float(t), 'far': float(far[i, j, k]), 'frr': float(frr[i, j, k])}
+             for i, t in enumerate(grids[0])]
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'dataset': os.path.abspath(args.dataset),
+                'mode': f'enroll {args.enroll}' if args.enroll else 'pairs',
+                'images': len(items),
+                'usable_images': int(ok.sum()),
+                'identities': int(len(np.unique(labels[ok]))),
+                'genuine_pairs': genuine_count,
+                'impostor_pairs': impostor_count,
+                'encoder': json.loads(encoder_signature()),
+                'grids': {name: [float(grids[n][0]), float(grids[n][-1]), len(grids[n])]
+                          for n, name in enumerate(('tolerance', 'max_distance', 'min_pixel_similarity'))},
+                'current': current,
+                'eer': eer,
+                'targets': targets,
+                'tolerance_table': table
+            }, f, indent=2)
+        print(f"[SUCCESS] Results saved to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Content-hash cache for repeated images
+
+Clients resend identical frames: retries after network errors, polling that
+posts the same snapshot, reference photos reused across /compare-faces calls.
+Entries are keyed by a hash of the image file bytes (after base64 decoding, so
+JSON and multipart uploads of the same file share an entry) and hold whatever
+the service derived from them, e.g. the detected face crop and its encoding.
+
+The cache is an LRU bounded both by entry count and by the bytes the entries
+hold; the least recently used entries are evicted until both limits are met.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+def content_key(data, namespace=''):
+    """Cache key for some image bytes; namespace separates results derived differently from the same image"""
+    return namespace + hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class FaceCache:
+    """Thread-safe LRU of key -> value with count and byte limits (max_entries 0 disables it)"""
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size in bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key):
+        """Cached value (marked most recently used), or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        """Insert or replace a value that holds about `size` bytes; values bigger than max_bytes are not kept"""
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None
+            }
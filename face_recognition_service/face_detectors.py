@@ -0,0 +1,127 @@
+"""
+Face detector backends
+
+Every backend takes a grayscale frame and returns face boxes as (x, y, w, h)
+tuples in that frame's coordinates, so detect_faces (downscaling, ROI
+tracking, stats) works the same whichever one is configured:
+
+  haar   OpenCV Haar cascade (haarcascade_frontalface_default.xml), the original detector
+  yunet  OpenCV DNN face detector (YuNet, cv2.FaceDetectorYN), ONNX model file loaded from disk
+  dlib   dlib's HOG + linear SVM frontal face detector (optional dependency)
+
+benchmark_detectors.py compares their latency and detection rate on the same images.
+"""
+import os
+import threading
+import cv2
+
+DEFAULT_YUNET_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models',
+                                   'face_detection_yunet_2023mar.onnx')
+
+try:
+    import dlib
+except ImportError:  # dlib backend unavailable; haar and yunet still work
+    dlib = None
+
+class HaarDetector:
+    """
+    Haar cascade with the service's original parameters (scaleFactor 1.1, minNeighbors per call).
+    Each thread gets its own CascadeClassifier (about 15 ms to load), like the other backends.
+    """
+    name = 'haar'
+
+    def __init__(self, scale_factor=1.1, cascade_path=None):
+        self.scale_factor = scale_factor
+        self.cascade_path = cascade_path or cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        self._local = threading.local()
+        self._instance()  # Fail at startup, not on the first request, if the cascade won't load
+
+    def _instance(self):
+        cascade = getattr(self._local, 'cascade', None)
+        if cascade is None:
+            cascade = cv2.CascadeClassifier(self.cascade_path)
+            if cascade.empty():
+                raise RuntimeError("Haar cascade file could not be loaded")
+            self._local.cascade = cascade
+        return cascade
+
+    def detect(self, gray, min_neighbors=6, min_size=(80, 80)):
+        faces = self._instance().detectMultiScale(gray, scaleFactor=self.scale_factor,
+                                                  minNeighbors=min_neighbors, minSize=min_size)
+        return [tuple(int(v) for v in face) for face in faces]
+
+class YuNetDetector:
+    """
+    OpenCV DNN detector (YuNet). A FaceDetectorYN instance keeps per-input-size
+    state, so each thread gets its own; min_neighbors is a cascade setting and is ignored.
+    """
+    name = 'yunet'
+
+    def __init__(self, model_path=DEFAULT_YUNET_MODEL, score_threshold=0.8, nms_threshold=0.3):
+        if not hasattr(cv2, 'FaceDetectorYN'):
+            raise RuntimeError("This OpenCV build has no FaceDetectorYN (needs opencv-python 4.5.4+)")
+        if not os.path.isfile(model_path):
+            raise RuntimeError(f"YuNet model not found at {model_path} (run python fetch_models.py, see models/README.md)")
+        self.model_path = model_path
+        self.score_threshold = score_threshold
+        self.nms_threshold = nms_threshold
+        self._local = threading.local()
+        self._instance()  # Fail at startup, not on the first request, if the model won't load
+
+    def _instance(self):
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            try:
+                detector = cv2.FaceDetectorYN.create(self.model_path, '', (320, 320),
+                                                     self.score_threshold, self.nms_threshold)
+            except cv2.error as e:
+                # A truncated or wrong file; python fetch_models.py --check tells which
+                raise RuntimeError(f"YuNet model at {self.model_path} could not be loaded: {str(e).strip()}")
+            self._local.detector = detector
+        return detector
+
+    def detect(self, gray, min_neighbors=6, min_size=(80, 80)):
+        height, width = gray.shape[:2]
+        image = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR) if gray.ndim == 2 else gray
+        detector = self._instance()
+        detector.setInputSize((width, height))
+        _, found = detector.detect(image)
+        faces = []
+        for row in found if found is not None else []:
+            x, y = max(0, int(round(row[0]))), max(0, int(round(row[1])))
+            w = min(width, int(round(row[0] + row[2]))) - x
+            h = min(height, int(round(row[1] + row[3]))) - y
+            if w >= min_size[0] and h >= min_size[1]:
+                faces.append((x, y, w, h))
+        return faces
+
+class DlibHogDetector:
+    """dlib HOG detector (the CPU model behind face_recognition.face_locations in app.py)"""
+    name = 'dlib'
+
+    def __init__(self, upsample=0):
+        if dlib is None:
+            raise RuntimeError("dlib is not installed (pip install dlib)")
+        self.upsample = upsample  # Upsampling finds smaller faces at ~4x the cost per step
+        self._local = threading.local()
+
+    def detect(self, gray, min_neighbors=6, min_size=(80, 80)):
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            detector = self._local.detector = dlib.get_frontal_face_detector()
+        height, width = gray.shape[:2]
+        faces = []
+        for rect in detector(gray, self.upsample):
+            x, y = max(0, rect.left()), max(0, rect.top())
+            w, h = min(width, rect.right()) - x, min(height, rect.bottom()) - y
+            if w >= min_size[0] and h >= min_size[1]:
+                faces.append((x, y, w, h))
+        return faces
+
+BACKENDS = {'haar': HaarDetector, 'yunet': YuNetDetector, 'dlib': DlibHogDetector}
+
+def create_detector(name, **options):
+    """Detector backend by name; raises ValueError for unknown names, RuntimeError if it can't be loaded here"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown face detector '{name}' (choose from {', '.join(BACKENDS)})")
+    return BACKENDS[name](**options)
@@ -0,0 +1,268 @@
+"""
+Hand-crafted face encoder used by app_simple.py
+
+The encoder is built once at startup: the Gabor kernel bank is precomputed and
+per-thread work buffers are reused between calls, so encoding a face only pays
+for the actual feature extraction.
+"""
+import threading
+import cv2
+import numpy as np
+
+# Bump whenever the feature layout changes; stored templates record the version that made them
+ENCODER_VERSION = 1
+
+# Neighbour offsets (dy, dx) for LBP bits 7..0, clockwise from top-left
+LBP_NEIGHBOURS = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
+GABOR_THETAS = [0, np.pi/4, np.pi/2, 3*np.pi/4]
+GRID_SIZE = 16  # Reduced from 24 to 16 for better generalization
+PIXEL_BLOCK = (20, 20)  # Downsampled raw pixels (400 features, always last in the encoding)
+
+def compute_lbp_uniform(img):
+    """Compute 8-neighbour LBP codes for every interior pixel (border stays 0); works on (..., H, W)"""
+    lbp = np.zeros_like(img)
+    h, w = img.shape[-2:]
+    center = img[..., 1:h-1, 1:w-1]
+    code = lbp[..., 1:h-1, 1:w-1]
+
+    # One whole-image comparison per neighbour instead of a per-pixel loop
+    for bit, (dy, dx) in zip(range(7, -1, -1), LBP_NEIGHBOURS):
+        neighbour = img[..., 1+dy:h-1+dy, 1+dx:w-1+dx]
+        code |= (neighbour >= center).astype(img.dtype) << bit
+
+    return lbp
+
+def compute_grid_features(gray, grid_size=GRID_SIZE, dtype=np.float64):
+    """Mean, std and median (scaled to 0-1) of every cell in a grid_size x grid_size grid; works on (..., H, W)"""
+    lead = gray.shape[:-2]
+    h, w = gray.shape[-2:]
+    grid_h, grid_w = h // grid_size, w // grid_size
+    if grid_h == 0 or grid_w == 0:
+        return np.zeros(lead + (0,), dtype=dtype)
+
+    # Gather each cell into one contiguous row, in row-major cell order
+    cells = gray[..., :grid_h*grid_size, :grid_w*grid_size]
+    cells = cells.reshape(lead + (grid_size, grid_h, grid_size, grid_w)).swapaxes(-3, -2)
+    cells = cells.reshape(lead + (grid_size * grid_size, grid_h * grid_w))
+    n = cells.shape[-1]
+
+    # Same reductions np.mean/np.std/np.median perform per cell, so float64 results are bit-identical
+    mean = np.add.reduce(cells, axis=-1, dtype=dtype) / dtype(n)
+    centered = cells - mean[..., None]
+    std = np.sqrt(np.add.reduce(centered * centered, axis=-1) / dtype(n))
+    median = np.median(cells, axis=-1).astype(dtype, copy=False)
+
+    return np.stack([mean, std, median], axis=-1).reshape(lead + (-1,)) / dtype(255.0)
+
+def batched_histogram(images, bins):
+    """cv2.calcHist over 0-255 for each image of an (N, H, W) uint8 stack -> (N, bins) float32 counts"""
+    return np.stack([cv2.calcHist([img], [0], None, [bins], [0, 256]).ravel() for img in images])
+
+def orientation_histograms(orientation, magnitude, bins=32):
+    """
+    Magnitude-weighted histograms of gradient angles over [-pi, pi], one per image in the batch.
+
+    Matches np.histogram(o, bins, range=(-pi, pi), weights=m) per image: same
+    edges (bin i holds edges[i] <= o < edges[i+1], last bin closed) and the
+    same in-order bincount accumulation, cast back to the weights dtype.
+    """
+    n = orientation.shape[0]
+    edges = np.linspace(-np.pi, np.pi, bins + 1, dtype=np.result_type(orientation.dtype, np.float32))
+    flat = orientation.reshape(n, -1)
+
+    # Arithmetic bin guess can be one off at the edges, so correct it against the edges themselves
+    indices = ((flat + np.pi) * (bins / (2 * np.pi))).astype(np.intp)
+    np.clip(indices, 0, bins - 1, out=indices)
+    indices[flat < edges[indices]] -= 1
+    indices[(flat >= edges[indices + 1]) & (indices != bins - 1)] += 1
+
+    indices += (np.arange(n) * bins)[:, None]
+    counts = np.bincount(indices.ravel(), weights=magnitude.reshape(-1), minlength=n * bins)
+    return counts.reshape(n, bins).astype(magnitude.dtype)
+
+class FaceEncoder:
+    """
+    Turns a face crop into a fixed-length, L2-normalized feature vector.
+
+    dtype=np.float64 reproduces the original encodings bit-for-bit; np.float32
+    (the service default) runs every filter and reduction in single precision.
+    use_cv2_gradients switches the gradient histogram to cv2.cartToPolar, which
+    is faster but approximates the orientation angle.
+    """
+
+    def __init__(self, image_size=(200, 200), dtype=np.float32, use_cv2_gradients=False):
+        self.image_size = image_size
+        self.dtype = np.dtype(dtype).type
+        self.depth = cv2.CV_32F if self.dtype == np.float32 else cv2.CV_64F
+        self.use_cv2_gradients = use_cv2_gradients
+
+        # Gabor bank is identical for every call, so build it once
+        self.gabor_kernels = [
+            cv2.getGaborKernel((21, 21), 5, theta, 10, 0.5, 0, ktype=cv2.CV_32F)
+            for theta in GABOR_THETAS
+        ]
+
+        # The 0 and 90 degree kernels are rank one; in float32 mode filter them as
+        # two 1-D passes (42 instead of 441 multiplies per pixel)
+        self.gabor_separable = [None] * len(self.gabor_kernels)
+        if self.dtype == np.float32:
+            for k, kernel in enumerate(self.gabor_kernels):
+                u, s, vt = np.linalg.svd(kernel.astype(np.float64))
+                if s[1] <= 1e-6 * s[0]:
+                    kx = (vt[0] * np.sqrt(s[0])).astype(np.float32)
+                    ky = (u[:, 0] * np.sqrt(s[0])).astype(np.float32)
+                    self.gabor_separable[k] = (kx, ky)
+
+        # Work buffers are per thread because Flask serves requests concurrently
+        self._local = threading.local()
+
+    @property
+    def dimension(self):
+        """Length of the encodings produced for image_size inputs"""
+        w, h = self.image_size
+        grid = 3 * GRID_SIZE * GRID_SIZE if h >= GRID_SIZE and w >= GRID_SIZE else 0
+        return 64 + 4 * 32 + 64 + grid + 32 + 2 * len(self.gabor_kernels) + PIXEL_BLOCK[0] * PIXEL_BLOCK[1]
+
+    def _buffers(self, n, shape):
+        """Per-thread float buffers for the gradient and Gabor stages, grown to hold n faces"""
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None or buffers['shape'] != shape or buffers['capacity'] < n:
+            buffers = {'shape': shape, 'capacity': n}
+            for name in ('source', 'sobelx', 'sobely', 'magnitude', 'orientation', 'filtered', 'scratch'):
+                buffers[name] = np.empty((n,) + shape, dtype=self.dtype)
+            self._local.buffers = buffers
+        return {name: buf[:n] if isinstance(buf, np.ndarray) else buf for name, buf in buffers.items()}
+
+    def encode(self, face_img):
+        """Encode an RGB face crop"""
+        return self.encode_batch(face_img[None])[0]
+
+    def encode_gray(self, gray):
+        """Encode a grayscale face crop"""
+        return self.encode_batch(gray[None])[0]
+
+    def pixel_block(self, gray):
+        """The raw 20x20 block that ends every encoding (equalized, resized, uint8, unscaled)"""
+        return cv2.resize(cv2.equalizeHist(gray), PIXEL_BLOCK).reshape(-1)
+
+    def encode_batch(self, faces):
+        """
+        Encode a stack of equally sized face crops in one pass.
+
+        Accepts (N, H, W) grayscale or (N, H, W, 3) RGB uint8 and returns an
+        (N, D) matrix whose rows equal encode()/encode_gray() of each face.
+        """
+        dtype = self.dtype
+        faces = np.ascontiguousarray(faces)
+        n = faces.shape[0]
+        if n == 0:
+            return np.empty((0, self.dimension), dtype=dtype)
+
+        if faces.ndim == 4:
+            # Color conversion is per pixel, so convert the whole stack as one tall image
+            nh, w = n * faces.shape[1], faces.shape[2]
+            faces = cv2.cvtColor(faces.reshape(nh, w, 3), cv2.COLOR_RGB2GRAY).reshape(n, -1, w)
+
+        # Apply histogram equalization for better contrast
+        gray = np.empty_like(faces)
+        for i in range(n):
+            cv2.equalizeHist(faces[i], dst=gray[i])
+        h, w = gray.shape[1:]
+        buf = self._buffers(n, (h, w))
+
+        # 1. Multi-scale histogram (64 bins at different resolutions)
+        hist_full = batched_histogram(gray, 64) / (h * w)
+
+        # Quarter images for spatial awareness
+        h2, w2 = h//2, w//2
+        quarters = [gray[:, :h2, :w2], gray[:, :h2, w2:], gray[:, h2:, :w2], gray[:, h2:, w2:]]
+        hist_spatial = np.concatenate([batched_histogram(q, 32) for q in quarters], axis=1)
+        hist_spatial = hist_spatial / (hist_spatial.sum(axis=1, keepdims=True) + 1e-7)
+
+        # 2. LBP histogram
+        lbp = compute_lbp_uniform(gray)
+        lbp_hist = batched_histogram(lbp, 64).astype(np.int64)
+        lbp_hist = lbp_hist / (lbp_hist.sum(axis=1, keepdims=True) + 1e-7)
+
+        # 3. Fine-grained grid features
+        grid_features = compute_grid_features(gray, GRID_SIZE, dtype)
+
+        # 4. Gradient orientation histogram (HOG-like)
+        sobelx, sobely = buf['sobelx'], buf['sobely']
+        for i in range(n):
+            cv2.Sobel(gray[i], self.depth, 1, 0, dst=sobelx[i], ksize=3)
+            cv2.Sobel(gray[i], self.depth, 0, 1, dst=sobely[i], ksize=3)
+        if self.use_cv2_gradients:
+            # cartToPolar is per element, so run it over the stack viewed as one tall image
+            magnitude, orientation = buf['magnitude'], buf['orientation']
+            cv2.cartToPolar(sobelx.reshape(n * h, w), sobely.reshape(n * h, w),
+                            magnitude.reshape(n * h, w), orientation.reshape(n * h, w))
+            # cartToPolar returns [0, 2*pi); fold back to arctan2's (-pi, pi]
+            orientation[orientation > np.pi] -= dtype(2 * np.pi)
+        else:
+            magnitude = np.multiply(sobelx, sobelx, out=buf['magnitude'])
+            magnitude += np.multiply(sobely, sobely, out=buf['scratch'])
+            np.sqrt(magnitude, out=magnitude)
+            orientation = np.arctan2(sobely, sobelx, out=buf['orientation'])
+
+        orient_hist = orientation_histograms(orientation, magnitude, 32)
+        orient_hist = orient_hist / (orient_hist.sum(axis=1, keepdims=True) + 1e-7)
+
+        # 5. Texture features from the precomputed Gabor bank
+        # (OpenCV's float32->float32 filter path is faster than uint8->float32)
+        source = gray
+        if dtype == np.float32:
+            source = buf['source']
+            np.copyto(source, gray)
+        filtered = buf['filtered']
+        abs_filtered = buf['scratch']
+        gabor_features = np.empty((n, 2 * len(self.gabor_kernels)), dtype=dtype)
+        for k, kernel in enumerate(self.gabor_kernels):
+            separable = self.gabor_separable[k]
+            for i in range(n):
+                if separable is not None:
+                    cv2.sepFilter2D(source[i], self.depth, separable[0], separable[1], dst=filtered[i])
+                else:
+                    cv2.filter2D(source[i], self.depth, kernel, dst=filtered[i])
+            flat = filtered.reshape(n, -1)
+            gabor_features[:, 2*k] = np.mean(np.abs(flat, out=abs_filtered.reshape(n, -1)), axis=1) / 255.0
+            gabor_features[:, 2*k+1] = np.std(flat, axis=1) / 255.0
+
+        # 6. Downsampled raw pixels for direct comparison (20x20 = 400 features)
+        small_faces = np.empty((n, PIXEL_BLOCK[1], PIXEL_BLOCK[0]), dtype=gray.dtype)
+        for i in range(n):
+            cv2.resize(gray[i], PIXEL_BLOCK, dst=small_faces[i])
+        pixel_features = small_faces.reshape(n, -1) / dtype(255.0)
+
+        # Combine all features
+        encodings = np.concatenate([
+            hist_full,
+            hist_spatial,
+            lbp_hist,
+            grid_features,
+            orient_hist,
+            gabor_features,
+            pixel_features  # Add raw pixel data
+        ], axis=1).astype(dtype, copy=False)
+
+        # L2 normalization (row-wise dot keeps the exact np.linalg.norm result per encoding)
+        norms = np.sqrt(np.array([row.dot(row) for row in encodings], dtype=dtype))
+        normalize = norms > 1e-7
+        encodings[normalize] /= norms[normalize, None]
+
+        return encodings
+
+def encoding_deviation(encoder, reference_encoder, faces):
+    """
+    Largest Euclidean distance between two encoders' outputs over the given RGB faces.
+
+    Uses the same metric as the MAX_DISTANCE check, so a deviation of 0.001
+    can move a verification distance by at most 0.001.
+    """
+    deviation = 0.0
+    for face in faces:
+        a = encoder.encode(face).astype(np.float64)
+        b = reference_encoder.encode(face).astype(np.float64)
+        deviation = max(deviation, float(np.linalg.norm(a - b)))
+    return deviation
@@ -0,0 +1,122 @@
+"""
+Per-session face tracking for /detect-face polling
+
+The frontend polls /detect-face many times per second with frames that barely
+change. FaceTracker remembers the last face box per session (bounded, with a
+TTL) so the next poll can search a small region of interest around it first.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+class FaceTracker:
+    """Bounded TTL store of the last face box per session, with per-session ROI hit counters"""
+
+    def __init__(self, max_sessions=1000, ttl_seconds=30.0, roi_margin=0.5, full_scan_every=10):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.roi_margin = roi_margin  # Grow the last box by this fraction of its size on every side
+        self.full_scan_every = full_scan_every  # Periodic full scan so new faces (e.g. a second person) still show up
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._totals = {'roi_hits': 0, 'roi_misses': 0, 'full_scans': 0}
+
+    def _get_session(self, session_id, now):
+        """Fetch a live session entry (caller holds the lock)"""
+        entry = self._sessions.get(session_id)
+        if entry is not None and now - entry['last_seen'] > self.ttl_seconds:
+            del self._sessions[session_id]
+            entry = None
+        return entry
+
+    def _evict(self, now):
+        """Drop expired sessions and trim to max_sessions, oldest first (caller holds the lock)"""
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if now - entry['last_seen'] <= self.ttl_seconds and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def roi_for(self, session_id, frame_shape):
+        """Expanded (x, y, w, h) search region for this session, or None when a full scan is due"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._get_session(session_id, now)
+            if entry is None or entry['box'] is None:
+                return None
+            if self.full_scan_every and entry['polls_since_full'] >= self.full_scan_every:
+                return None
+            x, y, w, h = entry['box']
+
+        height, width = frame_shape[:2]
+        dx, dy = int(w * self.roi_margin), int(h * self.roi_margin)
+        x0, y0 = max(0, x - dx), max(0, y - dy)
+        x1, y1 = min(width, x + w + dx), min(height, y + h + dy)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def record(self, session_id, box, mode, roi_hit=None):
+        """
+        Store the latest box (None when no face was found) and count how it was found.
+
+        mode is 'roi' or 'full'; roi_hit says whether an ROI search found the face
+        (False means it was lost and a full scan followed).
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._get_session(session_id, now)
+            if entry is None:
+                entry = {'box': None, 'last_seen': now, 'polls': 0, 'polls_since_full': 0,
+                         'roi_hits': 0, 'roi_misses': 0, 'full_scans': 0}
+                self._sessions[session_id] = entry
+
+            entry['box'] = box
+            entry['last_seen'] = now
+            entry['polls'] += 1
+            if roi_hit is True:
+                entry['roi_hits'] += 1
+                self._totals['roi_hits'] += 1
+            elif roi_hit is False:
+                entry['roi_misses'] += 1
+                self._totals['roi_misses'] += 1
+            if mode == 'full':
+                entry['full_scans'] += 1
+                entry['polls_since_full'] = 0
+                self._totals['full_scans'] += 1
+            else:
+                entry['polls_since_full'] += 1
+
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+
+    def stats(self, session_id=None):
+        """Hit rates overall and per live session (or for one session)"""
+        def hit_rate(counts):
+            attempts = counts['roi_hits'] + counts['roi_misses']
+            return round(counts['roi_hits'] / attempts, 4) if attempts else None
+
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            sessions = self._sessions.items()
+            if session_id is not None:
+                entry = self._get_session(session_id, now)
+                sessions = [(session_id, entry)] if entry is not None else []
+
+            per_session = {
+                sid: {
+                    'polls': entry['polls'],
+                    'roi_hits': entry['roi_hits'],
+                    'roi_misses': entry['roi_misses'],
+                    'full_scans': entry['full_scans'],
+                    'roi_hit_rate': hit_rate(entry),
+                    'tracking': entry['box'] is not None
+                }
+                for sid, entry in sessions
+            }
+            totals = dict(self._totals)
+
+        totals['roi_hit_rate'] = hit_rate(totals)
+        totals['active_sessions'] = len(self._sessions)
+        return {'totals': totals, 'sessions': per_session}
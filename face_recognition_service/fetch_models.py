@@ -0,0 +1,108 @@
+"""
+Download the detector models that aren't shipped in the repository
+
+The files are pinned by SHA-256: a download is written next to its target,
+checked, and only then moved into models/, so a truncated or tampered file
+never ends up where the service loads it from. Files already present with the
+right checksum are left alone.
+
+Each pin is the Git LFS object id of the file in its upstream repository
+(`git lfs ls-files -l` in a clone of opencv_zoo lists it), i.e. the SHA-256
+upstream itself recorded for the artifact, together with its size.
+
+  python fetch_models.py            # download whatever is missing
+  python fetch_models.py --check    # verify only, exit 1 if a model is missing or differs
+"""
+import os
+import sys
+import hashlib
+import argparse
+import tempfile
+import urllib.request
+
+from face_detectors import DEFAULT_YUNET_MODEL
+
+MODELS = {
+    'yunet': {
+        'path': DEFAULT_YUNET_MODEL,
+        'url': 'https://github.com/opencv/opencv_zoo/raw/main/models/face_detection_yunet/'
+               'face_detection_yunet_2023mar.onnx',
+        # LFS pointer of models/face_detection_yunet/face_detection_yunet_2023mar.onnx in opencv/opencv_zoo
+        'sha256': '8f2383e4dd3cfbb4553ea8718107fc0423210dc964f9f4280604804ed2552fa4',
+        'size': 232589
+    }
+}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def verify(name):
+    """(ok, message) for the model file on disk"""
+    model = MODELS[name]
+    if not os.path.isfile(model['path']):
+        return False, f"{name}: missing ({model['path']})"
+    size = os.path.getsize(model['path'])
+    if size != model['size']:
+        return False, f"{name}: {size} bytes, expected {model['size']} (truncated or a different file)"
+    actual = file_sha256(model['path'])
+    if actual != model['sha256']:
+        return False, f"{name}: checksum mismatch ({actual}, expected {model['sha256']})"
+    return True, f"{name}: OK ({model['path']})"
+
+def fetch(name, timeout=60):
+    """Download one model unless a verified copy is already in place; raises ValueError on a bad checksum"""
+    model = MODELS[name]
+    ok, _ = verify(name)
+    if ok:
+        return False
+
+    directory = os.path.dirname(model['path'])
+    os.makedirs(directory, exist_ok=True)
+    handle, partial = tempfile.mkstemp(prefix='.download-', dir=directory)
+    try:
+        digest = hashlib.sha256()
+        with os.fdopen(handle, 'wb') as f, urllib.request.urlopen(model['url'], timeout=timeout) as response:
+            for block in iter(lambda: response.read(1 << 20), b''):
+                digest.update(block)
+                f.write(block)
+        if digest.hexdigest() != model['sha256']:
+            # Either the download was tampered with or upstream replaced the file; never load it unchecked
+            raise ValueError(f"{name}: downloaded file has checksum {digest.hexdigest()}, expected "
+                             f"{model['sha256']} (compare with the LFS pointer of {model['url']})")
+        os.replace(partial, model['path'])
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download and verify the detector models')
+    parser.add_argument('models', nargs='*', default=list(MODELS), help=f"models to fetch ({', '.join(MODELS)})")
+    parser.add_argument('--check', action='store_true', help="verify the files on disk, don't download")
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.models if name not in MODELS]
+    if unknown:
+        parser.error(f"unknown model(s): {', '.join(unknown)}")
+
+    failed = 0
+    for name in args.models:
+        if not args.check:
+            try:
+                if fetch(name):
+                    print(f"[SUCCESS] {name}: downloaded {MODELS[name]['url']}")
+            except (OSError, ValueError) as e:
+                print(f"[ERROR] {name}: {str(e)}")
+                failed += 1
+                continue
+        ok, message = verify(name)
+        print(f"[INFO] {message}" if ok else f"[ERROR] {message}")
+        failed += not ok
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
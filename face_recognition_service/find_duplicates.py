@@ -0,0 +1,186 @@
+"""
+Offline duplicate-face detection over all registered templates
+
+Finds pairs of templates that would verify as each other under the login
+thresholds (combined similarity, euclidean distance and pixel similarity, as
+in compare_encodings), for fraud review of accounts registered with the same
+face.
+
+All pairs are scored block by block: each (block_size x block_size) tile of
+the similarity matrix is one float32 matrix product and is dropped as soon as
+its candidates are pulled out, so memory stays at a few tiles however large
+the gallery is. Rows are scaled so that a single product yields the combined
+similarity directly; tiles are spread over worker threads (NumPy releases the
+GIL for the product), and every candidate is then re-scored exactly in float64.
+
+  python find_duplicates.py                       # server-side template store
+  python find_duplicates.py --input users.jsonl   # {"user_id": ..., "encoding": ...} per line
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from gallery import PIXEL_DIMS, row_norms
+from template_store import TemplateStore, read_dimension
+from template_codec import load_template
+
+FEATURE_WEIGHT, PIXEL_WEIGHT = 0.6, 0.4  # compare_encodings' combined similarity
+FILTER_MARGIN = 1e-4  # float32 tiles keep candidates this far below min_similarity; the exact pass decides
+
+def _scales(squared, weight):
+    """Per-row factor that turns a part into weight-scaled unit length (0 for empty rows, which never match)"""
+    norms = np.sqrt(squared)
+    return np.where(norms > 1e-7, np.sqrt(weight) / np.maximum(norms, 1e-7), 0).astype(np.float32)
+
+def _scaled_block(matrix, start, stop, feature_scale, pixel_scale):
+    block = np.array(matrix[start:stop], dtype=np.float32)
+    block[:, :-PIXEL_DIMS] *= feature_scale[start:stop, None]
+    block[:, -PIXEL_DIMS:] *= pixel_scale[start:stop, None]
+    return block
+
+def exact_pair_scores(matrix, feature_sq, pixel_sq, rows, cols):
+    """compare_encodings(matrix[row], matrix[col]) for each pair -> (combined, euclidean, pixel) arrays"""
+    a = np.asarray(matrix[rows], dtype=np.float64)
+    b = np.asarray(matrix[cols], dtype=np.float64)
+    feature_dot = np.einsum('ij,ij->i', a[:, :-PIXEL_DIMS], b[:, :-PIXEL_DIMS])
+    pixel_dot = np.einsum('ij,ij->i', a[:, -PIXEL_DIMS:], b[:, -PIXEL_DIMS:])
+
+    feature_sim = feature_dot / (np.sqrt(feature_sq[rows] * feature_sq[cols]) + 1e-7)
+    pixel_sim = pixel_dot / (np.sqrt(pixel_sq[rows] * pixel_sq[cols]) + 1e-7)
+    squared = feature_sq[rows] + pixel_sq[rows] + feature_sq[cols] + pixel_sq[cols] - 2 * (feature_dot + pixel_dot)
+    return FEATURE_WEIGHT * feature_sim + PIXEL_WEIGHT * pixel_sim, np.sqrt(np.maximum(squared, 0)), pixel_sim
+
+def find_duplicate_pairs(ids, matrix, min_similarity, max_distance, min_pixel_similarity,
+                         block_size=4096, workers=None, max_pairs=100000):
+    """
+    Every pair of rows that passes all three thresholds, best combined similarity first.
+
+    Returns (pairs, info): pairs are dicts with user_a, user_b, similarity,
+    distance and pixel_similarity; info describes the run. At most max_pairs
+    pairs are kept (info['truncated'] says whether more passed).
+    """
+    start_time = time.perf_counter()
+    size = len(ids)
+    feature_sq, pixel_sq = row_norms(matrix)
+    feature_scale = _scales(feature_sq, FEATURE_WEIGHT)
+    pixel_scale = _scales(pixel_sq, PIXEL_WEIGHT)
+    starts = range(0, size, block_size)
+    tiles = [(i, j) for i in starts for j in starts if j >= i]
+
+    def score_tile(tile):
+        i, j = tile
+        left = _scaled_block(matrix, i, min(i + block_size, size), feature_scale, pixel_scale)
+        right = left if i == j else _scaled_block(matrix, j, min(j + block_size, size), feature_scale, pixel_scale)
+        candidate = (left @ right.T) >= min_similarity - FILTER_MARGIN
+        if i == j:
+            candidate = np.triu(candidate, k=1)  # Each pair once, no self-matches
+        rows, cols = np.nonzero(candidate)
+        rows, cols = rows + i, cols + j
+        if not len(rows):
+            return rows, cols, None
+        return rows, cols, exact_pair_scores(matrix, feature_sq, pixel_sq, rows, cols)
+
+    workers = workers or os.cpu_count() or 1
+    found = []
+    candidates = 0
+    passed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # map() consumes results in order, so only the finished tiles' candidates are held
+        for rows, cols, scores in pool.map(score_tile, tiles):
+            if scores is None:
+                continue
+            candidates += len(rows)
+            combined, distance, pixel = scores
+            keep = np.flatnonzero((combined >= min_similarity) & (distance <= max_distance) &
+                                  (pixel >= min_pixel_similarity))
+            passed += len(keep)
+            found.extend((float(combined[k]), int(rows[k]), int(cols[k]), float(distance[k]), float(pixel[k]))
+                         for k in keep)
+            if len(found) > max_pairs:
+                found.sort(reverse=True)
+                del found[max_pairs:]
+
+    found.sort(reverse=True)
+    pairs = [{
+        'user_a': ids[row],
+        'user_b': ids[col],
+        'similarity': round(combined, 6),
+        'distance': round(distance, 6),
+        'pixel_similarity': round(pixel, 6)
+    } for combined, row, col, distance, pixel in found]
+
+    return pairs, {
+        'templates': size,
+        'pairs_compared': size * (size - 1) // 2,
+        'tiles': len(tiles),
+        'block_size': block_size,
+        'workers': workers,
+        'candidates': candidates,
+        'pairs_found': passed,
+        'truncated': passed > len(pairs),
+        'seconds': round(time.perf_counter() - start_time, 2)
+    }
+
+def load_store(directory):
+    """(ids, matrix) copied from a server-side template store directory, so enrolments during the scan don't matter"""
+    return TemplateStore(directory, read_dimension(directory)).snapshot()
+
+def load_jsonl(path):
+    """(ids, matrix) from JSON lines with user_id and encoding (any form load_template accepts)"""
+    ids, rows = [], []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            encoding = load_template(record.get('encoding', record.get('template')))
+            if encoding.ndim != 1:
+                # A template set counts as its mean, like the server-side store
+                encoding = encoding.mean(axis=0)
+            if rows and len(encoding) != len(rows[0]):
+                raise ValueError(f"Line {number}: {len(encoding)} values, expected {len(rows[0])}")
+            ids.append(str(record['user_id']))
+            rows.append(encoding.astype(np.float32))
+    return ids, np.array(rows, dtype=np.float32).reshape(len(rows), -1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find templates that match each other (possible duplicate accounts)')
+    parser.add_argument('--store', default=os.environ.get('TEMPLATE_STORE_DIR', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'template_store')), help='template store directory')
+    parser.add_argument('--input', help='JSON lines file to scan instead of the template store')
+    parser.add_argument('--output', help='write pairs as JSON lines here (default: stdout)')
+    parser.add_argument('--min-similarity', type=float, default=float(os.environ.get('TOLERANCE', '0.92')))
+    parser.add_argument('--max-distance', type=float, default=float(os.environ.get('MAX_DISTANCE', '0.35')))
+    parser.add_argument('--min-pixel-similarity', type=float,
+                        default=float(os.environ.get('MIN_PIXEL_SIMILARITY', '0.88')))
+    parser.add_argument('--block-size', type=int, default=4096, help='rows per tile (tile memory ~ 4 * size^2 bytes)')
+    parser.add_argument('--workers', type=int, default=0, help='tiles scored concurrently (0 = CPU count)')
+    parser.add_argument('--max-pairs', type=int, default=100000, help='keep at most this many pairs')
+    args = parser.parse_args(argv)
+
+    ids, matrix = load_jsonl(args.input) if args.input else load_store(args.store)
+    print(f"[INFO] Scanning {len(ids)} templates for duplicates "
+          f"(similarity >= {args.min_similarity}, distance <= {args.max_distance}, "
+          f"pixel >= {args.min_pixel_similarity})", file=sys.stderr)
+
+    pairs, info = find_duplicate_pairs(ids, matrix, args.min_similarity, args.max_distance,
+                                       args.min_pixel_similarity, args.block_size, args.workers, args.max_pairs)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for pair in pairs:
+            out.write(json.dumps(pair) + '\n')
+    finally:
+        if args.output:
+            out.close()
+
+    print(f"[SUCCESS] {info['pairs_found']} duplicate pairs in {info['seconds']}s "
+          f"({info['pairs_compared']} pairs, {info['tiles']} tiles, {info['workers']} workers)", file=sys.stderr)
+    if info['truncated']:
+        print(f"[WARNING] Only the best {len(pairs)} pairs were kept (--max-pairs)", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
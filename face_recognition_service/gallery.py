@@ -0,0 +1,297 @@
+"""
+1:N gallery search over the server-side template store
+
+Scores a probe encoding against every enrolled template with the same
+combined / euclidean / pixel triple as compare_encodings, using one matrix
+product over the memory-mapped template matrix instead of a Python loop.
+
+For large galleries an optional IVF (inverted file) index narrows the scan:
+templates are clustered with spherical k-means, and a search only scores the
+templates in the clusters closest to the probe. Templates are L2-normalized,
+so a match (euclidean <= MAX_DISTANCE) is always close to the probe in
+cosine terms, which is what the clusters are built on.
+"""
+import copy
+import time
+import threading
+import numpy as np
+
+PIXEL_DIMS = 400  # Last 400 values of every encoding are the raw 20x20 pixels
+NORM_CHUNK = 8192  # Rows per pass when computing norms, bounds the float64 temporaries
+
+def row_norms(matrix):
+    """Squared norms of the feature and pixel parts of every row (float64)"""
+    feature_sq = np.empty(len(matrix))
+    pixel_sq = np.empty(len(matrix))
+    for start in range(0, len(matrix), NORM_CHUNK):
+        block = np.asarray(matrix[start:start + NORM_CHUNK], dtype=np.float64)
+        feature_sq[start:start + len(block)] = np.einsum('ij,ij->i', block[:, :-PIXEL_DIMS], block[:, :-PIXEL_DIMS])
+        pixel_sq[start:start + len(block)] = np.einsum('ij,ij->i', block[:, -PIXEL_DIMS:], block[:, -PIXEL_DIMS:])
+    return feature_sq, pixel_sq
+
+def score_rows(rows, feature_sq, pixel_sq, probe):
+    """
+    compare_encodings(row, probe) for every row at once.
+
+    Returns (combined_sim, euclidean_dist, pixel_sim) arrays. One product
+    against a (D, 2) probe matrix yields the feature and pixel dot products in
+    a single pass over the rows; the euclidean distance follows from the norms.
+    """
+    combined_sim, euclidean_dist, pixel_sim = score_rows_batch(rows, feature_sq, pixel_sq, [probe])
+    return combined_sim[:, 0], euclidean_dist[:, 0], pixel_sim[:, 0]
+
+def score_rows_batch(rows, feature_sq, pixel_sq, probes):
+    """score_rows for M probes at once: one product against a (D, 2M) split probe matrix -> (rows, M) arrays"""
+    probes = np.asarray(probes, dtype=np.float64)
+    split = np.zeros((probes.shape[1], 2 * len(probes)), dtype=rows.dtype)
+    split[:-PIXEL_DIMS, 0::2] = probes[:, :-PIXEL_DIMS].T
+    split[-PIXEL_DIMS:, 1::2] = probes[:, -PIXEL_DIMS:].T
+    dots = (rows @ split).astype(np.float64)
+    feature_dot, pixel_dot = dots[:, 0::2], dots[:, 1::2]
+
+    probe_feature_sq = np.einsum('ij,ij->i', probes[:, :-PIXEL_DIMS], probes[:, :-PIXEL_DIMS])
+    probe_pixel_sq = np.einsum('ij,ij->i', probes[:, -PIXEL_DIMS:], probes[:, -PIXEL_DIMS:])
+    feature_sq, pixel_sq = feature_sq[:, None], pixel_sq[:, None]
+
+    feature_sim = feature_dot / (np.sqrt(feature_sq * probe_feature_sq) + 1e-7)
+    pixel_sim = pixel_dot / (np.sqrt(pixel_sq * probe_pixel_sq) + 1e-7)
+    squared = feature_sq + pixel_sq + probe_feature_sq + probe_pixel_sq - 2 * (feature_dot + pixel_dot)
+    euclidean_dist = np.sqrt(np.maximum(squared, 0))
+    combined_sim = 0.6 * feature_sim + 0.4 * pixel_sim
+    return combined_sim, euclidean_dist, pixel_sim
+
+def pairwise_scores(encodings):
+    """compare_encodings(a, b) for every pair of rows -> (combined_sim, euclidean_dist, pixel_sim) N x N matrices"""
+    x = np.asarray(encodings, dtype=np.float64)
+    feature_dot = x[:, :-PIXEL_DIMS] @ x[:, :-PIXEL_DIMS].T
+    pixel_dot = x[:, -PIXEL_DIMS:] @ x[:, -PIXEL_DIMS:].T
+    feature_sq, pixel_sq = np.diag(feature_dot), np.diag(pixel_dot)
+
+    feature_sim = feature_dot / (np.sqrt(np.outer(feature_sq, feature_sq)) + 1e-7)
+    pixel_sim = pixel_dot / (np.sqrt(np.outer(pixel_sq, pixel_sq)) + 1e-7)
+    sq = feature_sq + pixel_sq
+    euclidean_dist = np.sqrt(np.maximum(sq[:, None] + sq[None, :] - 2 * (feature_dot + pixel_dot), 0))
+    np.fill_diagonal(euclidean_dist, 0)
+    return 0.6 * feature_sim + 0.4 * pixel_sim, euclidean_dist, pixel_sim
+
+class IVFIndex:
+    """Spherical k-means coarse quantizer with one inverted list of rows per centroid"""
+
+    def __init__(self, n_lists, iterations=8, sample_size=10000, seed=0):
+        self.n_lists = n_lists
+        self.iterations = iterations
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self.centroids = None
+        self.assignments = np.empty(0, dtype=np.int32)
+        self.trained_size = 0
+        self._order = None
+        self._offsets = None
+
+    @staticmethod
+    def _normalize(x):
+        norms = np.sqrt(np.einsum('ij,ij->i', x, x))
+        return x / np.maximum(norms, 1e-7)[:, None]
+
+    def _nearest(self, rows):
+        """Index of the closest centroid for each row (chunked so the score matrix stays small)"""
+        nearest = np.empty(len(rows), dtype=np.int32)
+        for start in range(0, len(rows), NORM_CHUNK):
+            block = np.asarray(rows[start:start + NORM_CHUNK], dtype=np.float32)
+            nearest[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        return nearest
+
+    def _rebuild_lists(self):
+        self._order = np.argsort(self.assignments, kind='stable').astype(np.int64)
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self._offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def train(self, matrix, live_rows):
+        """Cluster a sample of the stored templates (live_rows), then assign every row"""
+        size = len(live_rows)
+        n_lists = min(self.n_lists, size)
+        sample_rows = np.sort(self.rng.choice(live_rows, min(size, max(self.sample_size, n_lists)), replace=False))
+        sample = self._normalize(np.asarray(matrix[sample_rows], dtype=np.float32))
+
+        centroids = sample[self.rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(self.iterations):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(nearest, minlength=n_lists)
+            filled = np.flatnonzero(counts)
+            starts = (np.cumsum(counts) - counts)[filled]
+            sums = np.zeros_like(centroids)
+            sums[filled] = np.add.reduceat(sample[np.argsort(nearest, kind='stable')], starts, axis=0)
+            empty = counts == 0
+            # Restart empty clusters on random sample rows
+            sums[empty] = sample[self.rng.choice(len(sample), int(empty.sum()))]
+            centroids = self._normalize(sums)
+
+        self.centroids = centroids
+        self.assignments = self._nearest(matrix)
+        self.trained_size = size
+        self._rebuild_lists()
+
+    def updated(self, matrix, changed_rows):
+        """
+        Copy of the index with the rows that were added or overwritten reassigned
+        (rows past the end of matrix are dropped); searches in flight keep using this one.
+        """
+        size = len(matrix)
+        index = copy.copy(self)
+        index.assignments = np.empty(size, dtype=np.int32)
+        keep = min(size, len(self.assignments))
+        index.assignments[:keep] = self.assignments[:keep]
+        if len(changed_rows):
+            index.assignments[changed_rows] = self._nearest(matrix[changed_rows])
+        index._rebuild_lists()
+        return index
+
+    def candidates(self, probe, n_probe):
+        """Rows in the n_probe lists whose centroids are closest to the probe"""
+        scores = self.centroids @ np.asarray(probe, dtype=np.float32)
+        n_probe = min(n_probe, len(scores))
+        lists = np.argpartition(-scores, n_probe - 1)[:n_probe]
+        return np.sort(np.concatenate([self._order[self._offsets[i]:self._offsets[i + 1]] for i in lists]))
+
+class Gallery:
+    """
+    Cached search state (norms, optional IVF index) for a TemplateStore.
+
+    The cache follows store.version, so enrolments from any worker process are
+    picked up on the next search. Only rows written or released since the
+    cached version (store.changes) get new norms and IVF assignments; the
+    index is retrained from scratch once the gallery has doubled (or halved)
+    since the last training.
+
+    The matrix is scanned in place, so a search whose rows were released by a
+    concurrent write (seen as a store version change) is run again, and after
+    a few such races once more with writers held off.
+    """
+
+    def __init__(self, store, ivf_min_size=50000, ivf_lists=0, ivf_probes=16, attempts=3):
+        self.store = store
+        self.ivf_min_size = ivf_min_size  # Gallery size at which the IVF index kicks in (0 = always exact)
+        self.ivf_lists = ivf_lists  # Number of clusters (0 = sqrt of the gallery size)
+        self.ivf_probes = ivf_probes  # Clusters scanned per search
+        self.attempts = attempts  # Lock-free searches before one is run with writers held off
+        self._lock = threading.Lock()
+        self._version = None
+        self._state = None
+        self._index = None
+
+    def _refresh(self):
+        """Update the cached state if the store changed -> (version, ids, live, matrix, feature_sq, pixel_sq, index)"""
+        with self._lock:
+            if self._state is not None and self.store.version == self._version:
+                return self._state
+
+            if self._state is None:
+                version, ids, matrix = self.store.rows_view()
+                live = np.array([key is not None for key in ids], dtype=bool)
+                feature_sq, pixel_sq = row_norms(matrix)
+                changed = None
+            else:
+                # New arrays rather than in-place updates: searches in flight still hold the old state
+                _, old_ids, old_live, _, old_feature_sq, old_pixel_sq, _ = self._state
+                version, size, updates = self.store.changes(self._version)
+                matrix = self.store.matrix_view(size)
+                ids = old_ids[:size] + [None] * (size - len(old_ids))
+                live = np.zeros(size, dtype=bool)
+                live[:min(size, len(old_live))] = old_live[:size]
+                feature_sq, pixel_sq = np.zeros(size), np.zeros(size)
+                feature_sq[:min(size, len(old_feature_sq))] = old_feature_sq[:size]
+                pixel_sq[:min(size, len(old_pixel_sq))] = old_pixel_sq[:size]
+                changed = np.array(sorted(updates), dtype=np.int64)
+                for row, key in updates.items():
+                    ids[row] = key
+                    live[row] = key is not None
+                if len(changed):
+                    feature_sq[changed], pixel_sq[changed] = row_norms(matrix[changed])
+
+            index = self._index
+            count = int(live.sum())
+            if self.ivf_min_size and count >= self.ivf_min_size:
+                if index is None or count > 2 * index.trained_size or count < index.trained_size // 2:
+                    start = time.perf_counter()
+                    n_lists = self.ivf_lists or int(np.sqrt(count))
+                    index = IVFIndex(n_lists)
+                    index.train(matrix, np.flatnonzero(live))
+                    print(f"[INFO] Gallery IVF index trained: {count} templates, {len(index.centroids)} lists "
+                          f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+                elif changed is not None:
+                    index = index.updated(matrix, changed)
+            else:
+                index = None
+
+            self._index = index
+            self._state = (version, ids, live, matrix, feature_sq, pixel_sq, index)
+            self._version = version
+            return self._state
+
+    def search(self, probe, top_k, min_similarity, max_distance, min_pixel_similarity, exact=False):
+        """
+        Top-k templates that pass all three thresholds, best combined similarity first.
+
+        Returns (candidates, info): candidates are dicts with user_id, similarity,
+        distance and pixel_similarity; info describes how the search ran.
+        """
+        results, info = self.search_batch([probe], top_k, min_similarity, max_distance, min_pixel_similarity, exact)
+        return results[0], info
+
+    def search_batch(self, probes, top_k, min_similarity, max_distance, min_pixel_similarity, exact=False):
+        """
+        search() for several probes (e.g. every face in a frame) with one matrix product.
+
+        Returns (candidates per probe, info). With the IVF index, the rows scanned
+        are the union of every probe's clusters, so each probe sees at least the
+        rows a single search would have scanned.
+        """
+        start = time.perf_counter()
+        probes = np.asarray(probes)
+        for _ in range(self.attempts):
+            state = self._refresh()
+            results, info = self._scan(state, probes, top_k, min_similarity, max_distance, min_pixel_similarity, exact)
+            if self.store.version == state[0]:
+                break
+        else:
+            with self.store.locked():
+                state = self._refresh()
+                results, info = self._scan(state, probes, top_k, min_similarity, max_distance,
+                                           min_pixel_similarity, exact)
+
+        info['search_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        return results, info
+
+    def _scan(self, state, probes, top_k, min_similarity, max_distance, min_pixel_similarity, exact):
+        """Score the probes against one cached state -> (candidates per probe, info)"""
+        _, ids, live, matrix, feature_sq, pixel_sq, index = state
+
+        if index is not None and not exact:
+            rows = np.unique(np.concatenate([index.candidates(probe, self.ivf_probes) for probe in probes]))
+            rows = rows[rows < len(ids)]
+            combined, distance, pixel = score_rows_batch(matrix[rows], feature_sq[rows], pixel_sq[rows], probes)
+            mode = 'ivf'
+        else:
+            rows = np.arange(len(ids))
+            combined, distance, pixel = score_rows_batch(matrix, feature_sq, pixel_sq, probes)
+            mode = 'exact'
+
+        # Released rows keep their old values until reused; they never match
+        passing = (combined >= min_similarity) & (distance <= max_distance) & (pixel >= min_pixel_similarity)
+        passing &= live[rows][:, None]
+        results = []
+        for j in range(len(probes)):
+            hits = np.flatnonzero(passing[:, j])
+            best = hits[np.argsort(-combined[hits, j], kind='stable')[:top_k]]
+            results.append([{
+                'user_id': ids[rows[i]],
+                'similarity': float(combined[i, j]),
+                'distance': float(distance[i, j]),
+                'pixel_similarity': float(pixel[i, j])
+            } for i in best])
+
+        return results, {
+            'mode': mode,
+            'gallery_size': int(live.sum()),
+            'scanned': int(live[rows].sum())
+        }
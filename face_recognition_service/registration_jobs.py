@@ -0,0 +1,233 @@
+"""
+Asynchronous registration jobs for /encode-faces
+
+Submitting a job stores its images in a small SQLite database and returns a
+job id straight away. Worker threads claim queued jobs from the database, run
+the normal registration pipeline and write back progress and the final result,
+which clients poll for. Because the queue lives in the database, jobs survive
+a service restart: a job left 'running' by a dead process goes back to the
+queue once its heartbeat is older than stale_seconds.
+
+Every process serving the app shares the database, so both limits are
+service-wide: at most `workers` jobs run at once and at most `max_queued`
+wait, however many gunicorn workers poll the queue.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from contextlib import closing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,            -- queued, running, done, failed
+    user_id TEXT,
+    template_set_size INTEGER,       -- NULL: the service default
+    stage TEXT,
+    processed INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,                     -- JSON body, same shape as the /encode-faces response
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_images (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    data BLOB NOT NULL,              -- base64 text or raw bytes, exactly as uploaded
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+class QueueFull(Exception):
+    """Raised by submit() when max_queued jobs are already waiting"""
+
+class RegistrationJobs:
+    """SQLite-backed job queue; `workers` threads per process, `workers` running jobs across all of them"""
+
+    def __init__(self, db_path, run_job, workers=1, max_queued=20, stale_seconds=120,
+                 ttl_seconds=3600, max_attempts=3):
+        self.db_path = db_path
+        self.run_job = run_job  # run_job(images, user_id, progress, template_set_size) -> (response body, HTTP status)
+        self.workers = workers  # Jobs running at once across every process sharing db_path
+        self.max_queued = max_queued  # Waiting jobs across every process
+        self.stale_seconds = stale_seconds  # A running job without a heartbeat for this long is requeued
+        self.ttl_seconds = ttl_seconds  # Finished jobs are kept this long for polling
+        self.max_attempts = max_attempts
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with closing(self._connect()) as db:
+            db.execute('PRAGMA journal_mode=WAL')  # Readers (status polls) don't block the writer
+            db.executescript(SCHEMA)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+            if 'template_set_size' not in columns:  # Database created before the column existed
+                db.execute('ALTER TABLE jobs ADD COLUMN template_set_size INTEGER')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def start(self):
+        """Start the worker threads once; they also pick up jobs left over from a previous run"""
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'registration-job-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            print(f"[INFO] Registration job workers started: {self.workers}")
+
+    def submit(self, images, user_id=None, template_set_size=None):
+        """Queue a registration, returns (job_id, queue position)"""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                # Finished jobs past their TTL are dropped here rather than by a separate sweeper
+                db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                           (now - self.ttl_seconds,))
+                db.execute("DELETE FROM job_images WHERE job_id NOT IN "
+                           "(SELECT id FROM jobs WHERE status IN ('queued', 'running'))")
+                queued = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+                if queued >= self.max_queued:
+                    raise QueueFull(f"Registration queue is full ({queued} jobs waiting)")
+
+                db.execute(
+                    "INSERT INTO jobs (id, status, user_id, template_set_size, stage, total, created_at, updated_at) "
+                    "VALUES (?, 'queued', ?, ?, 'queued', ?, ?, ?)",
+                    (job_id, None if user_id is None else str(user_id), template_set_size, len(images), now, now)
+                )
+                db.executemany('INSERT INTO job_images (job_id, idx, data) VALUES (?, ?, ?)',
+                               [(job_id, idx, image) for idx, image in enumerate(images)])
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+        self.start()
+        self._wakeup.set()
+        return job_id, queued + 1
+
+    def get(self, job_id):
+        """Job status dict, or None for an unknown (or expired) job"""
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT id, status, user_id, stage, processed, total, result, created_at, updated_at '
+                'FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            position = None
+            if row[1] == 'queued':
+                position = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= ?",
+                                      (row[7],)).fetchone()[0]
+
+        return {
+            'job_id': row[0],
+            'status': row[1],
+            'user_id': row[2],
+            'progress': {'stage': row[3], 'processed': row[4], 'total': row[5]},
+            'queue_position': position,
+            'result': json.loads(row[6]) if row[6] else None,
+            'created_at': row[7],
+            'updated_at': row[8]
+        }
+
+    def stats(self):
+        with closing(self._connect()) as db:
+            counts = dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {'workers': self.workers, 'max_queued': self.max_queued, 'jobs': counts}
+
+    def _claim(self):
+        """
+        Atomically take the oldest queued (or stale running) job, returns (job_id, user_id, template_set_size) or None.
+        Nothing is claimed while `workers` jobs with a live heartbeat are already running in any process.
+        """
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                # Jobs that keep killing their worker are failed instead of retried forever
+                db.execute(
+                    "UPDATE jobs SET status = 'failed', updated_at = ?, result = ? "
+                    "WHERE status = 'running' AND updated_at < ? AND attempts >= ?",
+                    (now, json.dumps({'success': False, 'error': 'Registration job was interrupted too many times'}),
+                     now - self.stale_seconds, self.max_attempts)
+                )
+                running = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running' AND updated_at >= ?",
+                                     (now - self.stale_seconds,)).fetchone()[0]
+                row = None
+                if running < self.workers:
+                    row = db.execute(
+                        "SELECT id, user_id, template_set_size FROM jobs WHERE status = 'queued' "
+                        "OR (status = 'running' AND updated_at < ?) ORDER BY created_at LIMIT 1",
+                        (now - self.stale_seconds,)
+                    ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE jobs SET status = 'running', stage = 'starting', processed = 0, "
+                        "attempts = attempts + 1, updated_at = ? WHERE id = ?", (now, row[0])
+                    )
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return row
+
+    def _progress(self, job_id, stage, processed, total):
+        """Progress update; doubles as the heartbeat that keeps the job from being requeued"""
+        with closing(self._connect()) as db:
+            db.execute('UPDATE jobs SET stage = ?, processed = ?, total = ?, updated_at = ? WHERE id = ?',
+                       (stage, processed, total, time.time(), job_id))
+
+    def _finish(self, job_id, body, ok):
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute("UPDATE jobs SET status = ?, stage = 'finished', result = ?, updated_at = ? WHERE id = ?",
+                       ('done' if ok else 'failed', json.dumps(body), time.time(), job_id))
+            # The images are only needed while the job can still run
+            db.execute('DELETE FROM job_images WHERE job_id = ?', (job_id,))
+            db.execute('COMMIT')
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"[ERROR] Registration job queue: {str(e)}")
+                job = None
+
+            if job is None:
+                # Poll now and then too, for jobs submitted by other processes or gone stale
+                self._wakeup.wait(timeout=1.0)
+                self._wakeup.clear()
+                continue
+
+            job_id, user_id, template_set_size = job
+            started = time.perf_counter()
+            print(f"[INFO] Registration job {job_id} started")
+            try:
+                with closing(self._connect()) as db:
+                    images = [data for (data,) in db.execute(
+                        'SELECT data FROM job_images WHERE job_id = ? ORDER BY idx', (job_id,))]
+
+                def progress(stage, processed, total):
+                    self._progress(job_id, stage, processed, total)
+
+                body, status = self.run_job(images, user_id, progress, template_set_size)
+                self._finish(job_id, body, ok=status == 200)
+            except Exception as e:
+                print(f"[ERROR] Registration job {job_id}: {str(e)}")
+                try:
+                    self._finish(job_id, {'success': False, 'error': str(e)}, ok=False)
+                except sqlite3.Error:
+                    pass  # Left 'running'; it is retried once its heartbeat goes stale
+            print(f"[INFO] Registration job {job_id} finished in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,117 @@
+"""
+Process pool for the /encode-faces registration pipeline
+
+Each worker imports app_simple once, so its Haar cascade and FaceEncoder
+(Gabor bank, work buffers) stay warm for the life of the pool. Work is split
+in two ordered phases:
+
+  1. one task per uploaded image: decode, detect, quality check, augment
+  2. one task per chunk of augmented faces: batch encode
+
+Results come back in submission order, so the final average is the same as
+the single-process path.
+"""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+# 1 keeps everything in the request thread (legacy behaviour); under serve.py a total across its workers
+REGISTRATION_WORKERS = int(os.environ.get('REGISTRATION_WORKERS', '1'))
+WARMUP_TIMEOUT = 300  # Seconds a worker waits in start() for the rest of the pool to load
+
+_pool = None
+_pool_lock = threading.Lock()
+_service = None  # app_simple, imported inside each worker
+
+def _init_worker(ready=None):
+    """Load the service once per worker and warm up the encoder buffers, then wait at the ready barrier if given"""
+    global _service
+    import cv2
+    # Each worker is one core's worth of work; don't let OpenCV fan out on top of the pool
+    cv2.setNumThreads(1)
+
+    import app_simple
+    _service = app_simple
+    width, height = app_simple.IMAGE_SIZE
+    app_simple.create_face_encoding(np.zeros((height, width, 3), dtype=np.uint8))
+    if ready is not None:
+        # A timeout breaks the barrier, which fails the initializer and with it the pool
+        ready.wait(WARMUP_TIMEOUT)
+
+def _prepare_image(img_base64):
+    return _service.prepare_registration_image(img_base64)
+
+def _encode_chunk(faces):
+    return _service.encoder.encode_batch(faces)
+
+def _ping(_):
+    return os.getpid()
+
+def enabled():
+    return REGISTRATION_WORKERS > 1
+
+def split_across(processes):
+    """
+    Treat REGISTRATION_WORKERS as a total for `processes` serving processes (serve.py's
+    gunicorn workers), so each starts its share instead of a full pool. Returns the per-process size.
+    """
+    global REGISTRATION_WORKERS
+    REGISTRATION_WORKERS = max(1, REGISTRATION_WORKERS // max(1, processes))
+    return REGISTRATION_WORKERS
+
+def get_pool(ready=None):
+    """Create the worker pool on first use; start() passes the barrier its workers meet at once loaded"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn avoids forking a threaded Flask process (and OpenCV's own thread pool)
+            _pool = ProcessPoolExecutor(
+                max_workers=REGISTRATION_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(ready,)
+            )
+            print(f"[INFO] Registration pool started with {REGISTRATION_WORKERS} workers")
+        return _pool
+
+def _run(fn, items):
+    """pool.map that drops a broken pool so the next request starts a fresh one"""
+    global _pool
+    pool = get_pool()
+    try:
+        return list(pool.map(fn, items))
+    except BrokenProcessPool:
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+
+def prepare_images(images):
+    """prepare_registration_image for every image, in parallel, results in input order"""
+    return _run(_prepare_image, images)
+
+def encode_faces(faces):
+    """Batch-encode a list of face images across the pool, returns an (N, D) matrix in input order"""
+    faces = np.stack(faces)
+    chunks = np.array_split(faces, min(REGISTRATION_WORKERS, len(faces)))
+    return np.concatenate(_run(_encode_chunk, chunks))
+
+def start():
+    """Spawn and warm every worker up front so the first registration doesn't pay for it"""
+    if not enabled():
+        return
+    get_pool(multiprocessing.get_context('spawn').Barrier(REGISTRATION_WORKERS))
+    # Workers are spawned as tasks arrive and none is idle while it loads, so one task per worker
+    # spawns all of them; none runs until every worker has reached the barrier, so once these
+    # return the whole pool is warm (counting distinct pids could be fooled by one fast worker)
+    _run(_ping, range(REGISTRATION_WORKERS))
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -0,0 +1,131 @@
+"""
+Production server for the face service: pre-forked gunicorn workers
+
+  python serve.py                      # app_simple, SERVE_WORKERS processes x SERVE_THREADS threads
+  SERVE_WORKERS=4 SERVE_THREADS=2 python serve.py
+  python serve.py --app app:app --threads 1   # the face_recognition (dlib) service
+
+The app is imported once in the master (preload), then forked, so every
+worker shares the encoder's Gabor bank, the detector model and the imported
+libraries copy-on-write instead of loading its own; gc.freeze() keeps the
+collector from touching (and so copying) those pages. Each request thread
+gets its own detector instance and encoder work buffers on first use.
+
+OpenCV and the BLAS library start their own thread pools per process, so
+N workers x T threads x cores would oversubscribe the CPU. The BLAS limits are
+environment variables read when numpy loads, so they are set here before
+anything imports it; OpenCV's is set in the master and again in every worker.
+
+Linux/macOS only (gunicorn needs fork); on Windows use start_service.bat.
+"""
+import os
+import sys
+import argparse
+
+SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', '0'))  # Worker processes (0 = one per CPU core)
+SERVE_THREADS = int(os.environ.get('SERVE_THREADS', '2'))  # Request threads per worker
+SERVE_CV2_THREADS = int(os.environ.get('SERVE_CV2_THREADS', '1'))  # OpenCV threads per worker (0 = OpenCV default)
+SERVE_BLAS_THREADS = int(os.environ.get('SERVE_BLAS_THREADS', '1'))  # NumPy BLAS threads per worker
+SERVE_TIMEOUT = int(os.environ.get('SERVE_TIMEOUT', '120'))  # Restart a worker stuck on one request this long (seconds)
+SERVE_APP = os.environ.get('SERVE_APP', 'app_simple:app')  # module:variable of the Flask app
+
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def limit_library_threads(blas_threads, cv2_threads):
+    """Cap BLAS (before numpy is imported) and OpenCV thread pools; explicit environment settings win"""
+    if blas_threads > 0:
+        for name in BLAS_THREAD_VARIABLES:
+            os.environ.setdefault(name, str(blas_threads))
+    if cv2_threads > 0:
+        import cv2
+        cv2.setNumThreads(cv2_threads)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the face service with pre-forked gunicorn workers')
+    parser.add_argument('--app', default=SERVE_APP, help='module:variable of the Flask app')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=SERVE_WORKERS, help='worker processes (0 = CPU cores)')
+    parser.add_argument('--threads', type=int, default=SERVE_THREADS, help='request threads per worker')
+    parser.add_argument('--cv2-threads', type=int, default=SERVE_CV2_THREADS)
+    parser.add_argument('--blas-threads', type=int, default=SERVE_BLAS_THREADS)
+    parser.add_argument('--timeout', type=int, default=SERVE_TIMEOUT)
+    args = parser.parse_args(argv)
+
+    limit_library_threads(args.blas_threads, args.cv2_threads)
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("[ERROR] gunicorn is not installed (pip install gunicorn); "
+              "use 'python app_simple.py' for the development server")
+        return 1
+
+    import gc
+    import shutil
+    import tempfile
+    import importlib
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    module_name, _, variable = args.app.partition(':')
+    module = importlib.import_module(module_name)  # Preload: everything below is shared with the workers
+    app = getattr(module, variable or 'app')
+    workers = args.workers or os.cpu_count() or 1
+
+    # Workers publish metrics here so /metrics adds up all of them (see service_metrics.py)
+    metrics = getattr(module, 'metrics', None)
+    metrics_dir = None
+    if metrics is not None and metrics.enabled and workers > 1:
+        metrics_dir = os.environ.get('METRICS_DIR') or tempfile.mkdtemp(prefix='face-metrics-')
+        metrics_dir_owned = 'METRICS_DIR' not in os.environ
+
+    # Forked workers already run registrations in parallel; each gets a share of REGISTRATION_WORKERS, not a full pool
+    registration_pool = getattr(module, 'registration_pool', None)
+    if registration_pool is not None:
+        total = registration_pool.REGISTRATION_WORKERS
+        per_worker = registration_pool.split_across(workers)
+        if total > 1 and per_worker == 1:
+            print(f"[WARNING] REGISTRATION_WORKERS={total} is below {workers} workers x 2; "
+                  f"registrations run in the request thread of each worker")
+
+    if hasattr(module, 'print_startup_banner'):
+        module.print_startup_banner(args.port, f'gunicorn, {workers} workers x {args.threads} threads')
+    print(f"  - Library Threads: OpenCV {args.cv2_threads or 'default'}, BLAS {args.blas_threads or 'default'} per worker")
+
+    def post_fork(server, worker):
+        limit_library_threads(0, args.cv2_threads)  # OpenCV's pool isn't inherited across fork
+        if metrics_dir:
+            metrics.share(metrics_dir)
+        if hasattr(module, 'start_background_workers'):
+            module.start_background_workers()
+
+    def on_exit(server):
+        if metrics_dir and metrics_dir_owned:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    options = {
+        'bind': f'{args.host}:{args.port}',
+        'workers': workers,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'threads': args.threads,
+        'timeout': args.timeout,
+        'preload_app': True,
+        'post_fork': post_fork,
+        'on_exit': on_exit
+    }
+
+    class FaceService(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    gc.freeze()  # Objects imported so far are never collected, so forked workers keep sharing their pages
+    FaceService().run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+"""
+Prometheus metrics for the face service
+
+Written out in the Prometheus text exposition format by the service itself,
+so no client library is needed:
+
+  face_stage_seconds{stage, endpoint}          histogram: decode, detect, quality, augment, encode, compare, search
+  face_rejections_total{reason, endpoint}      counter: no_face, multiple_faces, too_small, blurry, invalid_image
+  face_requests_in_flight{endpoint}            gauge
+  face_requests_total{endpoint, status}        counter
+  face_request_seconds{endpoint}               histogram
+
+The endpoint label is the route of the request being served (a context
+variable set per request), or 'background' for work outside a request such as
+registration jobs. When metrics are disabled every hook returns immediately
+and stage() hands out one shared no-op context manager.
+
+With several worker processes (serve.py), share() makes each process publish
+its series to a directory every few seconds and /metrics sum every process's
+latest series, so a scrape sees the whole service whichever worker answers it.
+"""
+import os
+import glob
+import json
+import time
+import atexit
+import bisect
+import threading
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+# Seconds; fine steps below 10 ms for compare/encode, coarse ones for whole requests
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+current_endpoint = ContextVar('metrics_endpoint', default='background')
+NO_OP = nullcontext()
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Counter:
+    """Monotonic count per label combination"""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name, self.help, self.label_names = name, help_text, tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(values, other):
+        for labels, value in other.items():
+            values[labels] = values.get(labels, 0) + value
+
+    def samples(self, values=None):
+        values = self.snapshot() if values is None else values
+        return [(self.name, format_labels(self.label_names, labels), value) for labels, value in sorted(values.items())]
+
+class Gauge(Counter):
+    """Value that goes up and down (inc with a negative amount)"""
+    kind = 'gauge'
+
+class Histogram:
+    """Bucketed observations per label combination (cumulative le buckets, _sum and _count)"""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label_names = name, help_text, tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)  # First bucket with le >= value
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, labels=()):
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[0]) if series else 0
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: (list(series[0]), series[1]) for labels, series in self._series.items()}
+
+    @staticmethod
+    def merge(series, other):
+        for labels, (counts, total) in other.items():
+            mine = series.get(labels)
+            series[labels] = (counts, total) if mine is None else \
+                ([a + b for a, b in zip(mine[0], counts)], mine[1] + total)
+
+    def samples(self, series=None):
+        series = self.snapshot() if series is None else series
+        samples = []
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                samples.append((self.name + '_bucket', format_labels(self.label_names, labels, le), cumulative))
+            samples.append((self.name + '_sum', format_labels(self.label_names, labels), total))
+            samples.append((self.name + '_count', format_labels(self.label_names, labels), cumulative))
+        return samples
+
+class StageTimer:
+    """Context manager recording its duration as one face_stage_seconds observation"""
+    __slots__ = ('histogram', 'stage', 'start')
+
+    def __init__(self, histogram, stage):
+        self.histogram = histogram
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, (self.stage, current_endpoint.get()))
+        return False
+
+class ServiceMetrics:
+    """The face service's metric families, plus gauges read from other components at scrape time"""
+
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.stages = Histogram('face_stage_seconds', 'Time spent in each pipeline stage',
+                                ('stage', 'endpoint'), buckets)
+        self.rejections = Counter('face_rejections_total', 'Images rejected by a face or quality check',
+                                  ('reason', 'endpoint'))
+        self.in_flight = Gauge('face_requests_in_flight', 'Requests currently being served', ('endpoint',))
+        self.requests = Counter('face_requests_total', 'Requests served', ('endpoint', 'status'))
+        self.latency = Histogram('face_request_seconds', 'Request latency', ('endpoint',), buckets)
+        self._collectors = []  # (name, kind, help, fn returning {labels tuple: value}, label names)
+        self.shared_dir = None
+
+    @property
+    def families(self):
+        return (self.stages, self.rejections, self.in_flight, self.requests, self.latency)
+
+    def stage(self, name):
+        """with metrics.stage('encode'): ... times the block (no-op when disabled)"""
+        if not self.enabled:
+            return NO_OP
+        return StageTimer(self.stages, name)
+
+    def observe_stage(self, name, seconds):
+        """Record a stage duration that was already measured"""
+        if self.enabled:
+            self.stages.observe(seconds, (name, current_endpoint.get()))
+
+    def reject(self, reason):
+        if self.enabled:
+            self.rejections.inc((reason, current_endpoint.get()))
+
+    def request_started(self, endpoint):
+        """Enter a request: sets the endpoint label for this context; returns a token for request_finished"""
+        self.in_flight.inc((endpoint,))
+        return current_endpoint.set(endpoint), time.perf_counter()
+
+    def request_finished(self, endpoint, status, token):
+        context_token, start = token
+        self.latency.observe(time.perf_counter() - start, (endpoint,))
+        self.requests.inc((endpoint, str(status)))
+        self.in_flight.inc((endpoint,), -1)
+        current_endpoint.reset(context_token)
+
+    def collect(self, name, kind, help_text, fn, label_names=()):
+        """Expose a value owned elsewhere (e.g. cache counters), read from fn() at scrape time"""
+        self._collectors.append((name, kind, help_text, fn, tuple(label_names)))
+
+    def share(self, directory, interval=5.0):
+        """Publish this process's series to directory every interval seconds (and at exit); render() sums all processes"""
+        os.makedirs(directory, exist_ok=True)
+        self.shared_dir = directory
+
+        def publish_forever():
+            while True:
+                time.sleep(interval)
+                self.publish()
+
+        threading.Thread(target=publish_forever, name='metrics-publish', daemon=True).start()
+        atexit.register(self.publish)
+
+    def publish(self):
+        """Write this process's series to the shared directory (atomically, via rename)"""
+        path = os.path.join(self.shared_dir, f'metrics-{os.getpid()}.json')
+        data = {metric.name: [[list(labels), value] for labels, value in metric.snapshot().items()]
+                for metric in self.families}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+
+    def merged(self):
+        """Series of this process plus the latest published by every other process -> {name: series}"""
+        merged = {metric.name: metric.snapshot() for metric in self.families}
+        if self.shared_dir is None:
+            return merged
+        for path in glob.glob(os.path.join(self.shared_dir, 'metrics-*.json')):
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+            if pid == os.getpid():
+                continue
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = process_alive(pid)
+            for metric in self.families:
+                # Counts of exited workers still belong in the totals; their gauges don't
+                if metric.kind == 'gauge' and not alive:
+                    continue
+                metric.merge(merged[metric.name], {tuple(labels): value if metric.kind != 'histogram' else tuple(value)
+                                                   for labels, value in data.get(metric.name, [])})
+        return merged
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        merged = self.merged()
+        for metric in self.families:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {format_value(value)}'
+                         for name, labels, value in metric.samples(merged[metric.name]))
+        for name, kind, help_text, fn, label_names in self._collectors:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(fn().items()):
+                if value is not None:
+                    lines.append(f'{name}{format_labels(label_names, labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,57 @@
+"""
+Multi-template enrollment
+
+Instead of collapsing every augmented registration sample into one mean, the
+samples are split into a few clusters with a bounded k-medoids pass, and each
+cluster's mean becomes one template. Verification scores the probe against all
+of them with the gallery's batched scoring and max-pools: the face matches if
+any template passes all three thresholds.
+"""
+import numpy as np
+from gallery import row_norms, score_rows
+
+def select_medoids(encodings, k, iterations=10):
+    """
+    Bounded k-medoids on euclidean distance -> (medoid indices, cluster label per sample).
+
+    Deterministic: the first medoid is the sample closest to the mean, each
+    next one the sample farthest from the medoids so far; then at most
+    `iterations` assign/update rounds. k is capped at the number of distinct
+    samples (near-identical burst frames can have fewer), so no cluster starts empty.
+    """
+    x = np.asarray(encodings, dtype=np.float64)
+    k = min(k, len(np.unique(x, axis=0)))
+    gram = x @ x.T
+    sq = np.diag(gram)
+    distances = np.sqrt(np.maximum(sq[:, None] + sq[None, :] - 2 * gram, 0))
+
+    medoids = [int(np.argmin(np.linalg.norm(x - x.mean(axis=0), axis=1)))]
+    while len(medoids) < k:
+        medoids.append(int(np.argmax(distances[:, medoids].min(axis=1))))
+    medoids = np.array(medoids)
+
+    for _ in range(iterations):
+        labels = np.argmin(distances[:, medoids], axis=1)
+        updated = medoids.copy()
+        for j in range(k):
+            members = np.flatnonzero(labels == j)
+            if len(members):  # An emptied cluster keeps its medoid
+                updated[j] = members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+
+    return medoids, np.argmin(distances[:, medoids], axis=1)
+
+def build_template_set(encodings, k):
+    """(k, D) matrix of cluster means, largest cluster first"""
+    encodings = np.asarray(encodings)
+    medoids, labels = select_medoids(encodings, k)
+    sizes = np.bincount(labels, minlength=len(medoids))
+    order = [j for j in np.argsort(-sizes, kind='stable') if sizes[j]]
+    return np.stack([encodings[labels == j].mean(axis=0) for j in order])
+
+def score_template_set(templates, probe):
+    """compare_encodings(template, probe) for every row of a (k, D) template set -> (combined, euclidean, pixel) arrays"""
+    templates = np.asarray(templates, dtype=np.float64)
+    return score_rows(templates, *row_norms(templates), probe)
@@ -0,0 +1,317 @@
+"""
+Server-side face template store
+
+Templates live in one memory-mapped float32 matrix (templates.f32) with a small
+SQLite index (index.sqlite3) mapping user id -> row. Every worker process maps
+the same file, so the encodings are shared through the OS page cache with no
+copies on the login path. Adding, updating or removing a template touches one
+index row, whatever the size of the store.
+
+A row's values are never changed while a user owns it: a re-registration is
+written to a free row and the old row is released in the same transaction, and
+a released row is only reused by a later write. Every write bumps the store
+version and stamps the rows it touched with it, so a reader that copies a row
+(get) or scans the matrix (Gallery) can confirm afterwards that nothing it read
+was released in the meantime, and callers can ask which rows changed since a
+version instead of re-reading the whole index.
+
+Each template can also carry a sample weight (how many encodings were
+averaged into it), which lets fold() add new samples to the running mean
+without reprocessing the images the template was built from.
+"""
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager, closing
+import numpy as np
+
+INDEX_FILE = 'index.sqlite3'
+MATRIX_FILE = 'templates.f32'
+LEGACY_INDEX_FILE = 'index.json'  # JSON index written by earlier versions, migrated on open
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS store (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    dimension INTEGER NOT NULL,
+    capacity INTEGER NOT NULL,       -- rows the matrix file has room for
+    size INTEGER NOT NULL,           -- rows in use or released (the rest of the file is untouched)
+    count INTEGER NOT NULL,          -- templates stored
+    version INTEGER NOT NULL         -- bumped by every write
+);
+CREATE TABLE IF NOT EXISTS templates (
+    row INTEGER PRIMARY KEY,
+    user_id TEXT UNIQUE,             -- NULL: released, free for the next write
+    weight REAL,
+    version INTEGER NOT NULL         -- store version of the last change to this row
+);
+CREATE INDEX IF NOT EXISTS templates_version ON templates (version);
+"""
+
+def fold_mean(current, weight, sample_sum, sample_count, decay=1.0, max_weight=0):
+    """
+    Running-mean update -> (new template, new weight).
+
+    current is the mean of `weight` earlier samples; sample_sum/sample_count are
+    the new ones. decay < 1 discounts the earlier samples on every update, and
+    max_weight > 0 caps their total weight so newer samples keep counting.
+    """
+    sample_sum = np.asarray(sample_sum, dtype=np.float64)
+    if current is None or not weight:
+        return sample_sum / sample_count, float(sample_count)
+    weight = weight * decay
+    if max_weight:
+        weight = min(weight, max(max_weight - sample_count, 0))
+    total = weight + sample_count
+    return (np.asarray(current, dtype=np.float64) * weight + sample_sum) / total, float(total)
+
+def read_dimension(directory):
+    """Encoding dimension of an existing store directory (either index format)"""
+    index_path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(index_path):
+        with open(os.path.join(directory, LEGACY_INDEX_FILE)) as f:
+            return json.load(f)['dimension']
+    with closing(sqlite3.connect(index_path)) as db:
+        return db.execute('SELECT dimension FROM store').fetchone()[0]
+
+class TemplateStore:
+    """Memory-mapped (capacity, dimension) float32 matrix plus an id -> row index"""
+
+    def __init__(self, directory, dimension, initial_capacity=1024):
+        self.directory = directory
+        self.dimension = dimension
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.matrix_path = os.path.join(directory, MATRIX_FILE)
+
+        self._lock = threading.RLock()  # Writers in this process queue here instead of on the database lock
+        self._map_lock = threading.Lock()
+        self._local = threading.local()
+        self._matrix = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(SCHEMA)
+        with self._write() as db:
+            state = db.execute('SELECT dimension FROM store').fetchone()
+            if state is None:
+                self._initialize(db, initial_capacity)
+            elif state[0] != dimension:
+                raise ValueError(f"Template store has dimension {state[0]}, encoder produces {dimension}")
+
+    def _connect(self):
+        """This thread's connection (connections can't cross threads, or a fork)"""
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')  # Readers never wait for a writer
+            db.execute('PRAGMA synchronous=NORMAL')  # The matrix row is flushed before its index row commits
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @contextmanager
+    def _write(self):
+        """One write transaction; serializes writers across threads and worker processes"""
+        with self._lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    @contextmanager
+    def _read(self):
+        """One consistent read of the index (joins the caller's transaction if it holds one)"""
+        db = self._connect()
+        if db.in_transaction:
+            yield db
+            return
+        db.execute('BEGIN')
+        try:
+            yield db
+        finally:
+            db.execute('COMMIT')
+
+    @contextmanager
+    def locked(self):
+        """Hold off every writer (in any process) for the duration of the block"""
+        with self._write():
+            yield
+
+    def _initialize(self, db, capacity):
+        """Create the index, importing a JSON index left by an earlier version"""
+        legacy_path = os.path.join(self.directory, LEGACY_INDEX_FILE)
+        rows, weights, count = {}, {}, 0
+        if os.path.exists(legacy_path):
+            with open(legacy_path) as f:
+                legacy = json.load(f)
+            if legacy['dimension'] != self.dimension:
+                raise ValueError(f"Template store has dimension {legacy['dimension']}, "
+                                 f"encoder produces {self.dimension}")
+            rows, weights, count, capacity = legacy['rows'], legacy.get('weights', {}), legacy['count'], legacy['capacity']
+
+        self._resize_file(capacity)
+        db.executemany('INSERT INTO templates (row, user_id, weight, version) VALUES (?, ?, ?, 0)',
+                       [(row, key, weights.get(key)) for key, row in rows.items()])
+        db.execute('INSERT INTO store (id, dimension, capacity, size, count, version) VALUES (0, ?, ?, ?, ?, 0)',
+                   (self.dimension, capacity, count, count))
+        if rows:
+            os.replace(legacy_path, legacy_path + '.migrated')
+            print(f"[INFO] Template store index migrated from {LEGACY_INDEX_FILE}: {len(rows)} templates")
+
+    def _resize_file(self, capacity):
+        with open(self.matrix_path, 'ab') as f:
+            f.truncate(capacity * self.dimension * 4)
+
+    def _rows(self, needed, capacity=None):
+        """The mapped matrix, remapped first if it doesn't cover `needed` rows yet (the file only ever grows)"""
+        matrix = self._matrix
+        if matrix is None or len(matrix) < needed:
+            with self._map_lock:
+                if self._matrix is None or len(self._matrix) < needed:
+                    if capacity is None:
+                        capacity = self._connect().execute('SELECT capacity FROM store').fetchone()[0]
+                    self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r+',
+                                             shape=(capacity, self.dimension))
+                matrix = self._matrix
+        return matrix
+
+    def _lookup(self, user_id):
+        return self._connect().execute('SELECT row, version, weight FROM templates WHERE user_id = ?',
+                                       (str(user_id),)).fetchone()
+
+    @property
+    def version(self):
+        """Changes whenever any process writes the store; lets callers cache derived data"""
+        return self._connect().execute('SELECT version FROM store').fetchone()[0]
+
+    def __len__(self):
+        return self._connect().execute('SELECT count FROM store').fetchone()[0]
+
+    def __contains__(self, user_id):
+        return self._lookup(user_id) is not None
+
+    def get(self, user_id):
+        """Copy of the template for user_id as float32, or None"""
+        entry = self._lookup(user_id)
+        while entry is not None:
+            row, version, _ = entry
+            template = np.array(self._rows(row + 1)[row])
+            # The row can't have changed unless this user's index entry did too
+            entry, previous = self._lookup(user_id), entry
+            if entry == previous:
+                return template
+        return None
+
+    def weight(self, user_id):
+        """Number of samples averaged into the template, or None if unknown"""
+        entry = self._lookup(user_id)
+        return None if entry is None else entry[2]
+
+    def put(self, user_id, encoding, weight=None):
+        """Insert or replace the template for user_id (weight = samples averaged into it), returns its row"""
+        encoding = np.asarray(encoding, dtype=np.float32)
+        if encoding.shape != (self.dimension,):
+            raise ValueError(f"Encoding must have {self.dimension} values, got {encoding.size}")
+
+        with self._write() as db:
+            return self._put_locked(db, str(user_id), encoding, weight)
+
+    def fold(self, user_id, sample_sum, sample_count, decay=1.0, max_weight=0, default_weight=None):
+        """
+        Add sample_count new encodings (given as their sum) to user_id's running mean.
+
+        A template without a recorded weight counts as default_weight samples.
+        Returns (new template as float32, new weight), or None if user_id has no template.
+        """
+        sample_sum = np.asarray(sample_sum, dtype=np.float64)
+        if sample_sum.shape != (self.dimension,):
+            raise ValueError(f"Encoding must have {self.dimension} values, got {sample_sum.size}")
+
+        with self._write() as db:
+            key = str(user_id)
+            entry = db.execute('SELECT row, weight FROM templates WHERE user_id = ?', (key,)).fetchone()
+            if entry is None:
+                return None
+            current = self._rows(entry[0] + 1)[entry[0]]
+            weight = default_weight if entry[1] is None else entry[1]
+            encoding, weight = fold_mean(current, weight, sample_sum, sample_count, decay, max_weight)
+            encoding = encoding.astype(np.float32)
+            self._put_locked(db, key, encoding, weight)
+        return encoding, weight
+
+    def _put_locked(self, db, key, encoding, weight):
+        """Write the template to a free row, then point the index at it; caller holds the write transaction"""
+        capacity, size, version = db.execute('SELECT capacity, size, version FROM store').fetchone()
+        version += 1
+        old = db.execute('SELECT row FROM templates WHERE user_id = ?', (key,)).fetchone()
+        free = db.execute('SELECT row FROM templates WHERE user_id IS NULL ORDER BY row LIMIT 1').fetchone()
+        if free is not None:
+            row = free[0]
+        else:
+            row, size = size, size + 1
+            if size > capacity:
+                # Double the backing file; readers remap when they first need a row past their mapping
+                capacity *= 2
+                self._resize_file(capacity)
+
+        matrix = self._rows(row + 1, capacity)
+        matrix[row] = encoding
+        matrix.flush()  # On disk before the index points at it
+
+        if old is not None:
+            db.execute('UPDATE templates SET user_id = NULL, weight = NULL, version = ? WHERE row = ?',
+                       (version, old[0]))
+        db.execute('INSERT OR REPLACE INTO templates (row, user_id, weight, version) VALUES (?, ?, ?, ?)',
+                   (row, key, None if weight is None else float(weight), version))
+        db.execute('UPDATE store SET capacity = ?, size = ?, count = count + ?, version = ?',
+                   (capacity, size, int(old is None), version))
+        return row
+
+    def delete(self, user_id):
+        """Remove a template; its row is released for the next write"""
+        with self._write() as db:
+            entry = db.execute('SELECT row FROM templates WHERE user_id = ?', (str(user_id),)).fetchone()
+            if entry is None:
+                return False
+            version = db.execute('SELECT version FROM store').fetchone()[0] + 1
+            db.execute('UPDATE templates SET user_id = NULL, weight = NULL, version = ? WHERE row = ?',
+                       (version, entry[0]))
+            db.execute('UPDATE store SET count = count - 1, version = ?', (version,))
+        return True
+
+    def rows_view(self):
+        """
+        (version, ids, matrix) without copying: ids[row] is the owner of each
+        matrix row, or None for a released one; matrix is a read-only view.
+
+        Rows read from the view are only valid if no row owned at this version
+        has changed since, i.e. changes(version) reports none of them.
+        """
+        with self._read() as db:
+            version, size = db.execute('SELECT version, size FROM store').fetchone()
+            ids = [None] * size
+            for row, key in db.execute('SELECT row, user_id FROM templates WHERE user_id IS NOT NULL'):
+                ids[row] = key
+        return version, ids, self.matrix_view(size)
+
+    def matrix_view(self, size):
+        """Read-only view of the first `size` matrix rows (size as reported by rows_view or changes)"""
+        matrix = self._rows(size)[:size].view(np.ndarray)
+        matrix.flags.writeable = False
+        return matrix
+
+    def changes(self, since):
+        """(version, size, {row: owner or None}) for rows written or released after version `since`"""
+        with self._read() as db:
+            version, size = db.execute('SELECT version, size FROM store').fetchone()
+            changed = dict(db.execute('SELECT row, user_id FROM templates WHERE version > ?', (since,)))
+        return version, size, changed
+
+    def snapshot(self):
+        """(ids, matrix) copy of every stored template, taken with writers held off; matrix is ordered like ids"""
+        with self.locked():
+            _, ids, matrix = self.rows_view()
+            rows = [row for row, key in enumerate(ids) if key is not None]
+            return [ids[row] for row in rows], matrix[rows]
@@ -0,0 +1,1231 @@
+"""
+Offline checks for the face encoding pipeline (no webcam or running server needed)
+Run directly (python test_encoding.py) or with pytest
+"""
+import time
+import cv2
+import numpy as np
+import sys
+import os
+import tempfile
+import io
+import json
+import base64
+import sqlite3
+import signal
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Add parent directory to path to import app_simple functions
+sys.path.insert(0, os.path.dirname(__file__))
+
+import app_simple
+import registration_pool
+import serve
+from app_simple import IMAGE_SIZE, ENCODER_TOLERANCE, augment_image, compare_encodings
+from face_encoder import FaceEncoder, compute_lbp_uniform, compute_grid_features, encoding_deviation
+from template_store import TemplateStore, fold_mean
+from gallery import Gallery, pairwise_scores, row_norms
+from template_codec import pack_template, template_to_text, load_template
+from template_set import build_template_set, score_template_set
+from find_duplicates import find_duplicate_pairs
+from registration_jobs import RegistrationJobs, QueueFull
+from face_cache import FaceCache, content_key
+from face_tracker import FaceTracker
+from face_detectors import create_detector
+import fetch_models
+from calibrate_thresholds import score_pairs, sweep
+from service_metrics import ServiceMetrics
+
+def skip(reason):
+    """Skip the calling test: pytest.skip under pytest, a note when this file is run directly"""
+    if 'pytest' in sys.modules:
+        sys.modules['pytest'].skip(reason)
+    print(f"  - skipped: {reason}")
+
+def make_test_faces(count=6, seed=0):
+    """Build deterministic 200x200 RGB images: noise, gradients and a drawn face"""
+    rng = np.random.default_rng(seed)
+    h, w = IMAGE_SIZE[1], IMAGE_SIZE[0]
+    faces = []
+
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            img = rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+        elif kind == 1:
+            yy, xx = np.mgrid[0:h, 0:w]
+            base = (xx * (1 + i) + yy * 2) % 256
+            noise = rng.integers(0, 12, size=(h, w))
+            img = np.clip(base + noise, 0, 255).astype(np.uint8)
+            img = np.dstack([img, np.roll(img, 7, axis=0), np.roll(img, 13, axis=1)])
+        else:
+            img = np.full((h, w, 3), 60 + 10 * i, dtype=np.uint8)
+            cv2.ellipse(img, (w // 2, h // 2), (70, 90), 0, 0, 360, (200, 170, 150), -1)
+            cv2.circle(img, (70, 80), 12, (40, 40, 40), -1)
+            cv2.circle(img, (130, 80), 12, (40, 40, 40), -1)
+            cv2.ellipse(img, (100, 145), (30, 10), 0, 0, 180, (120, 60, 60), 3)
+            img = cv2.GaussianBlur(img, (5, 5), 1.0)
+        faces.append(img)
+
+    return faces
+
+class MarkerDetector:
+    """Stand-in face detector: each connected patch of pure white pixels is a face; records every frame shape"""
+    name = 'marker'
+
+    def __init__(self):
+        self.shapes = []
+
+    def detect(self, gray, min_neighbors=6, min_size=(80, 80)):
+        self.shapes.append(gray.shape[:2])
+        count, _, stats, _ = cv2.connectedComponentsWithStats((gray == 255).astype(np.uint8), connectivity=8)
+        # Label order is raster order (top-most first), not size order
+        return [tuple(int(v) for v in stats[label, :4]) for label in range(1, count)]
+
+def marker_frame(box, shape=(480, 640)):
+    """Gray frame with one white (x, y, w, h) "face" for MarkerDetector"""
+    gray = np.full(shape, 90, dtype=np.uint8)
+    x, y, w, h = box
+    gray[y:y + h, x:x + w] = 255
+    return gray
+
+def framed_face(x, y, size=160, shape=(480, 640)):
+    """RGB frame with a textured face inside a white outline, which MarkerDetector reports as the box"""
+    image = np.full((*shape, 3), 90, dtype=np.uint8)
+    image[y:y + size, x:x + size] = np.minimum(cv2.resize(make_test_faces(3)[2], (size, size)), 254)
+    cv2.rectangle(image, (x, y), (x + size - 1, y + size - 1), (255, 255, 255), 1)
+    return image
+
+def reference_lbp(img):
+    """Original per-pixel LBP loop, kept as the parity reference"""
+    lbp = np.zeros_like(img)
+    for i in range(1, img.shape[0]-1):
+        for j in range(1, img.shape[1]-1):
+            center = img[i, j]
+            code = 0
+            code |= (img[i-1, j-1] >= center) << 7
+            code |= (img[i-1, j] >= center) << 6
+            code |= (img[i-1, j+1] >= center) << 5
+            code |= (img[i, j+1] >= center) << 4
+            code |= (img[i+1, j+1] >= center) << 3
+            code |= (img[i+1, j] >= center) << 2
+            code |= (img[i+1, j-1] >= center) << 1
+            code |= (img[i, j-1] >= center) << 0
+            lbp[i, j] = code
+    return lbp
+
+def reference_grid_features(gray, grid_size=16):
+    """Original per-cell grid statistics loop, kept as the parity reference"""
+    h, w = gray.shape
+    grid_h, grid_w = h // grid_size, w // grid_size
+    grid_features = []
+    for i in range(grid_size):
+        for j in range(grid_size):
+            cell = gray[i*grid_h:(i+1)*grid_h, j*grid_w:(j+1)*grid_w]
+            if cell.size > 0:
+                grid_features.append(np.mean(cell) / 255.0)
+                grid_features.append(np.std(cell) / 255.0)
+                grid_features.append(np.median(cell) / 255.0)
+    return np.array(grid_features)
+
+def reference_create_face_encoding(face_img):
+    """create_face_encoding as it was before vectorization"""
+    gray = cv2.cvtColor(face_img, cv2.COLOR_RGB2GRAY)
+    gray = cv2.equalizeHist(gray)
+
+    hist_full = cv2.calcHist([gray], [0], None, [64], [0, 256])
+    hist_full = hist_full.flatten() / (gray.shape[0] * gray.shape[1])
+
+    h, w = gray.shape
+    h2, w2 = h//2, w//2
+    hist_tl = cv2.calcHist([gray[:h2, :w2]], [0], None, [32], [0, 256]).flatten()
+    hist_tr = cv2.calcHist([gray[:h2, w2:]], [0], None, [32], [0, 256]).flatten()
+    hist_bl = cv2.calcHist([gray[h2:, :w2]], [0], None, [32], [0, 256]).flatten()
+    hist_br = cv2.calcHist([gray[h2:, w2:]], [0], None, [32], [0, 256]).flatten()
+    hist_spatial = np.concatenate([hist_tl, hist_tr, hist_bl, hist_br])
+    hist_spatial = hist_spatial / (hist_spatial.sum() + 1e-7)
+
+    lbp = reference_lbp(gray)
+    lbp_hist = np.histogram(lbp, bins=64, range=(0, 256))[0]
+    lbp_hist = lbp_hist / (lbp_hist.sum() + 1e-7)
+
+    grid_features = reference_grid_features(gray, 16)
+
+    sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
+    sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
+    magnitude = np.sqrt(sobelx**2 + sobely**2)
+    orientation = np.arctan2(sobely, sobelx)
+    orient_hist = np.histogram(orientation, bins=32, range=(-np.pi, np.pi), weights=magnitude)[0]
+    orient_hist = orient_hist / (orient_hist.sum() + 1e-7)
+
+    gabor_features = []
+    for theta in [0, np.pi/4, np.pi/2, 3*np.pi/4]:
+        kernel = cv2.getGaborKernel((21, 21), 5, theta, 10, 0.5, 0, ktype=cv2.CV_32F)
+        filtered = cv2.filter2D(gray, cv2.CV_64F, kernel)
+        gabor_features.append(np.mean(np.abs(filtered)) / 255.0)
+        gabor_features.append(np.std(filtered) / 255.0)
+
+    small_face = cv2.resize(gray, (20, 20))
+    pixel_features = small_face.flatten() / 255.0
+
+    encoding = np.concatenate([
+        hist_full, hist_spatial, lbp_hist, grid_features,
+        orient_hist, np.array(gabor_features), pixel_features
+    ])
+    norm = np.linalg.norm(encoding)
+    if norm > 1e-7:
+        encoding = encoding / norm
+    return encoding
+
+def test_lbp_matches_reference():
+    for face in make_test_faces():
+        gray = cv2.equalizeHist(cv2.cvtColor(face, cv2.COLOR_RGB2GRAY))
+        assert np.array_equal(compute_lbp_uniform(gray), reference_lbp(gray))
+
+def test_grid_features_bit_identical():
+    for face in make_test_faces():
+        gray = cv2.equalizeHist(cv2.cvtColor(face, cv2.COLOR_RGB2GRAY))
+        expected = reference_grid_features(gray)
+        actual = compute_grid_features(gray)
+        assert actual.dtype == expected.dtype
+        assert actual.tobytes() == expected.tobytes()
+
+def test_encoding_bit_identical():
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float64)
+    for face in make_test_faces():
+        expected = reference_create_face_encoding(face)
+        actual = encoder.encode(face)
+        assert actual.shape == expected.shape == (encoder.dimension,)
+        assert actual.tobytes() == expected.tobytes()
+
+def test_float32_encoder_within_tolerance():
+    reference = FaceEncoder(IMAGE_SIZE, dtype=np.float64)
+    faces = make_test_faces()
+    for use_cv2_gradients in (False, True):
+        encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32, use_cv2_gradients=use_cv2_gradients)
+        assert encoder.encode(faces[0]).dtype == np.float32
+        assert encoding_deviation(encoder, reference, faces) <= ENCODER_TOLERANCE
+
+def test_encoder_falls_back_to_float64_past_tolerance():
+    # The default is the exact encoder
+    assert app_simple.encoder.dtype == np.float64 and app_simple.encoder_deviation == 0.0
+
+    saved = app_simple.ENCODER_DTYPE, app_simple.ENCODER_CV2_GRADIENTS, app_simple.ENCODER_TOLERANCE
+    try:
+        app_simple.ENCODER_DTYPE, app_simple.ENCODER_TOLERANCE = 'float32', 0.01
+        encoder, deviation = app_simple.load_encoder()
+        assert encoder.dtype == np.float32 and 0 < deviation <= 0.01
+
+        # Opted in, but drifting past the tolerance: refused in favour of float64
+        app_simple.ENCODER_DTYPE, app_simple.ENCODER_TOLERANCE = 'float32', 0.0
+        encoder, deviation = app_simple.load_encoder()
+        assert encoder.dtype == np.float64 and deviation == 0.0 and app_simple.ENCODER_DTYPE == 'float64'
+    finally:
+        app_simple.ENCODER_DTYPE, app_simple.ENCODER_CV2_GRADIENTS, app_simple.ENCODER_TOLERANCE = saved
+
+def test_batch_matches_single():
+    faces = make_test_faces()
+    for dtype in (np.float64, np.float32):
+        encoder = FaceEncoder(IMAGE_SIZE, dtype=dtype)
+        batch = encoder.encode_batch(np.stack(faces))
+        assert batch.shape == (len(faces), encoder.dimension)
+        for row, face in zip(batch, faces):
+            assert row.tobytes() == encoder.encode(face).tobytes()
+
+        grays = np.stack([cv2.cvtColor(face, cv2.COLOR_RGB2GRAY) for face in faces])
+        assert encoder.encode_batch(grays).tobytes() == batch.tobytes()
+
+def test_gallery_matches_compare_encodings():
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+    encodings = encoder.encode_batch(np.stack(make_test_faces(9)))
+    with tempfile.TemporaryDirectory() as directory:
+        store = TemplateStore(directory, encoder.dimension, initial_capacity=4)
+        for i, encoding in enumerate(encodings):
+            store.put(f'user{i}', encoding)
+        gallery = Gallery(store, ivf_min_size=0)
+
+        for probe in encodings[:3]:
+            candidates, info = gallery.search(probe, len(encodings), -1, 10, -1)
+            assert info['scanned'] == len(encodings)
+            for candidate in candidates:
+                expected = compare_encodings(store.get(candidate['user_id']), probe)
+                assert abs(candidate['similarity'] - expected[0]) < 1e-5
+                assert abs(candidate['pixel_similarity'] - expected[2]) < 1e-5
+                # Distance comes from norms and dot products, float32 rounding shows up only near 0
+                assert abs(candidate['distance'] - expected[1]) < 1e-3
+
+        # Several probes in one product give the same candidates as one search each
+        batch, _ = gallery.search_batch(encodings[:3], 4, 0.5, 1.0, 0.5)
+        for probe, candidates in zip(encodings[:3], batch):
+            single, _ = gallery.search(probe, 4, 0.5, 1.0, 0.5)
+            assert [c['user_id'] for c in candidates] == [c['user_id'] for c in single]
+            assert np.allclose([c['similarity'] for c in candidates], [c['similarity'] for c in single])
+
+        # A re-registered template is picked up on the next search
+        store.put('user0', encodings[5])
+        candidates, _ = gallery.search(encodings[5], 2, 0.999, 0.01, 0.999)
+        assert sorted(c['user_id'] for c in candidates) == ['user0', 'user5']
+
+        # Deleted templates drop out, and their released rows never match
+        store.delete('user5')
+        candidates, info = gallery.search(encodings[5], 2, 0.999, 0.01, 0.999)
+        assert [c['user_id'] for c in candidates] == ['user0'] and info['gallery_size'] == len(encodings) - 1
+
+        # The incrementally updated state (norms, IVF assignments) equals a rebuild from scratch
+        indexed = Gallery(store, ivf_min_size=1, ivf_lists=3)
+        indexed.search(encodings[0], 1, -1, 10, -1)
+        store.put('user9', encodings[5])  # Reuses the row released above
+        store.put('user10', encodings[6])  # Appended past the old capacity
+        version, ids, live, matrix, feature_sq, pixel_sq, index = indexed._refresh()
+        expected_version, expected_ids, expected_matrix = store.rows_view()
+        assert version == expected_version and ids == expected_ids
+        assert np.array_equal(live, [key is not None for key in expected_ids])
+        expected_feature_sq, expected_pixel_sq = row_norms(expected_matrix)
+        assert np.array_equal(feature_sq[live], expected_feature_sq[live])
+        assert np.array_equal(pixel_sq[live], expected_pixel_sq[live])
+        assert np.array_equal(index.assignments[live], index._nearest(expected_matrix)[live])
+
+def test_template_store_rows_and_changes():
+    encodings = np.random.default_rng(0).random((6, 32), dtype=np.float32)
+    with tempfile.TemporaryDirectory() as directory:
+        store = TemplateStore(directory, 32, initial_capacity=2)
+        for i in range(4):
+            store.put(f'user{i}', encodings[i], weight=i + 1)
+        version = store.version
+
+        # get() hands out a copy: later writes to the store never change it
+        before = store.get('user1')
+        store.put('user1', encodings[4])
+        store.delete('user2')
+        store.put('user9', encodings[5])
+        assert before.tobytes() == encodings[1].tobytes() and before.flags.writeable
+        assert store.get('user1').tobytes() == encodings[4].tobytes() and store.weight('user1') is None
+        assert store.get('user2') is None and 'user2' not in store and len(store) == 4
+
+        # Rows touched since a version: user1 moved to a free row, user2's row was released and reused
+        now, size, changed = store.changes(version)
+        _, ids, matrix = store.rows_view()
+        assert now == store.version and size == len(ids) == 5
+        assert {key for key in changed.values() if key} == {'user1', 'user9'} and None in changed.values()
+        assert all(ids[row] == key for row, key in changed.items())
+        for row, key in enumerate(ids):
+            if key is not None:
+                assert matrix[row].tobytes() == store.get(key).tobytes()
+
+        ids, matrix = store.snapshot()
+        assert sorted(ids) == ['user0', 'user1', 'user3', 'user9'] and len(matrix) == 4
+
+    # A store written by the JSON index version is migrated on open
+    with tempfile.TemporaryDirectory() as directory:
+        encodings[:2].tofile(os.path.join(directory, 'templates.f32'))
+        with open(os.path.join(directory, 'index.json'), 'w') as f:
+            json.dump({'dimension': 32, 'capacity': 2, 'count': 2, 'rows': {'a': 0, 'b': 1}, 'weights': {'b': 7}}, f)
+        store = TemplateStore(directory, 32)
+        assert store.get('b').tobytes() == encodings[1].tobytes() and store.weight('b') == 7 and len(store) == 2
+
+def test_pairwise_scores_match_compare_encodings():
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+    encodings = encoder.encode_batch(np.stack(make_test_faces(6)))
+    combined, distance, pixel = pairwise_scores(encodings)
+    assert np.allclose(combined, combined.T) and np.allclose(np.diag(distance), 0)
+    for i in range(len(encodings)):
+        for j in range(len(encodings)):
+            expected = compare_encodings(encodings[i], encodings[j])
+            assert np.allclose((combined[i, j], pixel[i, j]), (expected[0], expected[2]), atol=1e-6)
+            # Same float cancellation near zero as the gallery test
+            assert abs(distance[i, j] - expected[1]) < 1e-3
+
+def test_compare_batch_endpoint_items_and_nulls():
+    client = app_simple.app.test_client()
+    # The item count is checked before anything is decoded
+    for images, templates in ((['x'], []), ([], ['t']), (['x'] * app_simple.COMPARE_BATCH_MAX_ITEMS, ['t'])):
+        response = client.post('/compare-batch', json={'images': images, 'templates': templates})
+        assert response.status_code == 400 and 'between 2 and' in response.get_json()['error']
+
+    def png(image):
+        return base64.b64encode(cv2.imencode('.png', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1]).decode()
+
+    saved = app_simple.face_detector
+    try:
+        app_simple.face_detector = MarkerDetector()
+        face = framed_face(200, 150)
+        template = app_simple.frame_encoding(app_simple.load_frame(png(face), False))
+        encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+        template_set = build_template_set(encoder.encode_batch(np.stack(make_test_faces(6))), 3)
+        response = client.post('/compare-batch', json={
+            'images': [png(face), png(framed_face(100, 60, size=200)), png(np.full((480, 640, 3), 90, np.uint8))],
+            'templates': [template_to_text(template, 'float32'), template_to_text(template_set, 'float32')],
+            'cache': False
+        })
+    finally:
+        app_simple.face_detector = saved
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [(item['type'], item['index']) for item in body['items']] == \
+        [('image', 0), ('image', 1), ('image', 2), ('template', 0), ('template', 1)]
+    assert [item['error'] is None for item in body['items']] == [True, True, False, True, False]
+    assert body['items'][2]['error'] == 'No face detected in the image'
+    assert 'Template sets' in body['items'][4]['error']
+
+    # Failed items keep a null row and column; every other cell is filled
+    usable = (0, 1, 3)
+    for name in ('similarity', 'distance', 'pixel_similarity', 'match'):
+        matrix = body[name]
+        assert len(matrix) == 5 and all(len(row) == 5 for row in matrix)
+        for i in range(5):
+            for j in range(5):
+                assert (matrix[i][j] is None) == (i not in usable or j not in usable), (name, i, j)
+    for i in usable:
+        assert body['similarity'][i][i] > 0.999 and body['match'][i][i] is True
+    # The image and the template made from it match, symmetrically
+    assert body['match'][0][3] is True and body['similarity'][0][3] == body['similarity'][3][0]
+
+def test_template_codec_round_trip():
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+    encoding = encoder.encode(make_test_faces(1)[0])
+
+    packed = pack_template(encoding, 'float32')
+    assert len(packed) == 12 + 4 * encoder.dimension
+    assert load_template(packed, encoder.dimension).tobytes() == encoding.tobytes()
+    assert load_template(template_to_text(encoding, 'float32')).tobytes() == encoding.tobytes()
+
+    # float16 halves the payload; matching scores move by far less than the threshold margins
+    half = load_template(template_to_text(encoding, 'float16'), encoder.dimension)
+    assert np.linalg.norm(half - encoding) < 1e-3
+
+    # Legacy JSON arrays still load unchanged
+    legacy = encoding.astype(np.float64).tolist()
+    assert load_template(legacy).tolist() == legacy
+    assert load_template(json.dumps(legacy)).tolist() == legacy
+
+    for bad in ('not a template', pack_template(encoding)[:-2], [0.0, 1.0]):
+        try:
+            load_template(bad, encoder.dimension)
+        except ValueError:
+            continue
+        raise AssertionError(f"accepted invalid template {bad!r:.40}")
+
+def test_staged_verification_matches_full():
+    faces = [aug for face in make_test_faces(6, seed=3) for aug in augment_image(face)]
+    grays = [cv2.cvtColor(face, cv2.COLOR_RGB2GRAY) for face in faces]
+    encodings = app_simple.encoder.encode_batch(np.stack(grays))
+    stored = [encodings[i:i+7].mean(axis=0) for i in range(0, len(encodings), 7)]
+
+    early_rejects = 0
+    configured = app_simple.VERIFY_EARLY_REJECT
+    try:
+        for template in stored:
+            for gray in grays:
+                app_simple.VERIFY_EARLY_REJECT = True
+                staged = app_simple.verify_staged(template, gray)
+                app_simple.VERIFY_EARLY_REJECT = False
+                full = app_simple.verify_staged(template, gray)
+                assert staged['match'] == full['match']
+                early_rejects += staged['decided_by'] == 'pixel_block'
+    finally:
+        app_simple.VERIFY_EARLY_REJECT = configured
+    assert early_rejects > 0
+
+def test_enrollment_fold_matches_full_average():
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+    encodings = encoder.encode_batch(np.stack([aug for face in make_test_faces(4) for aug in augment_image(face)]))
+    first, rest = encodings[:14], encodings[14:]
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = TemplateStore(directory, encoder.dimension)
+        store.put('user', first.mean(axis=0), weight=len(first))
+        folded, weight = store.fold('user', rest.sum(axis=0, dtype=np.float64), len(rest))
+        assert weight == len(encodings) == store.weight('user')
+        assert np.allclose(folded, encodings.mean(axis=0), atol=1e-6)
+        assert store.get('user').tobytes() == folded.tobytes()
+
+    # decay halves the old samples' say; max_weight caps it
+    _, weight = fold_mean(first.mean(axis=0), len(first), rest.sum(axis=0), len(rest), decay=0.5)
+    assert weight == len(first) / 2 + len(rest)
+    _, weight = fold_mean(first.mean(axis=0), len(first), rest.sum(axis=0), len(rest), max_weight=20)
+    assert weight == 20
+
+def test_enroll_update_requires_matching_faces():
+    faces = make_test_faces(6, seed=5)
+    encodings = app_simple.encoder.encode_batch(np.stack(augment_image(faces[2])))
+    prepare = app_simple.prepare_registration_image
+    store = app_simple.template_store
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            # Images are indexes into faces, "detected" without a detector
+            app_simple.prepare_registration_image = lambda image: (augment_image(faces[int(image)]), None)
+            app_simple.template_store = TemplateStore(directory, app_simple.encoder.dimension)
+            app_simple.template_store.put('user', encodings.mean(axis=0), weight=len(encodings))
+            client = app_simple.app.test_client()
+
+            response = client.post('/enroll-update', json={'images': ['2'], 'user_id': 'nobody'})
+            assert response.status_code == 404 and 'nobody' not in app_simple.template_store
+
+            # Malformed numbers are the client's error, not a 500
+            for fields in ({'decay': 'fast'}, {'decay': 0}, {'max_weight': -1},
+                           {'stored_encoding': encodings[0].tolist(), 'sample_count': 'many'}):
+                response = client.post('/enroll-update', json={'images': ['2'], 'user_id': 'user', **fields})
+                assert response.status_code == 400, fields
+
+            response = client.post('/enroll-update', json={'images': ['2', '3'], 'user_id': 'user'})
+            assert response.status_code == 403 and [m['image'] for m in response.get_json()['mismatched']] == [2]
+            assert app_simple.template_store.weight('user') == len(encodings)
+
+            response = client.post('/enroll-update', json={'images': ['2'], 'user_id': 'user'})
+            assert response.status_code == 200 and response.get_json()['sample_count'] == 2 * len(encodings)
+        finally:
+            app_simple.prepare_registration_image = prepare
+            app_simple.template_store = store
+
+def test_identify_rejects_bad_numbers():
+    client = app_simple.app.test_client()
+    # Checked before the image is decoded, so any image will do
+    for top_k in ('abc', 0, -3, 2.5, True, None):
+        response = client.post('/identify-face', json={'image': 'x', 'top_k': top_k})
+        assert response.status_code == 400 and 'top_k' in response.get_json()['error'], top_k
+    response = client.post('/identify-face?top_k=many', data=b'x', content_type='application/octet-stream')
+    assert response.status_code == 400
+    for fields in ({'top_k': 'abc'}, {'top_k': -1}, {'max_faces': 'all'}, {'max_faces': 0}, {'max_faces': -2}):
+        response = client.post('/identify-faces', json={'image': 'x', **fields})
+        assert response.status_code == 400 and list(fields)[0] in response.get_json()['error'], fields
+
+    store = app_simple.template_store
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            app_simple.template_store = TemplateStore(directory, app_simple.encoder.dimension)
+            response = client.put('/templates/someone', json={'encoding': [0.0], 'weight': 'heavy'})
+            assert response.status_code == 400 and 'weight' in response.get_json()['error']
+        finally:
+            app_simple.template_store = store
+
+def test_identify_faces_per_face_matches():
+    faces = make_test_faces(5)
+    # (x, y, size, face index): two enrolled users, one stranger and one face below MIN_FACE_SIZE
+    layout = {'alice': (20, 40, 100, 2), 'bob': (200, 30, 180, 1), 'stranger': (420, 250, 140, 0),
+              'tiny': (40, 380, 60, 4)}
+    image = np.full((480, 640, 3), 90, dtype=np.uint8)
+    for x, y, size, index in layout.values():
+        image[y:y + size, x:x + size] = np.minimum(cv2.resize(faces[index], (size, size)), 254)
+        cv2.rectangle(image, (x, y), (x + size - 1, y + size - 1), (255, 255, 255), 1)
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    png = cv2.imencode('.png', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].tobytes()
+
+    def box(name):
+        x, y, size, _ = layout[name]
+        return {'x': x, 'y': y, 'width': size, 'height': size}
+
+    saved = app_simple.face_detector, app_simple.template_store, app_simple.gallery
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            app_simple.face_detector = MarkerDetector()
+            app_simple.template_store = TemplateStore(directory, app_simple.encoder.dimension)
+            app_simple.gallery = None
+            for user_id in ('alice', 'bob'):
+                x, y, size, _ = layout[user_id]
+                face_img, _, error = app_simple.crop_face(image, gray, (x, y, size, size))
+                assert error is None
+                app_simple.template_store.put(user_id, app_simple.create_face_encodings([face_img])[0])
+
+            client = app_simple.app.test_client()
+            everyone = client.post('/identify-faces', data=png, content_type='image/png')
+            capped = client.post('/identify-faces?max_faces=2&top_k=1', data=png, content_type='image/png')
+        finally:
+            app_simple.face_detector, app_simple.template_store, app_simple.gallery = saved
+
+    # Largest face first, whatever order the detector reported them in
+    assert everyone.status_code == 200
+    body = everyone.get_json()
+    assert body['face_count'] == body['faces_processed'] == 4 and body['identified'] == 2
+    results = body['faces']
+    assert [result['box'] for result in results] == [box(name) for name in ('bob', 'stranger', 'alice', 'tiny')]
+    assert [result['user_id'] for result in results] == ['bob', None, 'alice', None]
+    assert [result['match'] for result in results] == [True, False, True, False]
+    for result in (results[0], results[2]):
+        assert result['candidates'][0]['user_id'] == result['user_id'] and result['error'] is None
+        assert result['candidates'][0]['similarity'] > 0.99
+    assert results[1]['error'] is None and results[1]['candidates'] == []
+    assert results[3]['error'] == 'Face too small or too far from camera' and results[3]['candidates'] == []
+    assert body['search']['gallery_size'] == 2
+
+    # max_faces keeps the largest faces; the rest are counted but not identified
+    assert capped.status_code == 200
+    body = capped.get_json()
+    assert body['face_count'] == 4 and body['faces_processed'] == 2 and body['identified'] == 1
+    assert [result['box'] for result in body['faces']] == [box('bob'), box('stranger')]
+    assert [len(result['candidates']) for result in body['faces']] == [1, 0]
+
+def test_registration_jobs_claim_requeue_and_queue_full():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'jobs.sqlite3')
+        jobs = RegistrationJobs(path, run_job=None, workers=1, max_queued=2, stale_seconds=60)
+        other = RegistrationJobs(path, run_job=None, workers=1, max_queued=2, stale_seconds=60)  # Another process
+        jobs.start = other.start = lambda: None  # Claims are driven by hand below
+
+        first, position = jobs.submit([b'a', b'b'], 'user1')
+        assert position == 1
+        second, position = other.submit([b'c'], 'user2', template_set_size=3)
+        assert position == 2
+        try:
+            jobs.submit([b'd'], 'user3')
+            assert False, 'third job should not fit the queue'
+        except QueueFull:
+            pass
+
+        # Oldest first; the worker limit holds across processes sharing the database
+        assert jobs._claim() == (first, 'user1', None)
+        assert jobs.get(first)['status'] == 'running' and jobs.get(second)['queue_position'] == 1
+        assert jobs._claim() is None and other._claim() is None
+
+        # A running job whose heartbeat went stale is taken over by any process
+        with closing(sqlite3.connect(path)) as db, db:
+            db.execute('UPDATE jobs SET updated_at = updated_at - 120 WHERE id = ?', (first,))
+        assert other._claim() == (first, 'user1', None)
+
+        jobs._finish(first, {'success': True}, ok=True)
+        assert jobs.get(first)['status'] == 'done' and jobs.get(first)['result'] == {'success': True}
+        assert other._claim() == (second, 'user2', 3)
+
+def test_registration_pool_order_recovery_and_fallback():
+    faces = make_test_faces(6)
+    images = [str(i) for i in range(len(faces))]
+    saved = (registration_pool.REGISTRATION_WORKERS, registration_pool._pool, registration_pool._prepare_image,
+             registration_pool.get_pool, app_simple.prepare_registration_image)
+    try:
+        # REGISTRATION_WORKERS=1: everything runs in the request thread, the pool is never created
+        registration_pool.REGISTRATION_WORKERS = 1
+        def no_pool(ready=None):
+            raise AssertionError('pool used with REGISTRATION_WORKERS=1')
+        registration_pool.get_pool = no_pool
+        app_simple.prepare_registration_image = lambda image: ([faces[int(image)]], None)
+        progress = []
+        batch, valid, errors, _ = app_simple.prepare_faces(images, lambda *args: progress.append(args))
+        assert valid == len(faces) and errors == [] and progress[-1] == ('preparing', 6, 6)
+        registration_pool.start()
+        encodings = app_simple.encode_face_batch(batch)
+        assert np.array_equal(encodings, app_simple.create_face_encodings(faces))
+        registration_pool.get_pool = saved[3]
+
+        # Results come back in input order even when later images finish first
+        registration_pool.REGISTRATION_WORKERS = 4
+        def slow_first(image):
+            time.sleep(0.01 * (len(images) - int(image)))
+            return int(image)
+        registration_pool._prepare_image = slow_first
+        with ThreadPoolExecutor(4) as threads:
+            registration_pool._pool = threads
+            assert registration_pool.prepare_images(images) == list(range(len(images)))
+        registration_pool._prepare_image = saved[2]
+        registration_pool._pool = None
+
+        # start() returns only once every spawned worker has loaded
+        registration_pool.REGISTRATION_WORKERS = 2
+        registration_pool.start()
+        processes = list(registration_pool._pool._processes.values())
+        assert len(processes) == 2
+        assert np.array_equal(registration_pool.encode_faces(faces), encodings)
+
+        # A dead worker breaks the pool once; the next call gets a fresh one
+        broken = registration_pool._pool
+        os.kill(processes[0].pid, signal.SIGKILL)
+        processes[0].join()
+        try:
+            registration_pool.encode_faces(faces)
+            assert False, 'a killed worker should break the pool'
+        except BrokenProcessPool:
+            pass
+        assert registration_pool._pool is None
+        assert np.array_equal(registration_pool.encode_faces(faces), encodings)
+        assert registration_pool._pool is not broken
+    finally:
+        registration_pool.shutdown()
+        (registration_pool.REGISTRATION_WORKERS, registration_pool._pool, registration_pool._prepare_image,
+         registration_pool.get_pool, app_simple.prepare_registration_image) = saved
+
+def test_serve_splits_registration_workers():
+    saved = registration_pool.REGISTRATION_WORKERS
+    try:
+        # (total, serving processes) -> pool size per process: rounded down, never 0
+        for total, processes, expected in ((8, 2, 4), (5, 2, 2), (7, 3, 2), (1, 4, 1), (3, 4, 1), (6, 1, 6), (6, 0, 6)):
+            registration_pool.REGISTRATION_WORKERS = total
+            assert registration_pool.split_across(processes) == expected, (total, processes)
+            assert registration_pool.REGISTRATION_WORKERS == expected
+            assert registration_pool.enabled() == (expected > 1)
+    finally:
+        registration_pool.REGISTRATION_WORKERS = saved
+
+def test_serve_limits_library_threads():
+    saved_env = {name: os.environ.get(name) for name in serve.BLAS_THREAD_VARIABLES}
+    saved_threads = cv2.getNumThreads()
+    try:
+        for name in serve.BLAS_THREAD_VARIABLES:
+            os.environ.pop(name, None)
+        os.environ['OMP_NUM_THREADS'] = '3'
+
+        # 0 leaves both libraries alone
+        serve.limit_library_threads(0, 0)
+        assert [os.environ.get(name) for name in serve.BLAS_THREAD_VARIABLES] == ['3', None, None, None, None]
+        assert cv2.getNumThreads() == saved_threads
+
+        # An explicit environment setting wins over the cap
+        serve.limit_library_threads(1, 2)
+        assert [os.environ[name] for name in serve.BLAS_THREAD_VARIABLES] == ['3', '1', '1', '1', '1']
+        assert cv2.getNumThreads() == 2
+        serve.limit_library_threads(4, 1)
+        assert os.environ['OPENBLAS_NUM_THREADS'] == '1' and cv2.getNumThreads() == 1
+    finally:
+        cv2.setNumThreads(saved_threads)
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def test_verify_burst_early_exit_and_budget():
+    def fake_score_frame(image, stored_encoding, use_cache):
+        # "outcome:seconds" frames instead of decoding and encoding real ones
+        outcome, seconds = image.split(':')
+        time.sleep(float(seconds))
+        similarity = 0.99 if outcome == 'match' else 0.5
+        return {'match': outcome == 'match', 'decided_by': 'full_encoding', 'combined_sim': similarity,
+                'euclidean_dist': 0.1, 'pixel_sim': similarity}
+
+    saved = app_simple.score_frame, app_simple.VERIFY_BURST_THREADS, app_simple.VERIFY_BURST_BUDGET_MS
+    stored = [0.0] * app_simple.encoder.dimension
+    client = app_simple.app.test_client()
+    try:
+        app_simple.score_frame = fake_score_frame
+        app_simple.VERIFY_BURST_THREADS = 1  # One frame in flight: a deterministic schedule
+
+        # The first match ends the burst; later frames are never scored, extra frames never looked at
+        app_simple.VERIFY_BURST_BUDGET_MS = 5000
+        images = ['miss:0', 'match:0', 'match:0', 'miss:0', 'miss:0', 'miss:0', 'miss:0']
+        body = client.post('/verify-face', json={'images': images, 'stored_encoding': stored}).get_json()
+        assert body['match'] and body['matched_frame'] == 1 and body['frames_scored'] == 2
+        assert body['frames_received'] == 7 and len(body['frames']) == app_simple.VERIFY_BURST_MAX_FRAMES
+        assert [f['status'] for f in body['frames']] == ['scored', 'scored', 'skipped', 'skipped', 'skipped']
+        assert not body['budget_exhausted']
+
+        # A frame still running when the budget runs out is reported, not waited for
+        app_simple.VERIFY_BURST_BUDGET_MS = 100
+        started = time.perf_counter()
+        body = client.post('/verify-face', json={'images': ['miss:0', 'match:1', 'match:0'],
+                                                 'stored_encoding': stored}).get_json()
+        assert time.perf_counter() - started < 0.8
+        assert body['budget_exhausted'] and not body['match'] and body['matched_frame'] is None
+        assert [f['status'] for f in body['frames']] == ['scored', 'unfinished', 'skipped']
+        assert body['similarity'] == 0.5  # Headline scores from the best scored frame
+    finally:
+        app_simple.score_frame, app_simple.VERIFY_BURST_THREADS, app_simple.VERIFY_BURST_BUDGET_MS = saved
+
+def test_face_tracker_roi_hit_miss_and_expiry():
+    saved = app_simple.face_detector, app_simple.face_tracker
+    try:
+        app_simple.face_detector = detector = MarkerDetector()
+        app_simple.face_tracker = FaceTracker(max_sessions=2, ttl_seconds=60, roi_margin=0.5, full_scan_every=3)
+
+        # No history yet: full scan
+        faces, _, tracking = app_simple.detect_faces_tracked(marker_frame((100, 100, 80, 80)), 'kiosk')
+        assert faces == [(100, 100, 80, 80)] and tracking['mode'] == 'full' and tracking['roi_hit'] is None
+
+        # Small move: found inside the ROI around the last box, mapped back to frame coordinates
+        faces, _, tracking = app_simple.detect_faces_tracked(marker_frame((110, 104, 80, 80)), 'kiosk')
+        assert faces == [(110, 104, 80, 80)] and tracking['mode'] == 'roi' and tracking['roi_hit'] is True
+        assert detector.shapes[-1] == (160, 160)  # 80 px box + 40 px margin on every side
+
+        # Face jumped out of the ROI: a miss, then a full scan finds it
+        faces, _, tracking = app_simple.detect_faces_tracked(marker_frame((400, 300, 80, 80)), 'kiosk')
+        assert faces == [(400, 300, 80, 80)] and tracking['mode'] == 'full' and tracking['roi_hit'] is False
+        assert detector.shapes[-2:] == [(160, 160), (480, 640)]
+
+        # Every full_scan_every-th poll scans the whole frame even while the ROI keeps hitting
+        modes = [app_simple.detect_faces_tracked(marker_frame((400, 300, 80, 80)), 'kiosk')[2]['mode']
+                 for _ in range(4)]
+        assert modes == ['roi', 'roi', 'roi', 'full']
+        stats = app_simple.face_tracker.stats('kiosk')['sessions']['kiosk']
+        assert (stats['roi_hits'], stats['roi_misses'], stats['full_scans']) == (4, 1, 3)
+        assert stats['roi_hit_rate'] == 0.8
+
+        # Sessions beyond max_sessions are evicted oldest first
+        for session in ('a', 'b'):
+            app_simple.detect_faces_tracked(marker_frame((100, 100, 80, 80)), session)
+        assert app_simple.face_tracker.roi_for('kiosk', (480, 640)) is None
+        assert app_simple.face_tracker.roi_for('b', (480, 640)) is not None
+
+        # Expired sessions start over with a full scan
+        tracker = FaceTracker(ttl_seconds=0.05)
+        tracker.record('kiosk', (100, 100, 80, 80), 'full')
+        assert tracker.roi_for('kiosk', (480, 640)) == (60, 60, 160, 160)
+        time.sleep(0.1)
+        assert tracker.roi_for('kiosk', (480, 640)) is None and tracker.stats()['totals']['active_sessions'] == 0
+    finally:
+        app_simple.face_detector, app_simple.face_tracker = saved
+
+def test_request_data_json_multipart_and_raw_body():
+    app = app_simple.app
+    with app.test_request_context('/verify-face', json={'image': 'aGk=', 'user_id': 7}):
+        assert app_simple.get_request_data(('images',), 'image') == {'image': 'aGk=', 'user_id': 7}
+
+    # Multipart: files arrive as bytes, repeated parts as a list only for list fields, other fields as strings
+    form = {'images': [(io.BytesIO(b'one'), 'a.jpg'), (io.BytesIO(b'two'), 'b.jpg')],
+            'reference': (io.BytesIO(b'ref'), 'c.jpg'), 'user_id': '7', 'cache': 'false'}
+    with app.test_request_context('/verify-face', data=form, content_type='multipart/form-data'):
+        data = app_simple.get_request_data(('images',), 'image')
+        assert data == {'images': [b'one', b'two'], 'reference': b'ref', 'user_id': '7', 'cache': 'false'}
+        assert not app_simple.cache_requested(data)
+
+    # Raw body: the bytes under raw_field, everything else from the query string
+    for content_type in ('image/jpeg', 'application/octet-stream'):
+        with app.test_request_context('/verify-face?user_id=7', data=b'\xff\xd8raw', content_type=content_type):
+            assert app_simple.get_request_data(('images',), 'image') == {'image': b'\xff\xd8raw', 'user_id': '7'}
+
+    # All three forms reach the same detection
+    saved = app_simple.face_detector
+    try:
+        app_simple.face_detector = MarkerDetector()
+        png = cv2.imencode('.png', marker_frame((100, 120, 90, 90)))[1].tobytes()
+        client = app.test_client()
+        responses = [
+            client.post('/detect-face', json={'image': base64.b64encode(png).decode(), 'cache': False}),
+            client.post('/detect-face', data={'image': (io.BytesIO(png), 'frame.png'), 'cache': 'false'},
+                        content_type='multipart/form-data'),
+            client.post('/detect-face?cache=false', data=png, content_type='image/png')
+        ]
+        for response in responses:
+            assert response.status_code == 200
+            assert response.get_json()['faces'] == [{'x': 100, 'y': 120, 'width': 90, 'height': 90}]
+    finally:
+        app_simple.face_detector = saved
+
+def test_identify_exact_flag_from_every_body():
+    # Form fields and query parameters arrive as strings; "false" must not read as True
+    for data, expected in ((None, True), ({}, True), ({'cache': 'false'}, False), ({'cache': 'Off'}, False),
+                           ({'cache': '1'}, True), ({'cache': False}, False), ({'cache': 0}, False)):
+        assert app_simple.flag(data, 'cache', True) is expected
+    assert app_simple.flag({'exact': ''}, 'exact') is False
+
+    class RecordingGallery:
+        def __init__(self):
+            self.exact = []
+
+        def search(self, encoding, top_k, *thresholds, exact=False):
+            self.exact.append(exact)
+            return [], {'scanned': 0, 'gallery_size': 0, 'mode': 'exact' if exact else 'ivf', 'search_ms': 0.0}
+
+        def search_batch(self, encodings, top_k, *thresholds, exact=False):
+            self.exact.append(exact)
+            return [[] for _ in encodings], {'scanned': 0, 'gallery_size': 0, 'mode': 'exact' if exact else 'ivf',
+                                             'search_ms': 0.0}
+
+    saved = app_simple.face_detector, app_simple.get_gallery
+    try:
+        app_simple.face_detector = MarkerDetector()
+        recording = RecordingGallery()
+        app_simple.get_gallery = lambda: recording
+        image = framed_face(200, 150)
+        png = cv2.imencode('.png', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].tobytes()
+        encoded = base64.b64encode(png).decode()
+        client = app_simple.app.test_client()
+        responses = [
+            client.post('/identify-face', json={'image': encoded, 'exact': False, 'cache': False}),
+            client.post('/identify-face', json={'image': encoded, 'exact': True, 'cache': False}),
+            client.post('/identify-face', data={'image': (io.BytesIO(png), 'frame.png'), 'exact': 'false',
+                                                'cache': 'false'}, content_type='multipart/form-data'),
+            client.post('/identify-face?exact=false&cache=false', data=png, content_type='image/png'),
+            client.post('/identify-face?exact=true&cache=false', data=png, content_type='image/png'),
+            client.post('/identify-faces', data={'image': (io.BytesIO(png), 'frame.png'), 'exact': 'false'},
+                        content_type='multipart/form-data'),
+            client.post('/identify-faces?exact=false', data=png, content_type='image/png'),
+            client.post('/identify-faces?exact=1', data=png, content_type='image/png')
+        ]
+    finally:
+        app_simple.face_detector, app_simple.get_gallery = saved
+
+    assert [response.status_code for response in responses] == [200] * 8
+    assert recording.exact == [False, True, False, False, True, False, False, True]
+
+def test_detect_faces_downscaled_boxes_map_back():
+    shape = (960, 1280)
+    boxes = [(400, 300, 240, 200), (37, 611, 163, 171)]  # Aligned and not aligned to the 4x grid
+    gray = np.full(shape, 90, dtype=np.uint8)
+    for x, y, w, h in boxes:
+        gray[y:y + h, x:x + w] = 255
+
+    class SizeRecordingDetector(MarkerDetector):
+        def detect(self, gray, min_neighbors=6, min_size=(80, 80)):
+            self.min_size = min_size
+            return super().detect(gray, min_neighbors, min_size)
+
+    saved = app_simple.face_detector, app_simple.DETECT_MAX_SIDE
+    try:
+        app_simple.face_detector = detector = SizeRecordingDetector()
+        app_simple.DETECT_MAX_SIDE = 0
+        full, info = app_simple.detect_faces(gray)
+        assert info['scale'] == 1.0 and detector.shapes == [shape] and sorted(full) == sorted(boxes)
+
+        app_simple.DETECT_MAX_SIDE = 320
+        small, info = app_simple.detect_faces(gray)
+        assert info['scale'] == 0.25 and detector.shapes[-1] == (240, 320)
+        assert detector.min_size == (20, 20)  # MIN_FACE_SIZE scaled with the frame
+
+        # Boxes come back in full-resolution pixels, off by at most one downscaled pixel (4 px here)
+        assert len(small) == len(boxes)
+        for found, expected in zip(sorted(small), sorted(full)):
+            assert all(isinstance(v, int) for v in found)
+            assert np.abs(np.subtract(found, expected)).max() <= 4, (found, expected)
+        assert (400, 300, 240, 200) in small  # On the grid the mapping is exact
+
+        # Frames already within the cap are searched as they are
+        app_simple.DETECT_MAX_SIDE = 1280
+        same, info = app_simple.detect_faces(gray)
+        assert info['scale'] == 1.0 and sorted(same) == sorted(boxes)
+    finally:
+        app_simple.face_detector, app_simple.DETECT_MAX_SIDE = saved
+
+def test_face_frame_preprocessed_in_one_pass():
+    image = framed_face(200, 150)
+
+    conversions = []
+    cvt_color = cv2.cvtColor
+    def counting_cvt_color(src, code, *args, **kwargs):
+        conversions.append(src.shape[:2])
+        return cvt_color(src, code, *args, **kwargs)
+
+    saved = app_simple.face_detector
+    try:
+        app_simple.face_detector = detector = MarkerDetector()
+        cv2.cvtColor = counting_cvt_color
+        frame = app_simple.preprocess_image(image)
+    finally:
+        cv2.cvtColor = cvt_color
+        app_simple.face_detector = saved
+
+    # One gray conversion of the full frame, one detection, and the face crop's own gray
+    assert frame.error is None and frame.faces == [(200, 150, 160, 160)]
+    assert detector.shapes == [(480, 640)] and conversions.count((480, 640)) == 1
+    assert np.array_equal(frame.gray, cv2.cvtColor(image, cv2.COLOR_RGB2GRAY))
+
+    # The crop matches cropping and converting the frame separately
+    padding = 16
+    expected = cv2.resize(image[150 - padding:310 + padding, 200 - padding:360 + padding], IMAGE_SIZE)
+    assert np.array_equal(frame.face_img, expected)
+    assert np.array_equal(frame.face_gray, cv2.cvtColor(expected, cv2.COLOR_RGB2GRAY))
+
+    # The encoding is computed once per frame and equals encoding the RGB crop
+    calls = []
+    encode_gray = app_simple.encoder.encode_gray
+    app_simple.encoder.encode_gray = lambda gray: calls.append(gray) or encode_gray(gray)
+    try:
+        first = app_simple.frame_encoding(frame)
+        assert app_simple.frame_encoding(frame) is first and len(calls) == 1
+    finally:
+        del app_simple.encoder.encode_gray
+    assert np.array_equal(first, app_simple.encoder.encode(expected))
+
+    # Quality gates still apply to the single detected box
+    frame = app_simple.preprocess_image(np.full((480, 640, 3), 90, dtype=np.uint8))
+    assert frame.error == "No face detected in the image" and frame.face_img is None
+
+def test_load_frame_cache_hits_and_eviction():
+    pngs = [cv2.imencode('.png', framed_face(100 + 60 * i, 150))[1].tobytes() for i in range(3)]
+    saved = app_simple.face_detector, app_simple.face_cache
+    try:
+        app_simple.face_detector = detector = MarkerDetector()
+        # Room for two cached frames (crop, gray crop and encoding, ~166 KB each)
+        app_simple.face_cache = cache = FaceCache(max_entries=10, max_bytes=400_000)
+
+        first = app_simple.load_frame(pngs[0])
+        assert first.error is None and first.image is None and first.gray is None  # Full-size frames aren't kept
+        encoding = app_simple.frame_encoding(first)
+
+        # Same bytes again, raw or as base64 text: no decode or detection, and the encoding comes along
+        for image in (pngs[0], base64.b64encode(pngs[0]).decode()):
+            frame = app_simple.load_frame(image)
+            assert frame is first and frame.encoding is encoding
+        assert len(detector.shapes) == 1 and (cache.hits, cache.misses) == (2, 1)
+
+        # Opting out neither reads nor fills the cache
+        assert app_simple.load_frame(pngs[0], use_cache=False) is not first
+        assert len(detector.shapes) == 2 and (cache.hits, cache.misses) == (2, 1)
+
+        # A third frame pushes the least recently used one out to stay under max_bytes
+        app_simple.load_frame(pngs[1])
+        app_simple.load_frame(pngs[0])  # pngs[0] is now the most recently used
+        app_simple.load_frame(pngs[2])
+        stats = cache.stats()
+        assert stats['evictions'] == 1 and stats['entries'] == 2 and stats['bytes'] <= 400_000
+        assert app_simple.load_frame(pngs[0]) is first
+        detections = len(detector.shapes)
+        app_simple.load_frame(pngs[1])  # Evicted: detected again
+        assert len(detector.shapes) == detections + 1
+    finally:
+        app_simple.face_detector, app_simple.face_cache = saved
+
+def test_fetch_models_checks_sha256():
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'upstream.onnx')
+        with open(source, 'wb') as f:
+            f.write(b'model bytes')
+        target = os.path.join(directory, 'models', 'model.onnx')
+        saved = fetch_models.MODELS
+        try:
+            fetch_models.MODELS = {'test': {'path': target, 'url': 'file://' + source, 'sha256': '0' * 64,
+                                            'size': len(b'model bytes')}}
+            try:
+                fetch_models.fetch('test')
+                assert False, 'a checksum mismatch must fail'
+            except ValueError:
+                pass
+            # Nothing half-written is left where the service would load it
+            assert os.listdir(os.path.dirname(target)) == []
+
+            fetch_models.MODELS['test']['sha256'] = fetch_models.file_sha256(source)
+            assert fetch_models.fetch('test') and fetch_models.verify('test')[0]
+            assert not fetch_models.fetch('test')  # Already verified, not downloaded again
+            with open(target, 'ab') as f:
+                f.write(b'!')
+            assert 'expected' in fetch_models.verify('test')[1] and not fetch_models.verify('test')[0]
+        finally:
+            fetch_models.MODELS = saved
+
+def test_template_set_scoring_matches_compare_encodings():
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+    encodings = encoder.encode_batch(np.stack([aug for face in make_test_faces(3) for aug in augment_image(face)]))
+    templates = build_template_set(encodings, 3)
+    assert templates.shape == (3, encoder.dimension)
+    assert np.array_equal(templates, build_template_set(encodings, 3))  # deterministic
+
+    packed = load_template(template_to_text(templates, 'float32'), encoder.dimension)
+    assert packed.tobytes() == templates.astype(np.float32).tobytes()
+    # Single templates keep the original header byte-for-byte (count 0)
+    assert pack_template(encodings[0])[7] == 0
+
+    for probe in encodings[::5]:
+        combined, distance, pixel = score_template_set(packed, probe)
+        for row, scores in enumerate(zip(combined, distance, pixel)):
+            assert np.allclose(scores, compare_encodings(packed[row], probe), atol=1e-6)
+
+    # Duplicate frames: k is capped at the distinct samples and no cluster comes back empty (NaN)
+    duplicated = np.repeat(encodings[:4], 5, axis=0)
+    templates = build_template_set(duplicated, 10)
+    assert templates.shape == (4, encoder.dimension) and np.isfinite(templates).all()
+
+def test_duplicate_pairs_match_compare_encodings():
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+    encodings = encoder.encode_batch(np.stack([aug for face in make_test_faces(4) for aug in augment_image(face)]))
+    ids = [f'user{i}' for i in range(len(encodings))]
+
+    # Small tiles so pairs straddle tile boundaries and the diagonal tiles
+    pairs, info = find_duplicate_pairs(ids, encodings, app_simple.TOLERANCE, app_simple.MAX_DISTANCE,
+                                       app_simple.MIN_PIXEL_SIMILARITY, block_size=5, workers=2)
+    expected = set()
+    for i in range(len(encodings)):
+        for j in range(i + 1, len(encodings)):
+            combined, distance, pixel = compare_encodings(encodings[i], encodings[j])
+            if combined >= app_simple.TOLERANCE and distance <= app_simple.MAX_DISTANCE \
+                    and pixel >= app_simple.MIN_PIXEL_SIMILARITY:
+                expected.add((ids[i], ids[j]))
+    assert expected
+    assert {(pair['user_a'], pair['user_b']) for pair in pairs} == expected
+    assert info['pairs_found'] == len(expected) and not info['truncated']
+
+def test_face_cache_lru_limits():
+    cache = FaceCache(max_entries=3, max_bytes=100)
+    keys = [content_key(bytes([i]) * 10) for i in range(5)]
+    assert len(set(keys)) == 5 and content_key(b'x', 'detect:') != content_key(b'x', 'frame:')
+
+    for key in keys[:3]:
+        cache.put(key, key, 10)
+    assert cache.get(keys[0]) == keys[0]  # now most recently used
+    cache.put(keys[3], keys[3], 10)  # count limit evicts keys[1], the least recently used
+    assert cache.get(keys[1]) is None and cache.get(keys[0]) is not None
+
+    cache.put(keys[4], keys[4], 80)  # byte limit evicts until the total fits again
+    stats = cache.stats()
+    assert stats['bytes'] == 100 and stats['entries'] == 3 and cache.get(keys[2]) is None
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 1, 2)
+
+    cache.put('huge', 'value', 101)  # larger than the whole cache: not kept
+    assert cache.get('huge') is None
+    assert FaceCache(max_entries=0).enabled is False
+
+def test_haar_backend_matches_cascade():
+    cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    detector = create_detector('haar')
+    for face in make_test_faces(3):
+        gray = cv2.resize(cv2.cvtColor(face, cv2.COLOR_RGB2GRAY), (400, 400))
+        expected = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=3, minSize=(40, 40))
+        assert detector.detect(gray, min_neighbors=3, min_size=(40, 40)) == [tuple(map(int, f)) for f in expected]
+
+    # Every thread detects with its own cascade instance, with the same results
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        instances = set(pool.map(lambda _: id(detector._instance()), range(2))) | {id(detector._instance())}
+        assert pool.submit(detector.detect, gray, 3, (40, 40)).result() == detector.detect(gray, 3, (40, 40))
+    assert len(instances) >= 2
+
+    for name, options in [('no-such-backend', {}), ('yunet', {'model_path': '/nonexistent/model.onnx'})]:
+        try:
+            create_detector(name, **options)
+        except (ValueError, RuntimeError):
+            continue
+        raise AssertionError(f"created detector {name}")
+
+def test_yunet_backend_detects():
+    if not os.path.isfile(app_simple.FACE_DETECTOR_MODEL):
+        return skip(f"YuNet model not found at {app_simple.FACE_DETECTOR_MODEL} (python fetch_models.py)")
+    detector = create_detector('yunet', model_path=app_simple.FACE_DETECTOR_MODEL, score_threshold=0.5)
+    assert detector.detect(np.full((480, 640), 90, dtype=np.uint8)) == []
+
+    # Drawn faces scaled into a larger frame: boxes are int tuples inside the frame, filtered by min_size
+    frame = np.full((480, 640, 3), 90, dtype=np.uint8)
+    frame[80:400, 160:480] = cv2.resize(make_test_faces(3)[2], (320, 320))
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    faces = detector.detect(gray, min_size=(1, 1))
+    for x, y, w, h in faces:
+        assert all(isinstance(v, int) for v in (x, y, w, h))
+        assert 0 <= x and 0 <= y and x + w <= 640 and y + h <= 480
+    assert detector.detect(gray, min_size=(481, 481)) == []
+
+    # Each thread runs its own FaceDetectorYN with the same results, also on a second input size
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert pool.submit(detector.detect, gray, 6, (1, 1)).result() == faces
+        small = cv2.resize(gray, (320, 240))
+        assert pool.submit(detector.detect, small, 6, (1, 1)).result() == detector.detect(small, 6, (1, 1))
+
+def test_calibration_sweep_matches_brute_force():
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+    encodings = encoder.encode_batch(np.stack([aug for face in make_test_faces(4) for aug in augment_image(face)]))
+    labels = np.repeat(np.arange(4), len(encodings) // 4)
+    scores = score_pairs(encodings, labels, encodings, labels, skip_self=True)
+    assert len(scores['genuine'][0]) == 4 * 21 and len(scores['impostor'][0]) == 28 * 27 // 2 - 4 * 21
+
+    genuine = [compare_encodings(encodings[i], encodings[j]) for i in range(len(encodings))
+               for j in range(i + 1, len(encodings)) if labels[i] == labels[j]]
+    assert np.allclose(np.array(scores['genuine'])[[0, 2]].T, np.array(genuine)[:, [0, 2]], atol=1e-6)
+    assert np.allclose(scores['genuine'][1], np.array(genuine)[:, 1], atol=1e-3)  # Cancellation near 0
+
+    # Grids include actual scores so the >= / <= boundaries are exercised
+    combined, distance, pixel = (np.concatenate([scores['genuine'][k], scores['impostor'][k]]) for k in range(3))
+    grids = [np.unique(np.concatenate([np.linspace(low, high, 7), values[::50]]))
+             for values, low, high in ((combined, 0.5, 1.0), (distance, 0.0, 0.8), (pixel, 0.5, 1.0))]
+    far, frr = sweep(scores['genuine'], scores['impostor'], *grids)
+    for i, tolerance in enumerate(grids[0]):
+        for j, max_distance in enumerate(grids[1]):
+            for k, min_pixel in enumerate(grids[2]):
+                rates = [np.mean((c >= tolerance) & (d <= max_distance) & (p >= min_pixel))
+                         for c, d, p in (scores['impostor'], scores['genuine'])]
+                assert np.isclose(far[i, j, k], rates[0]) and np.isclose(frr[i, j, k], 1 - rates[1])
+
+def test_metrics_text_format():
+    metrics = ServiceMetrics(enabled=True, buckets=(0.001, 0.01))
+    for seconds in (0.0005, 0.001, 0.005, 0.5):
+        metrics.observe_stage('encode', seconds)
+    metrics.reject('blurry')
+    metrics.reject('blurry')
+    token = metrics.request_started('/verify-face')
+    with metrics.stage('detect'):
+        metrics.reject('no_face')
+    metrics.request_finished('/verify-face', 200, token)
+
+    lines = metrics.render().splitlines()
+    for expected in ['face_stage_seconds_bucket{stage="encode",endpoint="background",le="0.001"} 2',
+                     'face_stage_seconds_bucket{stage="encode",endpoint="background",le="0.01"} 3',
+                     'face_stage_seconds_bucket{stage="encode",endpoint="background",le="+Inf"} 4',
+                     'face_stage_seconds_count{stage="encode",endpoint="background"} 4',
+                     'face_stage_seconds_count{stage="detect",endpoint="/verify-face"} 1',
+                     'face_rejections_total{reason="blurry",endpoint="background"} 2',
+                     'face_rejections_total{reason="no_face",endpoint="/verify-face"} 1',
+                     'face_requests_in_flight{endpoint="/verify-face"} 0',
+                     'face_requests_total{endpoint="/verify-face",status="200"} 1',
+                     '# TYPE face_request_seconds histogram']:
+        assert expected in lines, expected
+
+    # Disabled: nothing is recorded
+    disabled = ServiceMetrics(enabled=False)
+    with disabled.stage('encode'):
+        disabled.reject('no_face')
+    assert disabled.stages.count(('encode', 'background')) == 0
+    assert disabled.rejections.value(('no_face', 'background')) == 0
+
+    # Worker processes: another process's published series are summed in; an exited one's gauges are not
+    with tempfile.TemporaryDirectory() as directory:
+        metrics.shared_dir = directory
+        with open(os.path.join(directory, 'metrics-999999999.json'), 'w') as f:
+            json.dump({'face_rejections_total': [[['blurry', 'background'], 3]],
+                       'face_requests_in_flight': [[['/verify-face'], 5]],
+                       'face_stage_seconds': [[['encode', 'background'], [[1, 0, 0], 0.0002]]]}, f)
+        lines = metrics.render().splitlines()
+        for expected in ['face_rejections_total{reason="blurry",endpoint="background"} 5',
+                         'face_requests_in_flight{endpoint="/verify-face"} 0',
+                         'face_stage_seconds_bucket{stage="encode",endpoint="background",le="0.001"} 3',
+                         'face_stage_seconds_count{stage="encode",endpoint="background"} 5']:
+            assert expected in lines, expected
+
+def time_encoder(fn, faces, repeats=3):
+    """Best-of-N mean milliseconds per face"""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for face in faces:
+            fn(face)
+        best = min(best, (time.perf_counter() - start) / len(faces))
+    return best * 1000
+
+def main():
+    print("="*60)
+    print("FACE ENCODING PARITY CHECK")
+    print("="*60)
+
+    for test in [test_lbp_matches_reference, test_grid_features_bit_identical, test_encoding_bit_identical,
+                 test_float32_encoder_within_tolerance, test_encoder_falls_back_to_float64_past_tolerance,
+                 test_batch_matches_single,
+                 test_gallery_matches_compare_encodings, test_template_store_rows_and_changes,
+                 test_pairwise_scores_match_compare_encodings,
+                 test_compare_batch_endpoint_items_and_nulls,
+                 test_template_codec_round_trip,
+                 test_staged_verification_matches_full, test_enrollment_fold_matches_full_average,
+                 test_enroll_update_requires_matching_faces, test_identify_rejects_bad_numbers,
+                 test_identify_faces_per_face_matches,
+                 test_registration_jobs_claim_requeue_and_queue_full,
+                 test_registration_pool_order_recovery_and_fallback,
+                 test_serve_splits_registration_workers, test_serve_limits_library_threads,
+                 test_verify_burst_early_exit_and_budget,
+                 test_face_tracker_roi_hit_miss_and_expiry,
+                 test_request_data_json_multipart_and_raw_body,
+                 test_identify_exact_flag_from_every_body,
+                 test_detect_faces_downscaled_boxes_map_back,
+                 test_face_frame_preprocessed_in_one_pass,
+                 test_load_frame_cache_hits_and_eviction,
+                 test_fetch_models_checks_sha256,
+                 test_template_set_scoring_matches_compare_encodings,
+                 test_duplicate_pairs_match_compare_encodings, test_face_cache_lru_limits,
+                 test_haar_backend_matches_cascade, test_yunet_backend_detects, test_calibration_sweep_matches_brute_force,
+                 test_metrics_text_format]:
+        test()
+        print(f"  ✓ {test.__name__}")
+
+    faces = make_test_faces()
+    reference = FaceEncoder(IMAGE_SIZE, dtype=np.float64)
+    before = time_encoder(reference_create_face_encoding, faces, repeats=1)
+    print(f"\nLatency per encoding ({IMAGE_SIZE[0]}x{IMAGE_SIZE[1]}):")
+    print(f"  Reference (loops):      {before:.2f} ms")
+    for label, encoder in [('float64', reference),
+                           ('float32', FaceEncoder(IMAGE_SIZE, dtype=np.float32)),
+                           ('float32 + cv2 HOG', FaceEncoder(IMAGE_SIZE, dtype=np.float32, use_cv2_gradients=True))]:
+        after = time_encoder(encoder.encode, faces)
+        deviation = encoding_deviation(encoder, reference, faces)
+        print(f"  {label + ':':<23} {after:.2f} ms ({before / after:.0f}x, deviation {deviation:.5f})")
+
+    # Registration-sized batch: 5 images x 7 augmentations
+    augmented = np.stack([aug for face in make_test_faces(5) for aug in augment_image(face)])
+    encoder = FaceEncoder(IMAGE_SIZE, dtype=np.float32)
+    serial = time_encoder(encoder.encode, augmented) * len(augmented)
+    batched = time_encoder(encoder.encode_batch, [augmented])
+    print(f"\n{len(augmented)} augmented samples (float32):")
+    print(f"  One at a time: {serial:.1f} ms")
+    print(f"  Single batch:  {batched:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,8 @@
             if (is_array($encoding)) {
                 echo "Encoding Array Length: " . count($encoding) . "\n";
                 echo "First 5 values: " . implode(', ', array_slice($encoding, 0, 5)) . "\n";
+            } elseif (str_starts_with((string) base64_decode($user->face_encoding, true), 'FTPL')) {
+                echo "Compact template: " . strlen($user->face_encoding) . " chars (base64)\n";
             } else {
                 echo "⚠️ WARNING: face_encoding is not a valid JSON array!\n";
                 echo "Raw data (first 100 chars): " . substr($user->face_encoding, 0, 100) . "\n";